@@ -1,7 +1,19 @@
+import datetime
 import ldap
+import ldap.filter
 import re
+import threading
 
-from logic.models import GlobalSettings
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from logic.db import write_transaction
+from logic.models import GlobalSettings, RosterGroup, RosterMember
+from .ldap_client import LDAPClient
+
+import logging
+logger = logging.getLogger(__name__)
 
 ##############################################################################################
 # settings
@@ -24,77 +36,203 @@ def course_groups():
 def get_default_group_id():
     return course_main()
 
+def _or_current(cid):
+    # course ids default to the current one, looked up on each call (a default argument would be looked up once,
+    # on import, and kept until restart)
+    return cid if cid is not None else course_id()
+
+ROSTER_DEFAULTS = {
+    'MAX_AGE': 6 * 3600, # seconds, older rosters are synced on the next login
+    'SYNC_INTERVAL': 300, # seconds, logins trigger at most one sync in this interval, in all processes
+    'CACHE': 'default', # shared by all processes, for claiming syncs
+}
+
+def roster_conf():
+    return dict(ROSTER_DEFAULTS, **getattr(settings, 'ROSTER', {}))
+
+CLIENT_DEFAULTS = {
+    'POOL_SIZE': 4,
+    'TIMEOUT': 5, # seconds
+    'WORKERS': 4,
+    'DN_TTL': 300, # seconds
+}
+
 ##############################################################################################
 
 ##############################################################################################
 # functionality
 
 def connect():
-    if enabled():
-        return ldap.initialize(ENDPOINT)
+    return ldap.initialize(ENDPOINT)
+
+def _create_client():
+    conf = dict(CLIENT_DEFAULTS, **getattr(settings, 'LDAP_CLIENT', {}))
+    return LDAPClient(connect, conf['POOL_SIZE'], conf['TIMEOUT'], conf['WORKERS'], conf['DN_TTL'])
+
+client = _create_client()
 
 def auth(uname, pw):
     if not enabled():
         return True
-    success = False
+    user_dn = get_user_dn(uname)
+    if not user_dn:
+        return False
     try:
-        user_ou = get_user_ou(uname)
-        if user_ou:
-            connect().simple_bind_s('cn=%s,ou=%s,o=TAU' % (uname, get_user_ou(uname)), pw.encode('utf-8'))
-            success = True
+        client.bind(user_dn, pw.encode('utf-8'))
     except ldap.INVALID_CREDENTIALS:
-        pass
-    return success
+        return False
+    return True
 
 def user_exists(uname):
     if not enabled():
         return True
-    for ou in USER_OU:
-        if user_exists_in_ou(uname, ou):
-            return True
-    return False
+    return get_user_dn(uname) is not None
 
 def user_exists_in_ou(uname, ou):
     if not enabled():
         return True
-    result = connect().search_s('ou=%s,o=TAU' % ou, ldap.SCOPE_SUBTREE, 'cn=%s' % uname)
+    return _user_exists_in_ou(uname, ou)
+
+def _user_exists_in_ou(uname, ou):
+    result = client.search('ou=%s,o=TAU' % ou, 'cn=%s' % ldap.filter.escape_filter_chars(uname))
     return len(result) > 0
 
-def user_exists_in_course(uname, course_id=course_id(), group_id=course_main()):
+def user_exists_in_course(uname, course_id=None, group_id=None):
     if not enabled():
         return True
+    course_id, group_id = _or_current(course_id), group_id or course_main()
     students = list_students(course_id, group_id)
     return uname in students or uname.lower() in students or uname.upper() in students
 
-def get_user_group_id(uname, course_id=course_id()):
+def get_user_group_id(uname, course_id=None):
     if not enabled():
         return course_main()
-    for group_id in course_groups() + [course_main()]:
-        if user_exists_in_course(uname, course_id, group_id):
-            return group_id
+    course_id = _or_current(course_id)
+    group_ids = get_all_user_group_ids(uname, course_id)
+    if group_ids:
+        return group_ids[0]
 
-def get_all_user_group_ids(uname, course_id=course_id()):
+def get_all_user_group_ids(uname, course_id=None):
     if not enabled():
         return [course_main()]
+    course_id = _or_current(course_id)
+    group_ids = roster_group_ids(uname, course_id)
+    if group_ids is None and try_sync_roster(course_id):
+        group_ids = roster_group_ids(uname, course_id)
+    if not group_ids:
+        # not in the roster (which may be older than the user's registration, or still not synced), ask ldap
+        group_ids = lookup_user_group_ids(uname, course_id)
     return [
         group_id for group_id in course_groups() + [course_main()]
-        if user_exists_in_course(uname, course_id, group_id)
+        if group_id in group_ids
     ]
 
-def list_students(course_id=course_id(), group_id=course_main()):
+def list_students(course_id=None, group_id=None):
     if not enabled():
         return []
-    result = connect().search_s('ou=Courses,o=TAU', ldap.SCOPE_SUBTREE, 'cn=%s%s' % (course_id, group_id))
+    return _list_students(_or_current(course_id), group_id or course_main())
+
+def _list_students(course_id, group_id):
+    result = client.search('ou=Courses,o=TAU', 'cn=%s%s' % (course_id, group_id))
     return {_extract_cn(entry) for entry in result[0][1]['member']}
 
+def lookup_user_group_ids(uname, course_id=None):
+    """ returns the set of the user's group ids in ldap, by a single query for the course groups listing the user """
+    course_id = _or_current(course_id)
+    user_dn = get_user_dn(uname)
+    if not user_dn:
+        return set()
+    groups = ''.join('(cn=%s%s)' % (course_id, group_id) for group_id in course_groups() + [course_main()])
+    query = '(&(|%s)(member=%s))' % (groups, ldap.filter.escape_filter_chars(user_dn))
+    result = client.search('ou=Courses,o=TAU', query, attrs=['cn'])
+    return {attrs['cn'][0][len(course_id):] for _, attrs in result}
+
 def get_user_ou(uname):
     if enabled():
-        for ou in USER_OU:
-            if user_exists_in_ou(uname, ou):
+        # query all ous at once (the worker threads do not check the settings, so as not to use the database)
+        exists = client.map(lambda ou: _user_exists_in_ou(uname, ou), USER_OU)
+        for ou, ou_exists in zip(USER_OU, exists):
+            if ou_exists:
                 return ou
 
+def get_user_dn(uname):
+    """ returns the user's bind dn, or None if the user does not exist. dns are cached for a short while """
+    user_dn = client.dn_cache.get(uname)
+    if user_dn is None:
+        user_ou = get_user_ou(uname)
+        if not user_ou:
+            return None
+        user_dn = 'cn=%s,ou=%s,o=TAU' % (uname, user_ou)
+        client.dn_cache.set(uname, user_dn)
+    return user_dn
+
 def _extract_cn(entry):
     match = re.findall('cn=(\S+?),', entry)
     return match[0] if match else None
 
 ##############################################################################################
+# local roster
+
+def sync_roster(course_id=None):
+    """ downloads the members of all course groups into the local roster """
+    course_id = _or_current(course_id)
+    logger.info('syncing roster of course %s', course_id)
+    synced = timezone.now()
+    group_ids = course_groups() + [course_main()]
+    # download all groups at once, then store them
+    rosters = client.map(lambda group_id: _list_students(course_id, group_id), group_ids)
+    for group_id, members in zip(group_ids, rosters):
+        _store_roster_group(course_id, group_id, {m.lower() for m in members if m}, synced)
+
+_sync_lock = threading.Lock()
+
+def try_sync_roster(course_id=None):
+    """
+    syncs the roster unless it is being synced, or a sync was started in the last SYNC_INTERVAL seconds by any
+    process, so that a storm of logins with a stale roster downloads it once. returns whether it was synced
+    """
+    course_id = _or_current(course_id)
+    if not _sync_lock.acquire(False):
+        return False
+    try:
+        conf = roster_conf()
+        if not caches[conf['CACHE']].add('roster-sync:%s' % course_id, True, conf['SYNC_INTERVAL']):
+            return False
+        sync_roster(course_id)
+        return True
+    except ldap.LDAPError, e:
+        logger.error('failed syncing roster of course %s: %s', course_id, e)
+        return False
+    finally:
+        _sync_lock.release()
+
+@write_transaction
+def _store_roster_group(course_id, group_id, members, synced):
+    group, _ = RosterGroup.objects.get_or_create(course_id=course_id, group_id=group_id, defaults={'synced': synced})
+    RosterMember.objects.filter(group=group).delete()
+    RosterMember.objects.bulk_create([RosterMember(group=group, username=m) for m in members], batch_size=500)
+    group.synced = synced
+    group.save()
+    logger.debug('stored roster group %s%s: %d members', course_id, group_id, len(members))
+
+def roster_group_ids(uname, course_id=None):
+    """
+    returns the set of the user's group ids according to the local roster, or None if the roster is missing or stale
+    """
+    course_id = _or_current(course_id)
+    group_ids = set(course_groups() + [course_main()])
+    synced = dict(RosterGroup.objects.filter(course_id=course_id, group_id__in=group_ids).values_list('group_id', 'synced'))
+    if set(synced) != group_ids:
+        logger.debug('%s: roster of course %s is missing groups', uname, course_id)
+        return None
+    conf = roster_conf()
+    age = timezone.now() - min(synced.itervalues())
+    if age > datetime.timedelta(seconds=conf['MAX_AGE']):
+        logger.debug('%s: roster of course %s is stale', uname, course_id)
+        return None
+    return set(
+        RosterMember.objects.filter(group__course_id=course_id, username=uname.lower())
+            .values_list('group__group_id', flat=True)
+    )
+
+##############################################################################################
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+LDAP client with a bounded connection pool, per-operation timeouts, concurrent queries and
+per-operation latency metrics.
+"""
+import Queue
+import threading
+import time
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import ldap
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Metrics(object):
+    """ per-operation count, errors and latency """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = {}
+
+    @contextmanager
+    def measure(self, op):
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                m = self.ops.setdefault(op, {'count': 0, 'errors': 0, 'total': 0., 'max': 0.})
+                m['count'] += 1
+                m['errors'] += int(failed)
+                m['total'] += elapsed
+                m['max'] = max(m['max'], elapsed)
+            logger.debug('ldap %s took %.3fs%s', op, elapsed, ' (failed)' if failed else '')
+
+    def get(self):
+        with self.lock:
+            return {
+                op: dict(m, avg=m['total'] / m['count'])
+                for op, m in self.ops.iteritems()
+            }
+
+class TTLCache(object):
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.items.get(key, (None, 0))
+            if expires < time.time():
+                self.items.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.time() + self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+class LDAPClient(object):
+    """
+    connect is a function returning a new ldap connection. at most pool_size connections are open at
+    a time, and waiting for a connection or for an ldap operation takes at most timeout seconds.
+    """
+
+    def __init__(self, connect, pool_size=4, timeout=5, workers=4, dn_ttl=300):
+        self.connect = connect
+        self.timeout = timeout
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.idle = Queue.LifoQueue()
+        for _ in range(pool_size):
+            self.idle.put(None) # a connection slot, connected on first use
+        self.dn_cache = TTLCache(dn_ttl)
+        self.metrics = Metrics()
+
+    def _new_connection(self):
+        conn = self.connect()
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ a pooled connection, which is discarded if an ldap error occurs """
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise ldap.TIMEOUT('no ldap connection available')
+        try:
+            if conn is None:
+                conn = self._new_connection()
+            yield conn
+        except ldap.LDAPError:
+            conn = None
+            raise
+        finally:
+            self.idle.put(conn)
+
+    def search(self, base, query, attrs=None):
+        with self.metrics.measure('search'):
+            with self.connection() as conn:
+                return conn.search_st(base, ldap.SCOPE_SUBTREE, query, attrlist=attrs, timeout=self.timeout)
+
+    def bind(self, dn, password):
+        """ binds on a new connection that is not pooled, raises ldap.INVALID_CREDENTIALS if credentials are wrong """
+        with self.metrics.measure('bind'):
+            conn = self._new_connection()
+            try:
+                conn.simple_bind_s(dn, password)
+            finally:
+                try:
+                    conn.unbind_s()
+                except ldap.LDAPError:
+                    pass
+
+    def map(self, func, items):
+        """ calls func on each of the items concurrently, returns the results in order """
+        items = list(items)
+        if len(items) <= 1:
+            return map(func, items)
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool.map(func, items)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous logging.
+
+QueueHandler puts log records on an in-process queue, and a QueueListener thread passes them on to
+the actual handlers, so that requests do not wait on log i/o. QueueSocketHandler is set up in the
+settings: its listener sends the records to the log server (see the log_server command), which is
+the single writer of the log file for all processes.
+
+Python 2.7 has no logging.handlers.QueueHandler/QueueListener, so they are provided here.
+"""
+import Queue
+import SocketServer
+import atexit
+import cPickle
+import logging
+import logging.handlers
+import os
+import random
+import struct
+import threading
+
+from django.conf import settings
+
+_formatter = logging.Formatter()
+
+class QueueHandler(logging.Handler):
+    """
+    queues records as they are, so that formatting them (e.g. rendering a sampled context) is left to the
+    listener thread. the message arguments must therefore not be changed once logged
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            # don't block the request, the listener is falling behind
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name='log-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.queue.put(self._sentinel)
+            self.thread.join()
+            self.thread = None
+
+    def prepare(self, record):
+        """
+        merges the message arguments and the traceback into the record, so that the handlers (which may pass
+        it on to another process) need not format them again
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        record = self.prepare(record)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+class FallbackSocketHandler(logging.handlers.SocketHandler):
+    """ socket handler that passes records to a fallback handler while the log server is unreachable """
+
+    def __init__(self, host, port, fallback=None):
+        logging.handlers.SocketHandler.__init__(self, host, port)
+        self.fallback = fallback
+
+    def emit(self, record):
+        if self.sock is None:
+            # connects, unless a previous attempt failed recently
+            self.createSocket()
+        if self.sock is None and self.fallback:
+            self.fallback.handle(record)
+        else:
+            logging.handlers.SocketHandler.emit(self, record)
+
+class QueueSocketHandler(QueueHandler):
+    """
+    queues records for a listener thread that sends them to the log server, the listener is started
+    on first use in each process (so that it survives forking). while the log server is unreachable,
+    records are written to the fallback file, if given. all processes append to the fallback file, so
+    it is not rotated here (which would race between them), but may be rotated externally (e.g. by
+    logrotate), and is then reopened
+    """
+
+    def __init__(self, host, port, fallback=None, maxsize=10000):
+        QueueHandler.__init__(self, Queue.Queue(maxsize))
+        fallback_handler = None
+        if fallback:
+            fallback_handler = logging.handlers.WatchedFileHandler(fallback, delay=True)
+            fallback_handler.setFormatter(logging.Formatter(getattr(settings, 'LOG_FORMAT', logging.BASIC_FORMAT)))
+        self.socket_handler = FallbackSocketHandler(host, port, fallback_handler)
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self._start()
+        QueueHandler.emit(self, record)
+
+    def _start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.listener = QueueListener(self.queue, self.socket_handler)
+            self.listener.start()
+            self.pid = os.getpid()
+            atexit.register(self.listener.stop)
+
+    def close(self):
+        if self.listener and self.pid == os.getpid():
+            self.listener.stop()
+        self.socket_handler.close()
+        QueueHandler.close(self)
+
+class LogRecordStreamHandler(SocketServer.StreamRequestHandler):
+    """ reads the records sent by a SocketHandler: each is a 4-byte length followed by a pickled dict """
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack('>L', header)[0]
+            data = self.rfile.read(length)
+            if len(data) < length:
+                break
+            self.server.handle_record(logging.makeLogRecord(cPickle.loads(data)))
+
+class LogServer(SocketServer.ThreadingTCPServer):
+    """
+    receives log records from all processes and passes them to a single handler. records are
+    unpickled, so the server should only listen on a local address
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        SocketServer.ThreadingTCPServer.__init__(self, address, LogRecordStreamHandler)
+        self.handler = handler
+
+    def handle_record(self, record):
+        if record.levelno >= self.handler.level:
+            self.handler.handle(record)
+
+class sampled(object):
+    """
+    wraps a large object (e.g. a template context) for logging, so that it is rendered only in one
+    of every settings.LOG_CONTEXT_SAMPLE records, and only if the record is actually logged
+    """
+
+    def __init__(self, obj, rate=None):
+        self.obj = obj
+        rate = rate or getattr(settings, 'LOG_CONTEXT_SAMPLE', 1)
+        self.chosen = random.random() * rate < 1
+
+    def __str__(self):
+        if self.chosen:
+            return '%s' % (self.obj,)
+        return '<not sampled>'
+
+    __repr__ = __str__
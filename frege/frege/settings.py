@@ -48,6 +48,7 @@ MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 #MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
 MIDDLEWARE_CLASSES = [
+    'logic.middleware.PerfMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,11 +89,110 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, '../data/db.sqlite3'),
         'OPTIONS': {
-            'timeout': 10,
+            'timeout': 5,
         }
+    },
+    # read-only copy of the default database for heavy reads, updated by the snapshot_db command
+    'snapshot': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, '../data/snapshot.sqlite3'),
+        'READ_ONLY': True,
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
+}
+DATABASE_ROUTERS = ['logic.db.SnapshotRouter']
+
+# snapshots older than MAX_AGE seconds are not used, and reads go to the default database instead
+SNAPSHOT = {
+    'MAX_AGE': 600,
+    'INTERVAL': 120,
+}
+
+# sqlite connection pragmas and write retries (see logic/db.py): with WAL journaling readers do not
+# block the writer, locked write transactions are retried with backoff, and with SQLITE_SINGLE_WRITER
+# the writers of each process wait in line for each other instead of competing for the database lock
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('cache_size', -16000), # KB
+]
+SQLITE_RETRY = {
+    'ATTEMPTS': 6,
+    'BASE_DELAY': 0.05,
+    'MAX_DELAY': 1.,
+}
+SQLITE_SINGLE_WRITER = True
+
+# ldap connection pool, operation timeout (seconds) and concurrent queries (see frege/ldap_client.py)
+LDAP_CLIENT = {
+    'POOL_SIZE': 8,
+    'TIMEOUT': 5,
+    'WORKERS': 8,
+    'DN_TTL': 600,
+}
+
+# request performance histograms (see logic/perf.py), served to staff at /perf/ and summarized
+# to the log every LOG_INTERVAL seconds
+PERF = {
+    'ENABLED': True,
+    'LOG_INTERVAL': 300,
+}
+
+# local course roster (see auth_ldap), synced from ldap by the sync_roster command (e.g. from cron), or by
+# a login once stale (at most once per SYNC_INTERVAL). users missing from the roster are looked up in ldap
+ROSTER = {
+    'MAX_AGE': 6 * 3600,
+    'SYNC_INTERVAL': 300,
+}
+
+# admission control of answer and submission posts, per process (see logic/admission.py): at most
+# MAX_CONCURRENT posts at a time, waiting in line up to MAX_WAIT seconds, and RATE posts a second per user
+ADMISSION = {
+    'ENABLED': True,
+    'MAX_CONCURRENT': 4,
+    'MAX_QUEUE': 50,
+    'MAX_WAIT': 5, # seconds
+    'RATE': 1.,
+    'BURST': 5,
+}
+
+# the cache is shared by all server processes, for the responses of repeated answer posts (see logic/idempotency.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '../data/cache'),
     }
 }
 
+# answer posts claim their idempotency keys by locking files in LOCK_DIR, which clear_idempotency_locks
+# clears of the files left by processes that died (e.g. from cron)
+IDEMPOTENCY = {
+    'LOCK_DIR': os.path.join(BASE_DIR, '../data/idempotency'),
+    'TIMEOUT': 300, # seconds
+    'WAIT': 5, # seconds
+}
+
+# followup pages poll for changes of their answer, answered from the cache (see logic/refresh.py), and poll
+# less often while answer posts wait for admission
+FOLLOWUP_REFRESH = {
+    'POLL_INTERVAL': 20, # seconds
+    'PEAK_POLL_INTERVAL': 60, # seconds
+}
+
+# answer stats are written in batches after the answer is saved (see logic/stat_buffer.py),
+# the journal keeps queued stats on disk so that they are not lost if a process crashes
+STAT_BUFFER = {
+    'BATCH_SIZE': 50,
+    'FLUSH_INTERVAL': 2, # seconds
+    'JOURNAL_DIR': os.path.join(BASE_DIR, '../data/stats-journal'),
+}
+
+# synthetic data for load and scale tests is only written to a database of its own (see frege/synthetic_settings.py)
+SYNTHETIC_DATA = False
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -123,14 +223,50 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, '../media/')
 
+# media files are served by the application after a permission check, and their transfer is handed to the
+# front-end server with SENDFILE set to 'x-sendfile' (apache mod_xsendfile, with XSendFilePath MEDIA_ROOT) or
+# 'x-accel-redirect' (nginx, with an internal location at ACCEL_PREFIX aliased to MEDIA_ROOT), see logic/media.py.
+# the front-end server must not serve MEDIA_URL directly
+MEDIA_SERVE = {
+    'SENDFILE': None,
+    'ACCEL_PREFIX': '/protected-media/',
+}
+
+# previews of uploaded images are made in the background once stored, if Pillow is installed (see logic/previews.py)
+UPLOAD_PREVIEWS = {
+    'PREVIEW_SIZE': 1600,
+    'THUMBNAIL_SIZE': 200,
+    'QUALITY': 75,
+}
+
+# uploads are streamed to disk and hashed, and stopped once larger than the maximum file size in the
+# global settings (see logic/uploads.py)
+FILE_UPLOAD_HANDLERS = ['logic.uploads.HashingUploadHandler']
+
 # Logging
 
+# logging: records are queued in each process and sent by a background thread to the log server
+# (manage.py log_server, started by deploy), which is the single writer of LOG_FILE. while the log
+# server is down, records are appended to LOG_FALLBACK_FILE, which is not rotated by the processes.
+LOG_FILE = os.path.join(BASE_DIR, '../logs/app.log')
+LOG_FALLBACK_FILE = os.path.join(BASE_DIR, '../logs/app-fallback.log')
+LOG_SERVER = ('localhost', 9020)
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(module)s.%(funcName)s] %(message)s'
+# template contexts are logged for one of every LOG_CONTEXT_SAMPLE requests
+LOG_CONTEXT_SAMPLE = 20
+# per-module log levels
+LOG_LEVELS = {
+    'logic': 'DEBUG',
+    'frege': 'DEBUG',
+    'django': 'INFO',
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'verbose': {
-            'format': '%(asctime)s %(levelname)s [%(module)s.%(funcName)s] %(message)s'
+            'format': LOG_FORMAT,
         },
         'simple': {
             'format': '%(levelname)s %(message)s'
@@ -142,13 +278,12 @@ LOGGING = {
         }
     },
     'handlers': {
-        'file': {
+        'queue': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.path.join(BASE_DIR, '../logs/app.log'),
-            'maxBytes': 1024*1024*100, # 100mb
-            'backupCount': 1, # 1 backups, in addition to current -- this works best since more than 1 splits concurrently into multiple files
-            'formatter': 'verbose'
+            'class': 'frege.logs.QueueSocketHandler',
+            'host': LOG_SERVER[0],
+            'port': LOG_SERVER[1],
+            'fallback': LOG_FALLBACK_FILE,
         },
         'mail_admins': {
             'level': 'ERROR',
@@ -157,7 +292,10 @@ LOGGING = {
             'include_html': True,
         }
     },
-    'loggers': {
+    'loggers': dict({
+        module: {'level': level}
+        for module, level in LOG_LEVELS.iteritems()
+    }, **{
         'django.request': {
             'handlers': ['mail_admins'],
             'level': 'ERROR',
@@ -169,10 +307,10 @@ LOGGING = {
             'propagate': True,
         },
         '': { # general catch-all logger
-            'handlers': ['file'],
+            'handlers': ['queue'],
             'level': 'DEBUG',
         },
-    },
+    }),
 }
 
 # mail settings
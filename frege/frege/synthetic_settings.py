@@ -0,0 +1,22 @@
+"""
+Settings for load and scale tests with synthetic data (see logic/synthetic.py), which is written to a
+database of its own, e.g.:
+
+    python manage.py migrate --settings=frege.synthetic_settings
+    python manage.py loadtest --runserver --settings=frege.synthetic_settings
+"""
+from .settings import *
+
+SYNTHETIC_DATA = True
+
+DATABASES = {
+    'default': dict(DATABASES['default'], NAME=os.path.join(BASE_DIR, '../data/synthetic.sqlite3')),
+    'snapshot': dict(DATABASES['snapshot'], NAME=os.path.join(BASE_DIR, '../data/synthetic-snapshot.sqlite3')),
+}
+
+# nothing is shared with the processes of the real database
+CACHES = {
+    'default': dict(CACHES['default'], LOCATION=os.path.join(BASE_DIR, '../data/synthetic-cache')),
+}
+STAT_BUFFER = dict(STAT_BUFFER, JOURNAL_DIR=os.path.join(BASE_DIR, '../data/synthetic-stats-journal'))
+IDEMPOTENCY = dict(IDEMPOTENCY, LOCK_DIR=os.path.join(BASE_DIR, '../data/synthetic-idempotency'))
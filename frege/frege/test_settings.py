@@ -0,0 +1,40 @@
+"""
+Settings for the tests, used by manage.py test.
+"""
+from .settings import *
+
+# the real cache must be neither used nor filled by the test data
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# tests post faster than the rate limits
+ADMISSION = dict(ADMISSION, ENABLED=False)
+
+# test data is not visible to other threads
+CHAPTER_INDEX_BACKGROUND = False
+
+# the tests must not write to the log files
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'null': {
+            'class': 'logging.NullHandler',
+        },
+    },
+    'loggers': {
+        '': {
+            'handlers': ['null'],
+            'level': 'DEBUG',
+        },
+    },
+}
+
+# stats of the test database must not be journaled with the real ones
+STAT_BUFFER = dict(STAT_BUFFER, JOURNAL_DIR=None)
+
+# synthetic data is written to the test database
+SYNTHETIC_DATA = True
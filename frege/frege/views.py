@@ -4,18 +4,16 @@ from django.contrib.auth.models import User
 from django.contrib.auth.views import login as auth_login
 from django.contrib.auth.views import logout as auth_logout
 from django.core.urlresolvers import reverse
-from django.db import transaction
-from django.db.utils import OperationalError
 from django.forms import ValidationError
 from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render_to_response
 from django.template.context_processors import csrf
 
+from logic.db import write_transaction
 from logic.models import UserProfile
 from . import auth_ldap
 
 import re
-import time
 import logging
 logger = logging.getLogger(__name__)
 
@@ -118,29 +116,23 @@ class UserAuthForm(AuthenticationForm):
                 logger.debug('%s: prompting user for id num', username)
                 raise ValidationError('')
 
-        # DB WRITE
-        while True:
-            try:
-                with transaction.atomic():
-                    user, user_created = User.objects.get_or_create(username=username)
-                    profile = _handle_user_profile(user, group_id, id_num)
-                    logger.debug('%s: user_created=%s, profile=%s', username, user_created, profile)
-                    if not user.check_password(password):
-                        # password has changed
-                        logger.debug('%s: changing user password', username)
-                        user.set_password(password)
-                        user.save()
-                    break
-            except OperationalError, e:
-                logger.error('%s: got %s', username, e)
-                time.sleep(0.2)
-            except Exception, e:
-                logger.error('%s: got unexpected %s (%s)', username, e, type(e))
-                raise
+            # DB WRITE
+            _save_user(username, password, group_id, id_num)
 
         else:
             raise ValidationError('נא להזין שם משתמש וסיסמה')
 
+@write_transaction
+def _save_user(username, password, group_id, id_num):
+    user, user_created = User.objects.get_or_create(username=username)
+    profile = _handle_user_profile(user, group_id, id_num)
+    logger.debug('%s: user_created=%s, profile=%s', username, user_created, profile)
+    if not user.check_password(password):
+        # password has changed
+        logger.debug('%s: changing user password', username)
+        user.set_password(password)
+        user.save()
+
 def _authenticate(username, password):
     try:
         # authenticate user through ldap
@@ -1,18 +1,61 @@
 # -*- coding: utf-8 -*-
 import csv
+import datetime
+import itertools
 
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .db import snapshot_alias
 
 """
 Based on: https://djangosnippets.org/snippets/2369/
 """
 
-# TODO: i don't have to use this general purpose function. can just write my own with all i need
+class Echo(object):
+    """ file-like object that returns what is written to it, for streaming csv rows """
+    def write(self, value):
+        return value
+
+def format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return timezone.localtime(value).strftime('%d/%m/%Y %H:%M')
+    return unicode(value).encode('utf-8', 'replace')
+
+def csv_rows(queryset, fields, header=True, chunk_size=500):
+    """
+    generates csv rows for the queryset, where fields is an ordered dict of column name -> either a
+    field lookup (e.g. 'user__username') that is fetched along with the queryset, or a function taking
+    a list of ids and a database alias and returning a dict of id -> value, which is called per chunk
+    """
+    if header:
+        yield fields.keys()
+    lookups = [f for f in fields.values() if not callable(f)]
+    resolvers = [f for f in fields.values() if callable(f)]
+    rows = queryset.values_list('id', *lookups).iterator()
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        ids = [row[0] for row in chunk]
+        resolved = {f: f(ids, queryset.db) for f in resolvers}
+        for row in chunk:
+            values = dict(zip(lookups, row[1:]))
+            yield [format_value(resolved[f].get(row[0]) if callable(f) else values[f]) for f in fields.values()]
+
+def csv_response(rows, filename):
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' % filename
+    return response
+
 def export_as_csv_action(description="ייצוא נתונים לאקסל",
                          fields=None, header=True):
     """
     This function returns an export csv action
-    'fields' and 'exclude' work like in django ModelForm
+    'fields' is an ordered dict of column name -> field lookup or id resolver (see csv_rows)
     'header' is whether or not to output the column names as the first row
     """
     def export_as_csv(modeladmin, request, queryset):
@@ -21,15 +64,7 @@ def export_as_csv_action(description="ייצוא נתונים לאקסל",
         """
         opts = modeladmin.model._meta
         filename = unicode(opts).replace('.', '_')
-
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=%s.csv' % filename
-
-        writer = csv.writer(response)
-        if header:
-            writer.writerow(fields.keys())
-        for obj in queryset:
-            writer.writerow([unicode(getattr(obj, field)).encode("utf-8","replace") for field in fields.values()])
-        return response
+        # read from the snapshot, to keep the export from holding up database writes
+        return csv_response(csv_rows(queryset.using(snapshot_alias()), fields, header), filename)
     export_as_csv.short_description = description
     return export_as_csv
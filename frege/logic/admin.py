@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
+import json
+
 from collections import OrderedDict
+from decimal import Decimal
 from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models, transaction
+from django.db import models
 from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.forms.widgets import TextInput
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
 from django.utils import timezone
 from django.utils.html import format_html
 
+from . import previews
 from .actions import export_as_csv_action
 from .forms import (
     QuestionForm,
@@ -36,6 +42,7 @@ from .models import (
     OpenAnswer,
     UserProfile,
     GlobalSettings,
+    GRADING_PAGE_SIZE,
 )
 import logging
 logger = logging.getLogger(__name__)
@@ -144,10 +151,21 @@ class ModelQuestionAdmin(TruthTableQuestionAdmin):
 
 class UserAnswerAdmin(admin.ModelAdmin):
     list_display = ['user', 'chapter', 'question_number', 'correct', 'is_followup', 'time']
-    ordering = ['user', 'chapter', 'question_number']
+    list_select_related = ['user', 'chapter', '_cq', '_oq', '_fq', '_tq', '_mq', '_dq']
+    ordering = ['user', 'chapter', '_question_number']
     readonly_fields = ['user', 'chapter', 'question_number', 'correct', 'is_followup', 'time', 'answer', 'submission']
-    actions = [export_as_csv_action(fields=['user', 'question_number', 'correct'])]
+    actions = [export_as_csv_action(fields=OrderedDict([
+        ('user', 'user__username'),
+        ('question', UserAnswer.question_numbers),
+        ('correct', 'correct'),
+    ]))]
  
+    def get_queryset(self, *args, **kwargs):
+        # question_number is a property, order by the number of whichever question the answer has
+        return super(UserAnswerAdmin, self).get_queryset(*args, **kwargs).annotate(_question_number=Coalesce(
+            '_cq__number', '_oq__number', '_fq__number', '_tq__number', '_mq__number', '_dq__number'
+        ))
+
     def has_add_permission(self, request, obj=None):
         return False
 
@@ -159,9 +177,7 @@ class GroupFilter(admin.SimpleListFilter):
     parameter_name = 'group'
 
     def lookups(self, request, model_admin):
-        groups = sorted(list(set(
-            cs.user.userprofile.group for cs in ChapterSubmission.objects.all() if hasattr(cs.user, 'userprofile')
-        )))
+        groups = UserProfile.objects.order_by('group').values_list('group', flat=True).distinct()
         return (
             (g, g) for g in groups
         )
@@ -208,13 +224,14 @@ class AnswerCheckedFilter(admin.SimpleListFilter):
             return queryset.all()
 
 class OpenAnswerAdmin(admin.ModelAdmin):
-    list_display = ['user', 'chapter', 'question', 'grade']
+    list_display = ['user', 'chapter', 'question', 'thumbnail', 'grade']
+    list_select_related = ['user_answer__user', 'question__chapter']
     list_filter = [AnswerGroupFilter, AnswerGroupFilter2, AnswerCheckedFilter, 'question__chapter', 'question__number', 'user_answer__user']
     ordering = ['user_answer__user', 'question__number']
-    readonly_fields = ['user', 'answer_text', 'upload', 'chapter', 'question_text', 'answer_time']
+    readonly_fields = ['user', 'answer_text', 'upload_preview', 'chapter', 'question_text', 'answer_time']
     fieldsets = (
         ('שאלה', {'fields': ('chapter', 'question_text')}),
-        ('תשובה', {'fields': ('user', 'answer_text', 'upload', 'answer_time')}),
+        ('תשובה', {'fields': ('user', 'answer_text', 'upload_preview', 'answer_time')}),
         ('בדיקה', {'fields': ('grade', 'comment')}),
     )
  
@@ -246,10 +263,99 @@ class OpenAnswerAdmin(admin.ModelAdmin):
         return timezone.localtime(obj.user_answer.time).strftime('%d/%m/%Y %H:%M')
     answer_time.short_description = 'זמן תשובה'
 
+    # uploaded images are shown by their previews (see logic/previews.py), linking to the original
+
+    def upload_preview(self, obj):
+        if not obj.upload:
+            return ''
+        url = previews.preview_url(obj.upload.name)
+        if url:
+            return format_html("<a href='{}'><img src='{}' style='max-width: 100%'></a>", obj.upload.url, url)
+        return format_html("<a href='{}'>{}</a>", obj.upload.url, obj.upload.name)
+    upload_preview.short_description = 'קובץ'
+
+    def thumbnail(self, obj):
+        if not obj.upload:
+            return ''
+        url = previews.preview_url(obj.upload.name, previews.THUMBNAIL)
+        if url:
+            return format_html("<a href='{}'><img src='{}'></a>", obj.upload.url, url)
+        return format_html(u"<a href='{}'>קובץ</a>", obj.upload.url)
+    thumbnail.short_description = 'קובץ'
+
     def get_queryset(self, *args, **kwargs):
         # return only answers for submitted submissions
         return OpenAnswer.objects.filter(user_answer__submission__attempt__gt = 0)
 
+    def get_urls(self):
+        urls = super(OpenAnswerAdmin, self).get_urls()
+        return [
+            url(r'^grade/(?P<chnum>[0-9]+\.[0-9]+)/$', self.admin_site.admin_view(self.grading_view), name='openanswer-grading'),
+        ] + urls
+
+    def grading_view(self, request, chnum):
+        """
+        grading of the ungraded answers of a chapter, a page at a time: the page posts the grades and comments of
+        all its answers at once. as json (with ?format=json, or posting a json body of {"grades": [{"id", "grade",
+        "comment"}]}) this is the bulk grading api
+        """
+        chapter = get_object_or_404(Chapter, number=chnum)
+        json_body = request.META.get('CONTENT_TYPE', '').startswith('application/json')
+        as_json = json_body or request.GET.get('format') == 'json'
+        context = {}
+
+        if request.method == 'POST':
+            try:
+                if json_body:
+                    grades = {
+                        int(item['id']): (item.get('grade'), item.get('comment'))
+                        for item in json.loads(request.body, parse_float=Decimal)['grades']
+                    }
+                else:
+                    grades = {
+                        int(key.split('-')[1]): (value, request.POST.get('comment-%s' % key.split('-')[1], ''))
+                        for key, value in request.POST.iteritems() if key.startswith('grade-') and value
+                    }
+                graded = OpenAnswer.grade_many(grades)
+                logger.info('%s: graded %d answers of chapter %s, %d changed', request.user, len(grades), chnum, graded)
+            except (ValueError, KeyError, TypeError, AttributeError), e:
+                logger.warning('%s: bad grading post for chapter %s: %s', request.user, chnum, e)
+                if as_json:
+                    return JsonResponse({'error': 'bad request'}, status=400)
+                context['error'] = 'בקשה לא חוקית'
+            except ValidationError, e:
+                if as_json:
+                    return JsonResponse({'error': e.message}, status=400)
+                context['error'] = e.message
+            else:
+                if as_json:
+                    return JsonResponse({'graded': graded})
+                return HttpResponseRedirect(request.get_full_path())
+
+        after = request.GET.get('after')
+        answers = OpenAnswer.grading_queue(chapter, int(after) if after and after.isdigit() else None)
+        next_after = answers[-1].id if len(answers) == GRADING_PAGE_SIZE else None
+        if as_json:
+            return JsonResponse({
+                'answers': [{
+                    'id': a.id,
+                    'user': a.user_answer.user.username,
+                    'question': a.question.number,
+                    'text': a.text,
+                    'upload': a.upload.url if a.upload else None,
+                    'preview': previews.preview_url(a.upload.name) if a.upload else None,
+                    'comment': a.comment,
+                } for a in answers],
+                'next': next_after,
+            })
+        context.update(dict(
+            self.admin_site.each_context(request),
+            chapter=chapter,
+            answers=[(a, previews.preview_url(a.upload.name) if a.upload else None) for a in answers],
+            next_after=next_after,
+        ))
+        return TemplateResponse(request, 'admin/grade_answers.html', context)
+
 class SubmittedFilter(admin.SimpleListFilter):
     title = 'מצב הגשה'
     parameter_name = 'submitted'
@@ -268,17 +374,18 @@ class SubmittedFilter(admin.SimpleListFilter):
 
 class ChapterSubmissionAdmin(admin.ModelAdmin):
     list_display = ['user', 'chapter', 'percent_correct', 'time', 'attempt']
+    list_select_related = ['user', 'chapter']
     list_filter = [GroupFilter, SubmittedFilter, 'chapter', 'time', 'user']
     ordering = ['chapter', 'user']
     readonly_fields = ['user', 'chapter', 'time', 'attempt']
     exclude = ['ongoing']
     actions = [export_as_csv_action(fields=OrderedDict([
-        ('user', 'user'),
-        ('id', 'user_id_num'),
-        ('group', 'user_group'),
-        ('chapter', 'chapter_number_f'),
-        ('percent', 'percent_correct_f'),
-        ('time', 'localtime_str'),
+        ('user', 'user__username'),
+        ('id', 'user__userprofile__id_num'),
+        ('group', 'user__userprofile__group'),
+        ('chapter', 'chapter__number'),
+        ('percent', ChapterSubmission.grades),
+        ('time', 'time'),
     ]))]
  
     def has_add_permission(self, request, obj=None):
@@ -290,13 +397,19 @@ class ChapterSubmissionAdmin(admin.ModelAdmin):
 #        return ChapterSubmission.objects.filter(id__in=submission_ids)
 
 class ChapterAdmin(admin.ModelAdmin):
-    list_display = ['__unicode__', 'num_questions', 'show_url']
+    list_display = ['__unicode__', 'num_questions', 'show_url', 'grading_url']
     search_fields = ['title']
 
     def show_url(self, chapter):
         return format_html("<a href='chq/%s'>רשימת שאלות פרק %s</a>" % (chapter.number, chapter.display.encode('utf-8')))
     show_url.short_description = 'שאלות'
 
+    def grading_url(self, chapter):
+        if not chapter.is_open():
+            return ''
+        return format_html("<a href='%s'>בדיקת תשובות</a>" % reverse('admin:openanswer-grading', args=(chapter.number,)))
+    grading_url.short_description = 'בדיקה'
+
     def get_urls(self):
         urls = super(ChapterAdmin, self).get_urls()
         return [
@@ -312,27 +425,18 @@ class ChapterAdmin(admin.ModelAdmin):
         if request.method == 'POST':
             logger.info('%s: post chapter %s questions view', request.user, chnum) 
             qdata = request.POST.get('qdata')
-            magic_number = 9999999
             if qdata:
+                numbers = {}
+                for item in qdata.split(','):
+                    if ':' in item:
+                        qnum, new_num = item.split(':')
+                        qnum = int(qnum.replace('q',''))
+                        new_num = int(new_num)
+                        if new_num != qnum:
+                            logger.debug('%s: chapter %s questions: setting %d->%d', request.user, chnum, qnum, new_num)
+                            numbers[qnum] = new_num
                 try:
-                    with transaction.atomic():
-                        questions_by_num = {q.number: q for q in questions}
-                        changed = []
-                        for item in qdata.split(','):
-                            if ':' in item:
-                                qnum, new_num = item.split(':')
-                                qnum = int(qnum.replace('q',''))
-                                new_num = int(new_num)
-                                if new_num != qnum:
-                                    question = questions_by_num[qnum]
-                                    logger.debug('%s: chapter %s questions: setting %d->%d', request.user, chnum, qnum, new_num)
-                                    question.number = new_num + magic_number
-                                    question.save()
-                                    changed.append(question)
-                        for question in changed:
-                            question.number -= magic_number
-                            logger.debug('%s: chapter %s questions: saving %s', request.user, chnum, question)
-                            question.save()
+                    chapter.renumber_questions(numbers, questions)
                 except ValidationError, e:
                     # get the questions anew
                     questions = chapter.questions()
@@ -370,6 +474,7 @@ class UserProfileInline(admin.StackedInline):
 class UserAdmin(BaseUserAdmin):
     inlines = [UserProfileInline]
     list_display = ('username', 'group', 'is_staff')
+    list_select_related = ('userprofile',)
     list_filter = ('groups', 'is_staff', 'userprofile__group')
     #readonly_fields = ('username',) # causes problems when readonly
     fieldsets = (
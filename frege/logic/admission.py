@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control of the write posts (answers and chapter submissions).
+
+At deadlines many students post at once, and all of their write transactions compete for the single sqlite
+writer, so that the retries of locked transactions only add to the load (see db.write_transaction). Instead,
+each process lets at most MAX_CONCURRENT posts in at a time, and the others wait in line, first come first
+served, for up to MAX_WAIT seconds. Posts that cannot get in, or find MAX_QUEUE posts already waiting, are
+rejected as overloaded (503). Each user also has a token bucket, refilled at RATE posts a second up to BURST,
+and posts beyond it are rejected as too many (429).
+Rejections are json responses with the seconds to wait before retrying (also in a Retry-After header), which
+requests.js waits (with jitter) before posting again. Rate limits are per process.
+"""
+import collections
+import functools
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MAX_CONCURRENT': 4,
+    'MAX_QUEUE': 50,
+    'MAX_WAIT': 5, # seconds
+    'RATE': 1., # posts a second per user
+    'BURST': 5,
+    'RETRY_AFTER': 2, # seconds, for overloaded rejections
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'ADMISSION', {}))
+
+class FairSemaphore(object):
+    """ a semaphore whose waiters get in by their order of arrival, with a bounded number of waiters """
+
+    def __init__(self, value, max_waiting):
+        self.value = value
+        self.max_waiting = max_waiting
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = collections.deque()
+
+    def acquire(self, timeout):
+        """ returns True once acquired, or False if there are too many waiters or timeout passes first """
+        with self.lock:
+            if self.active < self.value and not self.waiting:
+                self.active += 1
+                return True
+            if len(self.waiting) >= self.max_waiting:
+                return False
+            event = threading.Event()
+            self.waiting.append(event)
+        event.wait(timeout)
+        with self.lock:
+            if event.is_set():
+                # handed over by release
+                return True
+            self.waiting.remove(event)
+            return False
+
+    def release(self):
+        with self.lock:
+            if self.waiting:
+                # hand the slot over to the first waiter, active stays the same
+                self.waiting.popleft().set()
+            else:
+                self.active -= 1
+
+class TokenBuckets(object):
+    """ per key token buckets, refilled at rate tokens a second up to burst """
+
+    PRUNE_SIZE = 1000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, now=None):
+        """ takes a token of the key, returns 0 if there was one, or else the seconds until there is """
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > self.PRUNE_SIZE:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # full buckets are the same as no buckets
+        full_after = self.burst / self.rate
+        self.buckets = {key: (tokens, last) for key, (tokens, last) in self.buckets.iteritems() if now - last < full_after}
+
+class AdmissionController(object):
+
+    STATS = ['admitted', 'queued', 'rate_limited', 'overloaded']
+
+    def __init__(self, max_concurrent, max_queue, max_wait, rate, burst, retry_after):
+        self.semaphore = FairSemaphore(max_concurrent, max_queue)
+        self.buckets = TokenBuckets(rate, burst)
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.STATS, 0)
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['active'], stats['waiting'] = self.semaphore.active, len(self.semaphore.waiting)
+        return stats
+
+    def admit(self, func, view, request, *args, **kwargs):
+        """ calls the view function once admitted, returns its response, or the rejection response """
+        wait = self.buckets.take(request.user.id)
+        if wait:
+            self._count('rate_limited')
+            logger.warning('%s: rate limited, retry in %.1fs', request.user, wait)
+            return rejection(429, wait, 'נשלחו יותר מדי בקשות, אנא המתינו מספר שניות')
+        start = time.time()
+        if not self.semaphore.acquire(self.max_wait):
+            self._count('overloaded')
+            logger.warning('%s: not admitted after %.1fs, %d waiting', request.user, time.time() - start, len(self.semaphore.waiting))
+            return rejection(503, self.retry_after, 'השרת עמוס כרגע, אנא נסו שוב בעוד מספר שניות')
+        waited = time.time() - start
+        self._count('admitted')
+        if waited > 0.01:
+            self._count('queued')
+            logger.debug('%s: admitted after %.2fs', request.user, waited)
+        try:
+            return func(view, request, *args, **kwargs)
+        finally:
+            self.semaphore.release()
+
+def rejection(status, retry, msg):
+    retry = int(math.ceil(retry))
+    response = JsonResponse({'retry': retry, 'msg': msg}, status=status)
+    response['Retry-After'] = retry
+    return response
+
+def admitted(func):
+    """ decorator for a view post method, letting it in by admission control (see controller) """
+
+    @functools.wraps(func)
+    def wrapper(view, request, *args, **kwargs):
+        if controller is None or not request.user.is_authenticated():
+            return func(view, request, *args, **kwargs)
+        return controller.admit(func, view, request, *args, **kwargs)
+
+    return wrapper
+
+def _create_controller():
+    c = conf()
+    if not c['ENABLED']:
+        return None
+    return AdmissionController(c['MAX_CONCURRENT'], c['MAX_QUEUE'], c['MAX_WAIT'], c['RATE'], c['BURST'], c['RETRY_AFTER'])
+
+controller = _create_controller()
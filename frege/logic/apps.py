@@ -7,3 +7,9 @@ from django.apps import AppConfig
 class LogicConfig(AppConfig):
     name = 'logic'
     verbose_name = 'לוגיקה'
+
+    def ready(self):
+        # set up database connections
+        from . import db
+        # invalidate cached answer versions when answers change
+        from . import refresh
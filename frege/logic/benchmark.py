@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+View benchmarks (see the benchmark command).
+
+Each view is requested through the test client against a generated semester (see synthetic.py),
+measuring the exact number of sql queries (on all database connections) and the median latency.
+The results are compared to the committed baseline, benchmarks/baseline.json: any additional
+query is a regression, and so is a median latency of more than LATENCY_TOLERANCE times the
+baseline (plus LATENCY_SLACK, since very fast views are noisy).
+"""
+import json
+import os
+import time
+
+from collections import OrderedDict
+
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import synthetic
+from .models import ChoiceQuestion, DeductionQuestion, FormulationQuestion, ModelQuestion, OpenQuestion, TruthTableQuestion
+
+import logging
+logger = logging.getLogger(__name__)
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmarks', 'baseline.json')
+DATASET = OrderedDict([('users', 200), ('chapters', 2), ('seed', 0)])
+LATENCY_TOLERANCE = 1.5
+LATENCY_SLACK = 10 # ms
+USERNAME = synthetic.USER_PREFIX + 'bench'
+# the benchmark uses a local cache, so that the real cache is neither used nor filled by the test database
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}}
+
+QUESTION_TYPES = OrderedDict([
+    (ChoiceQuestion, 'choice'),
+    (FormulationQuestion, 'formulation'),
+    (TruthTableQuestion, 'truth-table'),
+    (ModelQuestion, 'model'),
+    (DeductionQuestion, 'deduction'),
+    (OpenQuestion, 'open'),
+])
+
+class QueryCount(object):
+    """ counts the queries on all database connections """
+
+    def __enter__(self):
+        self.contexts = [CaptureQueriesContext(conn) for conn in connections.all()]
+        for context in self.contexts:
+            context.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        for context in self.contexts:
+            context.__exit__(*exc_info)
+
+    @property
+    def count(self):
+        return sum(len(context) for context in self.contexts)
+
+def prepare(users, chapters, random_seed):
+    """ generates the semester and the user the views are requested as """
+    synthetic.generate_semester(users, chapters, random_seed)
+    synthetic.seed_staff(USERNAME)
+
+def cases():
+    """
+    returns the requests to benchmark, in order, as (name, method, path, data, anonymous).
+    the question pages are requested after they are answered, and the summary after submitting
+    """
+    chapter = synthetic.chapters()[0]
+    open_chapter = chapter.parts().exclude(id=chapter.id).first()
+    questions = {type(q): q for q in chapter.questions() + open_chapter.questions()}
+    question_url = lambda q: reverse('logic:question', args=(q.chapter.chnum, q.number))
+    formulation = questions[FormulationQuestion]
+    followup_args = (chapter.chnum, formulation.number)
+    summary_url = reverse('logic:chapter-summary', args=(chapter.chnum,))
+
+    cases = [('login', 'get', reverse('login'), None, True)]
+    for cls, name in QUESTION_TYPES.iteritems():
+        cases.append(('question/%s post' % name, 'post', question_url(questions[cls]), synthetic.answer(questions[cls]), False))
+    cases += [
+        ('followup post', 'post', reverse('logic:followup', args=followup_args), synthetic.followup_answer(synthetic.FORMULATION_CORRECT), False),
+        ('chapter-summary post', 'post', summary_url, None, False),
+    ]
+    for cls, name in QUESTION_TYPES.iteritems():
+        cases.append(('question/%s' % name, 'get', question_url(questions[cls]), None, False))
+    cases += [
+        ('followup', 'get', reverse('logic:followup', args=followup_args), None, False),
+        ('followup-refresh', 'get', reverse('logic:followup-refresh', args=followup_args), {'refresh': synthetic.FORMULATION_CORRECT}, False),
+        ('chapter', 'get', reverse('logic:chapter', args=(chapter.chnum,)), None, False),
+        ('chapter-summary', 'get', summary_url, None, False),
+        ('chapter-parts', 'get', reverse('logic:chapter-parts', args=(chapter.chnum,)), None, False),
+        ('index', 'get', reverse('logic:index'), None, False),
+        ('user', 'get', reverse('logic:user'), None, False),
+        ('stats', 'get', reverse('logic:stats'), None, False),
+        ('chapter-stats', 'get', reverse('logic:chapter-stats', args=(chapter.chnum,)), None, False),
+        ('chapter-maintenance', 'get', reverse('logic:chapter-maintenance'), None, False),
+        ('help', 'get', reverse('logic:help'), None, False),
+        ('about', 'get', reverse('logic:about'), None, False),
+        ('perf', 'get', reverse('logic:perf'), None, False),
+    ]
+    return cases
+
+def run(repeat=5):
+    """
+    requests each case once to warm up and then repeat times, returns the results per case name:
+    the status, the number of queries (the most of any repetition) and the median latency in ms
+    """
+    user = synthetic.users().get(username=USERNAME)
+    client = Client()
+    client.force_login(user)
+    anonymous = Client()
+    results = OrderedDict()
+    for name, method, path, data, is_anonymous in cases():
+        request = getattr(anonymous if is_anonymous else client, method)
+        request(path, data or {})
+        times = []
+        queries = []
+        for _ in range(repeat):
+            with QueryCount() as count:
+                start = time.time()
+                response = request(path, data or {})
+                times.append((time.time() - start) * 1000)
+            queries.append(count.count)
+        times.sort()
+        results[name] = {
+            'status': response.status_code,
+            'queries': max(queries),
+            'median_ms': round(times[len(times) // 2], 1),
+        }
+        logger.debug('benchmark %s: %s', name, results[name])
+    return results
+
+def load_baseline(path=BASELINE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+def save_baseline(dataset, results, path=BASELINE):
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([
+            ('dataset', dataset),
+            ('views', OrderedDict(
+                (name, OrderedDict([('queries', r['queries']), ('median_ms', r['median_ms'])]))
+                for name, r in results.iteritems()
+            )),
+        ]), f, indent=2, separators=(',', ': '))
+        f.write('\n')
+
+def compare(results, baseline, tolerance=LATENCY_TOLERANCE, slack=LATENCY_SLACK):
+    """ returns a list of (case name, problem) for failed requests and regressions from the baseline views """
+    problems = []
+    for name, r in results.iteritems():
+        if r['status'] >= 400:
+            problems.append((name, 'status %d' % r['status']))
+        base = baseline.get(name)
+        if not base:
+            continue
+        if r['queries'] > base['queries']:
+            problems.append((name, '%d queries, baseline %d' % (r['queries'], base['queries'])))
+        if r['median_ms'] > base['median_ms'] * tolerance + slack:
+            problems.append((name, '%.1fms, baseline %.1fms' % (r['median_ms'], base['median_ms'])))
+    return problems
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite connection setup and write contention handling.
+
+Connections are set up with the pragmas in settings.SQLITE_PRAGMAS (WAL journaling by default),
+and database writes go through write_transaction, which retries a locked transaction a bounded
+number of times with jittered exponential backoff, optionally letting only one writer per process
+at a time into the database (settings.SQLITE_SINGLE_WRITER).
+
+Heavy reads (stats and exports) can go to a read-only snapshot of the database, which is copied
+periodically by the snapshot_db command (see snapshot_alias).
+"""
+import datetime
+import functools
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.utils import OperationalError
+from django.dispatch import receiver
+from django.utils import timezone
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+]
+
+DEFAULT_SNAPSHOT = {
+    'MAX_AGE': 600, # seconds, older snapshots are not used
+    'INTERVAL': 120, # seconds between snapshots when looping
+}
+
+DEFAULT_RETRY = {
+    'ATTEMPTS': 6,
+    'BASE_DELAY': 0.05, # seconds
+    'MAX_DELAY': 1.,
+}
+
+@receiver(connection_created)
+def setup_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    if connection.settings_dict.get('READ_ONLY'):
+        pragmas = [('query_only', 'ON')]
+    else:
+        pragmas = getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+    for pragma, value in pragmas:
+        cursor.execute('PRAGMA %s=%s' % (pragma, value))
+    cursor.close()
+
+##############################################################################################
+# counters
+
+class Counters(object):
+    """ process-wide counters, and per-thread counters that can be reset (e.g. per request) """
+
+    NAMES = ['transactions', 'lock_waits', 'retries', 'failures', 'wait_time', 'queue_time']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = dict.fromkeys(self.NAMES, 0)
+        self.local = threading.local()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.totals[name] += value
+        current = self.current()
+        current[name] += value
+
+    def current(self):
+        if not hasattr(self.local, 'counts'):
+            self.reset_current()
+        return self.local.counts
+
+    def reset_current(self):
+        self.local.counts = dict.fromkeys(self.NAMES, 0)
+
+    def get(self):
+        with self.lock:
+            return dict(self.totals)
+
+counters = Counters()
+
+##############################################################################################
+# write transactions
+
+writer_lock = threading.RLock()
+
+def _is_lock_error(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+def _backoff(attempt, base_delay, max_delay):
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class _writer(object):
+    """ lets a single writer per process in when single-writer mode is on """
+
+    def __enter__(self):
+        if getattr(settings, 'SQLITE_SINGLE_WRITER', False):
+            start = time.time()
+            writer_lock.acquire()
+            counters.add('queue_time', time.time() - start)
+            self.locked = True
+        else:
+            self.locked = False
+
+    def __exit__(self, *args):
+        if self.locked:
+            writer_lock.release()
+
+def write_transaction(func=None, attempts=None, base_delay=None, max_delay=None):
+    """
+    decorator for running a function in a database write transaction, retrying while the database
+    is locked. can be used as @write_transaction or @write_transaction(attempts=...)
+    """
+    if func is None:
+        return lambda f: write_transaction(f, attempts, base_delay, max_delay)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            # a transaction cannot be retried from within another one, let the outer one handle it
+            return func(*args, **kwargs)
+        conf = dict(DEFAULT_RETRY, **getattr(settings, 'SQLITE_RETRY', {}))
+        max_attempts = attempts or conf['ATTEMPTS']
+        with _writer():
+            attempt = 0
+            while True:
+                try:
+                    with transaction.atomic():
+                        result = func(*args, **kwargs)
+                    counters.add('transactions')
+                    return result
+                except OperationalError, e:
+                    if not _is_lock_error(e):
+                        raise
+                    counters.add('lock_waits')
+                    attempt += 1
+                    if attempt >= max_attempts:
+                        counters.add('failures')
+                        logger.error('%s: database locked, giving up after %d attempts: %s', func.__name__, attempt, e)
+                        raise
+                    delay = _backoff(attempt - 1, base_delay or conf['BASE_DELAY'], max_delay or conf['MAX_DELAY'])
+                    logger.warning('%s: database locked, retrying in %.2fs (attempt %d): %s', func.__name__, delay, attempt, e)
+                    counters.add('retries')
+                    counters.add('wait_time', delay)
+                    time.sleep(delay)
+    return wrapper
+
+##############################################################################################
+# snapshot
+
+SNAPSHOT_DB = 'snapshot'
+
+class SnapshotRouter(object):
+    """ the snapshot database is only read from explicitly (see snapshot_alias), and is never written to or migrated """
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != SNAPSHOT_DB
+
+def snapshot_conf():
+    return dict(DEFAULT_SNAPSHOT, **getattr(settings, 'SNAPSHOT', {}))
+
+def snapshot_path():
+    if SNAPSHOT_DB not in connections.databases:
+        return None
+    return connections[SNAPSHOT_DB].settings_dict['NAME']
+
+def snapshot_age(path=None):
+    """ returns the snapshot age in seconds, or None if there is no snapshot """
+    path = path or snapshot_path()
+    if not path or not os.path.isfile(path):
+        return None
+    return time.time() - os.path.getmtime(path)
+
+def snapshot_time():
+    age = snapshot_age()
+    if age is None:
+        return None
+    return timezone.now() - datetime.timedelta(seconds=age)
+
+def snapshot_alias():
+    """ returns the database to use for heavy reads: the snapshot if it is fresh enough, otherwise the default database """
+    age = snapshot_age()
+    if age is None:
+        return DEFAULT_DB_ALIAS
+    if age > snapshot_conf()['MAX_AGE']:
+        logger.warning('snapshot is stale (%ds old), reading from the default database', age)
+        return DEFAULT_DB_ALIAS
+    return SNAPSHOT_DB
+
+VACUUM_INTO_VERSION = (3, 27, 0) # the first sqlite version with VACUUM INTO
+
+def take_snapshot(source=None, dest=None):
+    """
+    copies the default database into the snapshot file: the copy is written to a temporary file
+    which then replaces the snapshot, so that readers never see a partial snapshot.
+    the copy is made by VACUUM INTO, which reads the database in a single read transaction without blocking the
+    writer. the online backup api is not available to python 2 (its sqlite3 module has it from python 3.7), so
+    with an older sqlite the database files are copied while the writer is held off (see _locked_copy)
+    """
+    source = source or connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+    dest = dest or snapshot_path()
+    tmp = '%s.tmp' % dest
+    for path in (tmp, '%s-wal' % tmp):
+        if os.path.exists(path):
+            os.remove(path)
+    start = time.time()
+    if sqlite3.sqlite_version_info >= VACUUM_INTO_VERSION:
+        _vacuum_into(source, tmp)
+    else:
+        _locked_copy(source, tmp)
+    os.rename(tmp, dest)
+    logger.info('took snapshot of %s to %s in %.2fs', source, dest, time.time() - start)
+
+def _vacuum_into(source, dest):
+    conn = sqlite3.connect(source, timeout=30)
+    try:
+        conn.execute('VACUUM INTO ?', (dest,))
+    finally:
+        conn.close()
+
+def _locked_copy(source, dest):
+    """
+    copies the database file and its wal while holding the write lock, so that writers wait until the files
+    are copied (readers do not), and then applies the copied wal to the copy
+    """
+    conn = sqlite3.connect(source, timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            shutil.copyfile(source, dest)
+            if os.path.exists('%s-wal' % source):
+                shutil.copyfile('%s-wal' % source, '%s-wal' % dest)
+        finally:
+            conn.execute('ROLLBACK')
+    finally:
+        conn.close()
+    conn = sqlite3.connect(dest)
+    try:
+        conn.execute('PRAGMA journal_mode=DELETE') # checkpoints the wal into the copy, and removes it
+    finally:
+        conn.close()
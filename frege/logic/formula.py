@@ -6,6 +6,8 @@ Code for handling classical propositional logic formulas.
 from string import ascii_lowercase
 import re
 
+from .perf import timed
+
 # Connectives
 NEG = '~'
 CON = u'·'
@@ -66,6 +68,7 @@ ARGUMENT_OPTIONS = [Valid, Invalid]
 
 class Formula(object):
 
+    @timed('formula')
     def __init__(self, string):
         string = string.strip()
         self._analyze(string)
@@ -248,6 +251,7 @@ class Formula(object):
         return FORMULA_OPTIONS
 
     @property
+    @timed('formula')
     def correct_option(self):
         tt = TruthTable(self)
         options = set([Tautology, Contradiction])
@@ -285,6 +289,7 @@ class Formula(object):
     def is_commutative(self):
         return self.con in COMMUTATIVE
 
+    @timed('formula')
     def eqv(self, other, strict=False):
         if strict:
             return self.combine(EQV, other).is_tautology
@@ -481,6 +486,7 @@ class PredicateFormula(Formula):
             p2 = PredicateFormula(self.sf2.instantiate_free(const, var)) if self.sf2 else None
             return p1.combine(self.con, p2).literal
  
+    @timed('formula')
     def eqv(self, other):
         if self == other:
             return True
@@ -578,6 +584,7 @@ class TruthTable(object):
         return len(self.values)
 
     @property
+    @timed('formula')
     def result(self):
         return [
             self.formula.assign({
@@ -609,6 +616,7 @@ class MultiTruthTable(TruthTable):
         self.values = self._values(self.variables)
 
     @property
+    @timed('formula')
     def result(self):
         result = []
         for f in self.formulas:
@@ -622,6 +630,7 @@ class FormulaSet(object):
 
     formula_cls = Formula
 
+    @timed('formula')
     def __init__(self, string = None, formulas = None):
         if not string and not formulas:
             raise ValueError('formula set cannot be empty')
@@ -693,6 +702,7 @@ class Argument(object):
     formula_cls = Formula
     formula_set_cls = FormulaSet
 
+    @timed('formula')
     def __init__(self, string = None, conclusion = None, premises = None):
         if string:
             self._analyze(string)
@@ -766,6 +776,7 @@ class PredicateArgument(Argument):
 def formal_type(string):
     return type(formalize(string))
 
+@timed('formula')
 def formalize(string):
     """
     takes a string representing a formula, a formula set, or an argument
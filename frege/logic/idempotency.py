@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Idempotent posts, for answers that are posted more than once (double clicks, or retries after an error).
+
+The client sends a key in the X-Idempotency-Key header, the same key for a repeated post (see requests.js).
+The first post of a key claims it by locking a file of the key in LOCK_DIR (with flock, so that only one post
+holds it even if several arrive at the same moment, whichever cache backend is used), and once handled, stores
+its response in the cache for TIMEOUT seconds and releases the claim, removing the file. A repeated post is
+answered with the stored response, without handling it again (and so without a write transaction). A repeated
+post that arrives while the first is being handled waits up to WAIT seconds for its response.
+Claims take no database writes, and the lock of a process that dies while handling its post is released with it,
+so that the next post of the key claims it at once. The files left by such processes are removed by the
+clear_idempotency_locks command (e.g. from cron).
+Only successful responses are stored: after an error the claim is released, and a retry is handled as usual.
+Keys are per user and url, and posts without a key are handled as usual.
+"""
+import errno
+import fcntl
+import functools
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'CACHE': 'default',
+    'LOCK_DIR': os.path.join(tempfile.gettempdir(), 'frege-idempotency'),
+    'TIMEOUT': 300, # seconds
+    'WAIT': 5, # seconds
+    'POLL_INTERVAL': 0.05, # seconds
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'IDEMPOTENCY', {}))
+
+HEADER = 'HTTP_X_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 64
+
+def cache_key(request, key):
+    return 'idempotency:%s:%s:%s' % (request.user.id, request.path, key)
+
+def lock_path(ckey):
+    return os.path.join(conf()['LOCK_DIR'], hashlib.sha1(ckey.encode('utf-8')).hexdigest())
+
+def _lock(path):
+    """ locks the file at path, returns its open descriptor, or None if it is locked by another post """
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0644)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        try:
+            locked = os.fstat(fd).st_ino == os.stat(path).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            locked = False
+        if locked:
+            return fd
+        # released and removed by its holder since it was opened, lock the file now at path
+        os.close(fd)
+
+def _claim(ckey):
+    """ claims the key for handling its post, returns the claim to release, or None if another post holds it """
+    path = lock_path(ckey)
+    fd = _lock(path)
+    return None if fd is None else (path, fd)
+
+def _release(claim):
+    path, fd = claim
+    os.remove(path) # while locked, so that no other post locks the removed file
+    os.close(fd)
+
+def clear_locks():
+    """ removes the files of claims left by processes that died while handling their posts, returns their number """
+    lock_dir = conf()['LOCK_DIR']
+    if not os.path.isdir(lock_dir):
+        return 0
+    cleared = 0
+    for name in os.listdir(lock_dir):
+        path = os.path.join(lock_dir, name)
+        fd = _lock(path)
+        if fd is not None:
+            _release((path, fd))
+            cleared += 1
+    return cleared
+
+def _replay(request, key, stored):
+    status, content_type, content = stored
+    logger.info('%s: repeated post of %s with key %s, answering from cache', request.user, request.path, key)
+    response = HttpResponse(content, status=status, content_type=content_type)
+    response['X-Idempotent-Replay'] = 'true'
+    return response
+
+def idempotent(func):
+    """ decorator for a view post method, answering repeated posts of the same key from the cache """
+
+    @functools.wraps(func)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.META.get(HEADER)
+        if not key or len(key) > MAX_KEY_LENGTH or not request.user.is_authenticated():
+            return func(view, request, *args, **kwargs)
+        c = conf()
+        cache = caches[c['CACHE']]
+        ckey = cache_key(request, key)
+
+        deadline = time.time() + c['WAIT']
+        while True:
+            stored = cache.get(ckey)
+            if stored is not None:
+                return _replay(request, key, stored)
+            claim = _claim(ckey)
+            if claim:
+                break
+            if time.time() >= deadline:
+                logger.warning('%s: repeated post of %s with key %s still pending after %ss', request.user, request.path, key, c['WAIT'])
+                return JsonResponse({'msg': 'התשובה עדיין נשמרת, אנא נסו שוב בעוד מספר שניות'})
+            time.sleep(c['POLL_INTERVAL'])
+
+        try:
+            # the previous post of the key may have stored its response since it was looked up
+            stored = cache.get(ckey)
+            if stored is not None:
+                return _replay(request, key, stored)
+            response = func(view, request, *args, **kwargs)
+            if 200 <= response.status_code < 300 and not response.streaming:
+                cache.set(ckey, (response.status_code, response['Content-Type'], response.content), c['TIMEOUT'])
+            return response
+        finally:
+            _release(claim)
+
+    return wrapper
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Load test harness, simulating students answering chapters concurrently (see the loadtest command).
+
+Each simulated student is a thread with its own http session that logs in and then, for each
+synthetic chapter (see synthetic.py), views and answers every question, answers the followups
+while polling for refresh like the followup page does, and submits the chapter.
+Latency and errors are recorded per endpoint on the client side, and the database lock retries
+are read from the server's performance stats (see perf.py) before and after the run.
+"""
+import cookielib
+import httplib
+import json
+import math
+import random
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from collections import OrderedDict
+
+from django.core.urlresolvers import reverse
+
+from . import synthetic
+
+import logging
+logger = logging.getLogger(__name__)
+
+STAFF_USERNAME = synthetic.USER_PREFIX + 'staff'
+REJECTED_STATUSES = (429, 503)
+MAX_REJECTED_RETRIES = 3
+
+class Stats(object):
+    """ client side latency and errors per endpoint """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = OrderedDict()
+
+    def record(self, endpoint, elapsed, error):
+        with self.lock:
+            e = self.endpoints.setdefault(endpoint, {'times': [], 'errors': 0})
+            e['times'].append(elapsed)
+            e['errors'] += int(error)
+
+    def report(self, duration):
+        """ returns the count, error rate, throughput (per second) and latency percentiles (ms) per endpoint """
+        with self.lock:
+            return OrderedDict(
+                (endpoint, {
+                    'count': len(e['times']),
+                    'errors': e['errors'],
+                    'error_rate': float(e['errors']) / len(e['times']),
+                    'throughput': len(e['times']) / duration if duration else 0,
+                    'p50': percentile(e['times'], 50) * 1000,
+                    'p95': percentile(e['times'], 95) * 1000,
+                    'p99': percentile(e['times'], 99) * 1000,
+                })
+                for endpoint, e in self.endpoints.iteritems()
+            )
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(pct / 100. * len(values))) - 1)]
+
+def _encode(data):
+    return {
+        k: [unicode(i).encode('utf-8') for i in v] if isinstance(v, list) else unicode(v).encode('utf-8')
+        for k, v in data.iteritems()
+    }
+
+class Session(object):
+    """ an http session with cookies, sending the csrf token with posts like the site's scripts """
+
+    def __init__(self, base_url, stats, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookies))
+
+    def cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+
+    def get(self, endpoint, path, params=None):
+        if params:
+            path = '%s?%s' % (path, urllib.urlencode(_encode(params)))
+        return self._request('GET ' + endpoint, path)
+
+    def post(self, endpoint, path, data=None):
+        return self._request('POST ' + endpoint, path, urllib.urlencode(_encode(data or {}), doseq=True))
+
+    def _request(self, endpoint, path, body=None, attempt=0):
+        request = urllib2.Request(self.base_url + path, body)
+        if body is not None:
+            request.add_header('X-CSRFToken', self.cookie('csrftoken') or '')
+            request.add_header('X-Requested-With', 'XMLHttpRequest')
+        content = None
+        error = False
+        start = time.time()
+        try:
+            content = self.opener.open(request, timeout=self.timeout).read()
+        except urllib2.HTTPError, e:
+            if e.code in REJECTED_STATUSES and attempt < MAX_REJECTED_RETRIES:
+                # rejected by admission control, wait and retry like requests.js
+                self.stats.record('rejected ' + endpoint, time.time() - start, False)
+                time.sleep(float(e.headers.get('Retry-After') or 1) * random.uniform(1, 2))
+                return self._request(endpoint, path, body, attempt + 1)
+            logger.debug('%s %s: http error %s', endpoint, path, e.code)
+            error = True
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            logger.debug('%s %s: %s', endpoint, path, e)
+            error = True
+        self.stats.record(endpoint, time.time() - start, error)
+        return content
+
+    def login(self, username, password):
+        path = reverse('login')
+        self.get('login', path)
+        self._request('POST login', path, urllib.urlencode({
+            'username': username,
+            'password': password,
+            'next': reverse('logic:index'),
+            'csrfmiddlewaretoken': self.cookie('csrftoken') or '',
+        }))
+        if not self.cookie('sessionid'):
+            self.stats.record('login failed', 0, True)
+            return False
+        return True
+
+class QuestionPlan(object):
+
+    def __init__(self, question):
+        chnum = question.chapter.chnum
+        self.url = reverse('logic:question', args=(chnum, question.number))
+        self.answers = {correct: synthetic.answer(question, correct) for correct in (True, False)}
+        self.followup_url = self.refresh_url = None
+        if question.has_followup():
+            self.followup_url = reverse('logic:followup', args=(chnum, question.number))
+            self.refresh_url = reverse('logic:followup-refresh', args=(chnum, question.number))
+
+class LoadTest(object):
+    """
+    users: number of concurrent students, iterations: times each student goes through all chapters,
+    think: max seconds between requests, polls: followup refresh polls per followup,
+    ramp: seconds over which the students start, correct_rate: probability of a correct answer
+    """
+
+    def __init__(self, base_url, users=10, chapters=2, iterations=1, think=0., polls=2, ramp=0., correct_rate=0.7):
+        self.base_url = base_url
+        self.users = users
+        self.chapters = chapters
+        self.iterations = iterations
+        self.think = think
+        self.polls = polls
+        self.ramp = ramp
+        self.correct_rate = correct_rate
+        self.stats = Stats()
+
+    def prepare(self):
+        """ seeds the synthetic data and plans the answers, returns the plan per chapter """
+        synthetic.seed(self.users, self.chapters)
+        synthetic.seed_staff(STAFF_USERNAME)
+        self.plan = [
+            (
+                reverse('logic:chapter-summary', args=(chapter.chnum,)),
+                [QuestionPlan(q) for q in sorted(chapter.questions(), key=lambda q: q.number)],
+            )
+            for chapter in synthetic.chapters(self.chapters)
+        ]
+        return self.plan
+
+    def run(self):
+        """ runs the load test, returns the client stats per endpoint and the server lock retries per url name """
+        self.prepare()
+        before = self._server_stats()
+        threads = [
+            threading.Thread(target=self._run_student, args=(synthetic.username(i), i * self.ramp / self.users))
+            for i in range(self.users)
+        ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+        after = self._server_stats()
+        return {
+            'duration': duration,
+            'endpoints': self.stats.report(duration),
+            'lock_retries': _retries_diff(before, after),
+        }
+
+    def _pause(self):
+        if self.think:
+            time.sleep(random.uniform(0, self.think))
+
+    def _run_student(self, username, delay):
+        time.sleep(delay)
+        session = Session(self.base_url, self.stats)
+        if not session.login(username, synthetic.PASSWORD):
+            logger.warning('%s: login failed', username)
+            return
+        for _ in range(self.iterations):
+            for summary_url, questions in self.plan:
+                for q in questions:
+                    session.get('logic:question', q.url)
+                    self._pause()
+                    correct = random.random() < self.correct_rate
+                    session.post('logic:question', q.url, q.answers[correct])
+                    if q.followup_url:
+                        self._answer_followup(session, q, q.answers[correct]['formulation'])
+                    self._pause()
+                session.post('logic:chapter-summary', summary_url)
+                session.get('logic:chapter-summary', summary_url)
+                self._pause()
+
+    def _answer_followup(self, session, q, formulation):
+        session.get('logic:followup', q.followup_url)
+        for _ in range(self.polls):
+            self._pause()
+            session.get('logic:followup-refresh', q.refresh_url, {'refresh': formulation})
+        correct = random.random() < self.correct_rate
+        session.post('logic:followup', q.followup_url, synthetic.followup_answer(formulation, correct))
+
+    def _server_stats(self):
+        """ the server performance stats, or None if they are not available """
+        session = Session(self.base_url, Stats())
+        if not session.login(STAFF_USERNAME, synthetic.PASSWORD):
+            return None
+        content = session.get('logic:perf', reverse('logic:perf'))
+        return json.loads(content) if content else None
+
+def _retries(stats):
+    retries = {
+        url_name: int(round(h['lock_retries']['avg'] * h['lock_retries']['count']))
+        for url_name, h in stats['urls'].iteritems()
+    }
+    retries['total'] = stats['db']['retries']
+    retries['failures'] = stats['db']['failures']
+    return retries
+
+def _retries_diff(before, after):
+    """ returns the lock retries per url name during the run (None if the server stats are not available) """
+    if not before or not after:
+        return None
+    before, after = _retries(before), _retries(after)
+    return OrderedDict(
+        (name, count - before.get(name, 0))
+        for name, count in sorted(after.iteritems())
+    )
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from logic import admission, benchmark
+from logic.stat_buffer import stat_buffer
+
+class Command(BaseCommand):
+    help = 'Benchmarks the query counts and latency of the views on a generated semester in a test database, and compares them to the baseline'
+    requires_system_checks = False # as for tests, the checks import the urls, which need the database
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='measured requests per view')
+        parser.add_argument('--update', action='store_true', default=False, help='write the results as the new baseline')
+        parser.add_argument('--baseline', default=benchmark.BASELINE)
+        parser.add_argument('--tolerance', type=float, default=benchmark.LATENCY_TOLERANCE, help='latency regression factor')
+
+    def handle(self, *args, **options):
+        baseline = benchmark.load_baseline(options['baseline'])
+        dataset = baseline['dataset'] if baseline and not options['update'] else benchmark.DATASET
+        with override_settings(CACHES=benchmark.CACHES, SYNTHETIC_DATA=True): # in a test database
+            results = self.run(dataset, options['repeat'])
+
+        views = baseline['views'] if baseline else {}
+        print '%-28s %6s %15s %15s' % ('view', 'status', 'queries (base)', 'median ms (base)')
+        for name, r in results.iteritems():
+            base = views.get(name, {})
+            print '%-28s %6d %7d (%5s) %8.1f (%6s)' % (
+                name, r['status'], r['queries'], base.get('queries', '-'), r['median_ms'], base.get('median_ms', '-'),
+            )
+
+        if options['update']:
+            benchmark.save_baseline(dataset, results, options['baseline'])
+            print 'baseline written to %s' % options['baseline']
+            return
+        problems = benchmark.compare(results, views, options['tolerance'])
+        for name, problem in problems:
+            print 'REGRESSION %s: %s' % (name, problem)
+        if problems:
+            raise CommandError('%d regressions' % len(problems))
+        print 'no regressions'
+
+    def run(self, dataset, repeat):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        stat_buffer.journal_dir = None # stats of the test database must not be replayed into the real one
+        admission.controller = None # the views are requested repeatedly, beyond the rate limits
+        try:
+            benchmark.prepare(dataset['users'], dataset['chapters'], dataset['seed'])
+            results = benchmark.run(repeat)
+            stat_buffer.flush()
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        return results
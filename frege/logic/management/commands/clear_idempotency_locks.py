@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+
+from logic import idempotency
+
+class Command(BaseCommand):
+    help = 'Removes the idempotency key locks left by processes that died while handling a post (e.g. from cron)'
+
+    def handle(self, *args, **options):
+        print '%d locks cleared' % idempotency.clear_locks()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import csv
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from logic.actions import format_value
+from logic.db import snapshot_alias
+from logic.models import Chapter, ChapterSubmission
+
+class Command(BaseCommand):
+    help = 'Writes the semester gradebook: a csv matrix of users by chapters, with the grade of each submitted chapter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', help='output csv file (default: stdout)')
+        parser.add_argument('--group', help='only users of this group')
+
+    def handle(self, *args, **options):
+        db = snapshot_alias()
+        chapters = [c for c in Chapter.objects.using(db).all() if c.num_questions() > 0]
+
+        # all submitted grades in one pass
+        submissions = ChapterSubmission.objects.using(db).filter(attempt__gt=0)
+        if options['group']:
+            submissions = submissions.filter(user__userprofile__group=options['group'])
+        grades = {}
+        missing = {}
+        for sub_id, user_id, chapter_id, grade in submissions.values_list('id', 'user_id', 'chapter_id', 'grade').iterator():
+            if grade is None:
+                missing[sub_id] = (user_id, chapter_id)
+            grades.setdefault(user_id, {})[chapter_id] = grade
+        if missing:
+            for sub_id, grade in ChapterSubmission.grades(missing.keys(), db).iteritems():
+                user_id, chapter_id = missing[sub_id]
+                grades[user_id][chapter_id] = grade
+
+        users = User.objects.using(db).filter(id__in=grades.keys()).order_by('username') \
+            .values_list('id', 'username', 'userprofile__id_num', 'userprofile__group')
+
+        out = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            writer = csv.writer(out)
+            writer.writerow(['user', 'id', 'group'] + [format_value(c.display) for c in chapters])
+            for user_id, username, id_num, group in users.iterator():
+                user_grades = grades[user_id]
+                writer.writerow(
+                    [format_value(v) for v in (username, id_num, group)] +
+                    [format_value(user_grades.get(c.id)) for c in chapters]
+                )
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write('%d users, %d chapters' % (len(grades), len(chapters)))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from logic.synthetic import check_database, generate_semester
+
+class Command(BaseCommand):
+    help = 'Replaces the synthetic data with a reproducible semester of users, submissions, answers and stats for scale testing (with --settings=frege.synthetic_settings)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--chapters', type=int, default=6, help='synthetic chapters, each with an open part')
+        parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed generates the same semester')
+        parser.add_argument('--batch-size', type=int, help='rows per bulk insert (default: as many as the database allows)')
+
+    def handle(self, *args, **options):
+        try:
+            check_database()
+        except ImproperlyConfigured, e:
+            raise CommandError(e)
+        start = time.time()
+        counts = generate_semester(options['users'], options['chapters'], options['seed'], options['batch_size'])
+        print ', '.join('%d %s' % (count, name) for name, count in sorted(counts.iteritems()))
+        print 'generated in %.1fs' % (time.time() - start)
@@ -24,4 +24,6 @@ class Command(BaseCommand):
         print '- user %s exists:' % test_user, auth_ldap.user_exists(test_user) 
         print '- user %s group:' % test_user, auth_ldap.get_user_group_id(test_user) 
         print '- user %s ou:' % test_user, auth_ldap.get_user_ou(test_user) 
+        for op, m in sorted(auth_ldap.client.metrics.get().iteritems()):
+            print '- %s: count=%d errors=%d avg=%.3fs max=%.3fs' % (op, m['count'], m['errors'], m['avg'], m['max'])
         print 'DONE'
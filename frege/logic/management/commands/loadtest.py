@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from logic import synthetic
+from logic.loadtest import LoadTest
+from logic.models import GlobalSettings
+
+class Command(BaseCommand):
+    help = 'Simulates students answering the synthetic chapters concurrently, and reports latency, throughput, errors and lock retries per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help='server to test')
+        parser.add_argument('--runserver', action='store_true', default=False, help='start a local server at the url for the test, with the same settings')
+        parser.add_argument('--users', type=int, default=20, help='concurrent students')
+        parser.add_argument('--chapters', type=int, default=2, help='synthetic chapters to answer')
+        parser.add_argument('--iterations', type=int, default=1, help='times each student answers all chapters')
+        parser.add_argument('--think', type=float, default=0.5, help='max seconds between requests')
+        parser.add_argument('--polls', type=int, default=3, help='followup refresh polls per followup')
+        parser.add_argument('--ramp', type=float, default=5, help='seconds over which the students start')
+        parser.add_argument('--clear', action='store_true', default=False, help='remove the synthetic data after the test')
+
+    def handle(self, *args, **options):
+        try:
+            synthetic.check_database()
+        except ImproperlyConfigured, e:
+            raise CommandError(e)
+        if GlobalSettings.objects.filter(ldap_enabled=True).exists():
+            self.stderr.write('warning: ldap is enabled, synthetic users can only log in if it is disabled in the settings')
+        server = self._start_server(options['url']) if options['runserver'] else None
+        try:
+            result = LoadTest(
+                options['url'],
+                users=options['users'],
+                chapters=options['chapters'],
+                iterations=options['iterations'],
+                think=options['think'],
+                polls=options['polls'],
+                ramp=options['ramp'],
+            ).run()
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+            if options['clear']:
+                synthetic.clear()
+        self._report(result)
+
+    def _start_server(self, url):
+        address = url.split('://', 1)[-1].rstrip('/')
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        server = subprocess.Popen([sys.executable, manage, 'runserver', '--noreload', address])
+        for _ in range(60):
+            try:
+                urllib2.urlopen(url, timeout=1)
+                return server
+            except urllib2.HTTPError:
+                return server # responding
+            except Exception:
+                time.sleep(0.5)
+        server.terminate()
+        raise CommandError('server did not start at %s' % url)
+
+    def _report(self, result):
+        print 'duration: %.1fs' % result['duration']
+        print '%-32s %7s %7s %8s %8s %8s %8s' % ('endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        for endpoint, e in result['endpoints'].iteritems():
+            print '%-32s %7d %6.1f%% %8.2f %8.0f %8.0f %8.0f' % (
+                endpoint, e['count'], e['error_rate'] * 100, e['throughput'], e['p50'], e['p95'], e['p99'],
+            )
+        retries = result['lock_retries']
+        if retries is None:
+            print 'lock retries: not available (performance stats are disabled on the server)'
+            return
+        print 'lock retries:'
+        for name, count in retries.iteritems():
+            print '  %-30s %d' % (name, count)
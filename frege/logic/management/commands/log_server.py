@@ -0,0 +1,31 @@
+import logging
+import logging.handlers
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from frege.logs import LogServer
+
+class Command(BaseCommand):
+    help = 'Receives the log records of all processes and writes them to the log file'
+    requires_system_checks = False # the log server does not use the database
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=settings.LOG_SERVER[1])
+
+    def handle(self, *args, **options):
+        handler = logging.handlers.RotatingFileHandler(
+            settings.LOG_FILE,
+            maxBytes=1024*1024*100, # 100mb
+            backupCount=5, # safe, since this is the only process writing the log
+        )
+        handler.setFormatter(logging.Formatter(settings.LOG_FORMAT))
+        server = LogServer((settings.LOG_SERVER[0], options['port']), handler)
+        print 'log server listening on %s:%s, writing to %s' % (server.server_address + (settings.LOG_FILE,))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            handler.close()
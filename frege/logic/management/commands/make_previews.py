@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from logic import previews
+from logic.models import StoredFile
+
+class Command(BaseCommand):
+    help = 'Makes the missing previews of uploaded images'
+
+    def handle(self, *args, **options):
+        if not previews.enabled():
+            raise CommandError('previews require Pillow')
+        written = previews.generate_missing(StoredFile.objects.values_list('name', flat=True))
+        print '%d previews written' % written
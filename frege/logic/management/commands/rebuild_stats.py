@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from logic.models import ChapterStats, ChapterStatsCount, ChapterSubmission, QuestionStats
+
+class Command(BaseCommand):
+    help = 'Rebuilds the aggregate stats tables from all ready submissions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missing', action='store_true', default=False, help='only rebuild if ready submissions are not counted (e.g. on deploy)')
+
+    def handle(self, *args, **options):
+        if options['missing']:
+            missing = ChapterSubmission.objects.filter(ready=True, grade__isnull=False, counted_stats__isnull=True).count()
+            if not missing:
+                print 'no missing stats'
+                return
+            print '%d ready submissions not counted, rebuilding' % missing
+        with transaction.atomic():
+            ChapterStats.rebuild()
+        print '%d chapters, %d counts, %d questions' % (
+            ChapterStats.objects.count(), ChapterStatsCount.objects.count(), QuestionStats.objects.count()
+        )
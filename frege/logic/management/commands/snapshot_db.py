@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from logic.db import snapshot_conf, snapshot_path, take_snapshot
+
+class Command(BaseCommand):
+    help = 'Copies the database into the read-only snapshot used by the stats pages and exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False, help='keep taking snapshots every SNAPSHOT interval')
+
+    def handle(self, *args, **options):
+        if not snapshot_path():
+            raise CommandError('no snapshot database configured')
+        interval = snapshot_conf()['INTERVAL']
+        while True:
+            start = time.time()
+            take_snapshot()
+            print 'snapshot taken in %.2fs' % (time.time() - start)
+            if not options['loop']:
+                break
+            time.sleep(max(0, interval - (time.time() - start)))
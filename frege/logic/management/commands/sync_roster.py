@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from frege import auth_ldap
+from logic.models import RosterGroup
+
+class Command(BaseCommand):
+    help = 'Syncs the local course roster from ldap (e.g. from cron, so that logins find it fresh)'
+
+    def handle(self, *args, **options):
+        if not auth_ldap.enabled():
+            print 'ldap is disabled'
+            return
+        auth_ldap.sync_roster()
+        for group in RosterGroup.objects.filter(course_id=auth_ldap.course_id()).order_by('group_id'):
+            print '%s: %d members' % (group, group.rostermember_set.count())
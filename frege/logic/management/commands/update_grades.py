@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from logic.models import ChapterSubmission
+
+class Command(BaseCommand):
+    help = 'Recalculates the stored grades of chapter submissions and verifies them against the live calculation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', default=False, help='only verify, do not update')
+
+    def handle(self, *args, **options):
+        verify = options['verify']
+        total = mismatched = 0
+        for submission in ChapterSubmission.objects.select_related('chapter', 'user').iterator():
+            total += 1
+            stored = (submission.grade, submission.ready)
+            live = submission.live_grade()
+            if stored != live:
+                mismatched += 1
+                print '%s/%s: stored grade=%s ready=%s, live grade=%s ready=%s' % (
+                    submission.user, submission.chapter.number, stored[0], stored[1], live[0], live[1]
+                )
+                if not verify:
+                    submission.update_grade()
+        print '%d submissions, %d %s' % (total, mismatched, 'mismatched' if verify else 'updated')
+        if verify and mismatched:
+            raise CommandError('%d stored grades do not match the live calculation' % mismatched)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Serving of uploaded (media) files, after the permission check in MediaView.
+
+With settings.MEDIA_SERVE['SENDFILE'] set, the transfer is handed to the front-end server, which then also
+handles ranges and conditional requests: 'x-sendfile' sends the file path in an X-Sendfile header (apache with
+mod_xsendfile), and 'x-accel-redirect' sends the url of the file under ACCEL_PREFIX in an X-Accel-Redirect
+header (nginx, with an internal location at ACCEL_PREFIX aliased to MEDIA_ROOT).
+Otherwise the file is streamed by django, supporting single byte ranges and conditional GET (ETag and
+Last-Modified).
+"""
+import mimetypes
+import os
+import re
+import urllib
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils.encoding import force_text
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+import logging
+logger = logging.getLogger(__name__)
+
+X_SENDFILE = 'x-sendfile'
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+
+DEFAULTS = {
+    'SENDFILE': None, # None to stream files from django, X_SENDFILE or X_ACCEL_REDIRECT
+    'ACCEL_PREFIX': '/protected-media/',
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'MEDIA_SERVE', {}))
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class RangeFile(object):
+    """ a file read from start, up to length bytes """
+
+    def __init__(self, f, start, length):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def parse_range(header, size):
+    """
+    returns the (start, end) bytes of a single range header, None if there is no range or it is not supported
+    (then the whole file is served), or False if the range cannot be satisfied
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        # suffix range: the last bytes
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+def etag(stat):
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+def content_disposition(filename):
+    """
+    returns an inline Content-Disposition of filename, encoded by RFC 5987 (e.g. for hebrew names), with an ascii
+    fallback for clients that do not support it
+    """
+    filename = force_text(filename)
+    fallback = ''.join(c if ' ' <= c <= '~' and c not in '"\\' else '_' for c in filename)
+    return 'inline; filename="%s"; filename*=UTF-8\'\'%s' % (fallback, urllib.quote(filename.encode('utf-8'), safe=''))
+
+def serve(request, path, filename=None):
+    """ returns a response serving the file at path (under MEDIA_ROOT) """
+    if not os.path.isfile(path):
+        raise Http404('no such file')
+    content_type, encoding = mimetypes.guess_type(path)
+    content_type = content_type or 'application/octet-stream'
+    filename = filename or os.path.basename(path)
+    disposition = content_disposition(filename)
+
+    mode = conf()['SENDFILE']
+    if mode:
+        response = HttpResponse(content_type=content_type)
+        if mode == X_SENDFILE:
+            response['X-Sendfile'] = path.encode('utf-8')
+        elif mode == X_ACCEL_REDIRECT:
+            name = os.path.relpath(path, settings.MEDIA_ROOT)
+            response['X-Accel-Redirect'] = urllib.quote((conf()['ACCEL_PREFIX'] + name).encode('utf-8'))
+        else:
+            raise ValueError('unknown sendfile mode: %s' % mode)
+        response['Content-Disposition'] = disposition
+        logger.debug('%s: sending %s by %s', request.user, path, mode)
+        return response
+
+    stat = os.stat(path)
+    tag = etag(stat)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = tag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+    else:
+        not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size)
+    if not_modified:
+        return HttpResponseNotModified()
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None or if_range == tag:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response
+    f = open(path, 'rb')
+    if byte_range:
+        start, end = byte_range
+        response = FileResponse(RangeFile(f, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = stat.st_size
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = tag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Content-Disposition'] = disposition
+    logger.debug('%s: streaming %s%s', request.user, path, ' bytes %d-%d' % byte_range if byte_range else '')
+    return response
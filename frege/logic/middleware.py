@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.contrib.auth import SESSION_KEY
+from django.db import connections
+from django.utils.functional import empty
+
+from . import perf
+from .db import counters
+
+import logging
+logger = logging.getLogger(__name__)
+
+def _user(request):
+    """ the user if it was fetched, or else the user id from the session, so as not to fetch it just for logging """
+    user = getattr(request, 'user', None)
+    if user is None:
+        return '-'
+    if getattr(user, '_wrapped', None) is empty:
+        return request.session.get(SESSION_KEY, '-')
+    return user
+
+class PerfMiddleware(object):
+    """ records the performance of each request per url name, see perf.py """
+
+    def process_request(self, request):
+        if not perf.conf()['ENABLED']:
+            return
+        perf.reset_sections()
+        counters.reset_current()
+        # log the queries of all connections, remembering where this request starts
+        request._perf_sql = {}
+        for conn in connections.all():
+            request._perf_sql[conn.alias] = (conn.force_debug_cursor, len(conn.queries_log))
+            conn.force_debug_cursor = True
+        request._perf_start = time.time()
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_perf_start'):
+            return response
+        wall = (time.time() - request._perf_start) * 1000
+        sql_count = 0
+        sql_time = 0.
+        for conn in connections.all():
+            debug_cursor, start = request._perf_sql.get(conn.alias, (False, 0))
+            queries = list(conn.queries_log)[start:]
+            sql_count += len(queries)
+            sql_time += sum(float(q['time']) for q in queries) * 1000
+            conn.force_debug_cursor = debug_cursor
+        match = request.resolver_match
+        url_name = match.view_name if match else 'unresolved'
+        sample = {
+            'wall': wall,
+            'sql_count': sql_count,
+            'sql_time': sql_time,
+            'lock_retries': counters.current()['retries'],
+            'formula_time': perf.section_times().get('formula', 0),
+        }
+        logger.debug('%s: %s %s perf: %s', _user(request), request.method, url_name, sample)
+        perf.registry.record(url_name, sample)
+        return response
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 15:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0029_auto_20161007_1726'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaptersubmission',
+            name='grade',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='\u05e6\u05d9\u05d5\u05df'),
+        ),
+        migrations.AddField(
+            model_name='chaptersubmission',
+            name='ready',
+            field=models.BooleanField(default=False, verbose_name='\u05de\u05d5\u05db\u05df \u05dc\u05e1\u05d8\u05d8\u05d9\u05e1\u05d8\u05d9\u05e7\u05d4'),
+        ),
+    ]
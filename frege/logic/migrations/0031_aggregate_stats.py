@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 15:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0030_chaptersubmission_grade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChapterStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_sub', models.IntegerField(default=0)),
+                ('sum_grade', models.IntegerField(default=0)),
+                ('sum_attempts', models.IntegerField(default=0)),
+                ('chapter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='logic.Chapter')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChapterStatsCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('G', '\u05e6\u05d9\u05d5\u05df'), ('A', '\u05e0\u05e1\u05d9\u05d5\u05e0\u05d5\u05ea')], max_length=1)),
+                ('value', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='logic.Chapter')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuestionStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question_number', models.PositiveIntegerField()),
+                ('num_answers', models.IntegerField(default=0)),
+                ('num_final_correct', models.FloatField(default=0)),
+                ('num_attempts', models.IntegerField(default=0)),
+                ('num_attempts_correct', models.FloatField(default=0)),
+                ('num_first_correct', models.FloatField(default=0)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='logic.Chapter')),
+            ],
+            options={
+                'ordering': ['question_number'],
+            },
+        ),
+        migrations.AddField(
+            model_name='chaptersubmission',
+            name='counted_stats',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='questionstats',
+            unique_together=set([('chapter', 'question_number')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='chapterstatscount',
+            unique_together=set([('chapter', 'kind', 'value')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 15:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+def count_attempts(apps, schema_editor):
+    UserAnswer = apps.get_model('logic', 'UserAnswer')
+    counts = UserAnswer.objects.annotate(num_stats=Count('stat')).filter(num_stats__gt=0).values_list('id', 'num_stats')
+    for ans_id, num_stats in counts:
+        UserAnswer.objects.filter(id=ans_id).update(attempts=num_stats)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0031_aggregate_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useranswer',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='\u05e0\u05e1\u05d9\u05d5\u05e0\u05d5\u05ea'),
+        ),
+        migrations.RunPython(count_attempts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 15:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0032_useranswer_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RosterGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_id', models.CharField(max_length=30, verbose_name='\u05de\u05e1\u05e4\u05e8 \u05e7\u05d5\u05e8\u05e1')),
+                ('group_id', models.CharField(max_length=2, verbose_name='\u05de\u05e1\u05e4\u05e8 \u05e7\u05d1\u05d5\u05e6\u05d4')),
+                ('synced', models.DateTimeField(verbose_name='\u05d6\u05de\u05df \u05e2\u05d3\u05db\u05d5\u05df')),
+            ],
+            options={
+                'verbose_name': '\u05e7\u05d1\u05d5\u05e6\u05ea \u05e7\u05d5\u05e8\u05e1',
+                'verbose_name_plural': '\u05e7\u05d1\u05d5\u05e6\u05d5\u05ea \u05e7\u05d5\u05e8\u05e1',
+            },
+        ),
+        migrations.CreateModel(
+            name='RosterMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(db_index=True, max_length=150)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='logic.RosterGroup')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='rostergroup',
+            unique_together=set([('course_id', 'group_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rostermember',
+            unique_together=set([('group', 'username')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 16:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0033_roster'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True, verbose_name='\u05e9\u05dd')),
+                ('version', models.PositiveIntegerField(default=0, verbose_name='\u05d2\u05e8\u05e1\u05d4')),
+            ],
+            options={
+                'verbose_name': '\u05d2\u05e8\u05e1\u05ea \u05e0\u05ea\u05d5\u05e0\u05d9\u05dd',
+                'verbose_name_plural': '\u05d2\u05e8\u05e1\u05d0\u05d5\u05ea \u05e0\u05ea\u05d5\u05e0\u05d9\u05dd',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 16:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0034_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='sha256')),
+                ('name', models.CharField(db_index=True, max_length=200, verbose_name='\u05e9\u05dd')),
+                ('size', models.PositiveIntegerField(verbose_name='\u05d2\u05d5\u05d3\u05dc')),
+                ('refs', models.PositiveIntegerField(default=0, verbose_name='\u05d4\u05e4\u05e0\u05d9\u05d5\u05ea')),
+            ],
+            options={
+                'verbose_name': '\u05e7\u05d5\u05d1\u05e5',
+                'verbose_name_plural': '\u05e7\u05d1\u05e6\u05d9\u05dd',
+            },
+        ),
+    ]
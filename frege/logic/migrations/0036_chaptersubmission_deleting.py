@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 17:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logic', '0035_stored_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaptersubmission',
+            name='deleting',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import os
 import threading
+import time
 
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.signals import request_started
 from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
-from django.db import models
-from django.db.models.signals import pre_delete, post_delete 
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.signals import pre_delete, post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
+from . import previews
 from .formula import (
     Formula,
     PredicateFormula,
@@ -39,6 +50,198 @@ def _concrete_sub_classes(cls):
             subs.append(sub)
     return subs
  
+class DataVersion(models.Model):
+    """
+    a version number of data that processes keep in memory, incremented on every change to the data,
+    so that all processes notice the change and not only the one that made it (see ChapterIndex)
+    """
+    name = models.CharField(max_length=40, unique=True, verbose_name='שם')
+    version = models.PositiveIntegerField(default=0, verbose_name='גרסה')
+
+    @classmethod
+    def get(cls, name):
+        return cls.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def versions(cls, prefix):
+        """ returns the versions of all names starting with prefix """
+        return dict(cls.objects.filter(name__startswith=prefix).values_list('name', 'version'))
+
+    @classmethod
+    def increment(cls, *names):
+        names = set(names)
+        if cls.objects.filter(name__in=names).update(version=F('version') + 1) < len(names):
+            existing = set(cls.objects.filter(name__in=names).values_list('name', flat=True))
+            for name in names - existing:
+                cls.objects.get_or_create(name=name, defaults={'version': 1})
+
+    def __unicode__(self):
+        return '%s: %d' % (self.name, self.version)
+
+    class Meta:
+        verbose_name = 'גרסת נתונים'
+        verbose_name_plural = 'גרסאות נתונים'
+
+class ChapterIndex(object):
+    """
+    the chapter hierarchy: all chapters with their parts, question counts and open flags, built in one pass
+    (a query for the chapters and one per question type) and kept in memory by each process.
+
+    changes to the chapters themselves increment the chapters data version, and changes to questions
+    increment the version of their chapter only, so that only the data of that chapter is rebuilt.
+    the versions are checked once per request (and at most every CHECK_INTERVAL seconds outside of requests).
+    changes made by this process are applied before its next read, while changes made by other processes
+    are applied by a background thread, and until it is done the previous index is used.
+    the index is never changed once built: rebuilding creates a new index which then replaces the current one
+    """
+    VERSION = 'chapters'
+    CHECK_INTERVAL = 1. # seconds
+    BACKGROUND = getattr(settings, 'CHAPTER_INDEX_BACKGROUND', True) # False to apply changes in the requesting thread
+
+    lock = threading.RLock()
+    current = None
+    dirty = set() # ids of chapters changed by this process since the current index was built
+    rebuild_thread = None
+    _local = threading.local() # time of the last version check of the thread
+
+    def __init__(self, versions, previous=None, chapter_ids=None):
+        """ builds the index, or rebuilds only the data of the given chapters from the previous index """
+        self.versions = versions
+        if previous is None or chapter_ids is None:
+            self.chapters = list(Chapter.objects.all())
+            self.data = {}
+            rebuilt = self.chapters
+        else:
+            self.chapters = previous.chapters
+            self.data = dict(previous.data)
+            rebuilt = [ch for ch in self.chapters if ch.id in chapter_ids]
+        self.parts = OrderedDict() # int chnum -> parts
+        for ch in self.chapters:
+            self.parts.setdefault(int(ch.number), []).append(ch)
+        self._build_data(rebuilt)
+        logger.debug('built chapter index: %d chapters, %s rebuilt', len(self.chapters), 'all' if chapter_ids is None else len(chapter_ids))
+
+    def _build_data(self, chapters):
+        if not chapters:
+            return
+        ids = [ch.id for ch in chapters]
+        num_questions = {}
+        num_followups = {}
+        open_chapters = set()
+        for sub in _concrete_sub_classes(Question):
+            fields = ['chapter_id'] + (['followup'] if sub == FormulationQuestion else [])
+            questions = sub.objects.all() if len(chapters) == len(self.chapters) else sub.objects.filter(chapter_id__in=ids)
+            for row in questions.values(*fields).annotate(count=models.Count('id')):
+                chapter_id = row['chapter_id']
+                num_questions[chapter_id] = num_questions.get(chapter_id, 0) + row['count']
+                if row.get('followup', FormulationQuestion.NONE) != FormulationQuestion.NONE:
+                    num_followups[chapter_id] = num_followups.get(chapter_id, 0) + row['count']
+                if sub == OpenQuestion:
+                    open_chapters.add(chapter_id)
+        for ch in chapters:
+            self.data[ch.number] = (ch.id in open_chapters, {
+                False: num_questions.get(ch.id, 0),
+                True: num_questions.get(ch.id, 0) + num_followups.get(ch.id, 0),
+            })
+
+    @classmethod
+    def chapter_version(cls, chapter_id):
+        return '%s-%s' % (cls.VERSION, chapter_id)
+
+    def changed(self, versions):
+        """ returns the ids of the chapters changed since the index was built, or None if the chapters themselves changed """
+        if versions.get(self.VERSION, 0) != self.versions.get(self.VERSION, 0):
+            return None
+        return {
+            ch.id for ch in self.chapters
+            if versions.get(self.chapter_version(ch.id), 0) != self.versions.get(self.chapter_version(ch.id), 0)
+        }
+
+    @classmethod
+    def get(cls):
+        now = time.time()
+        check = now - getattr(cls._local, 'checked', 0) >= cls.CHECK_INTERVAL
+        with cls.lock:
+            current, dirty = cls.current, set(cls.dirty)
+        if current is not None and not dirty and not check:
+            return current
+        versions = DataVersion.versions(cls.VERSION)
+        cls._local.checked = now
+        if current is None:
+            return cls._refresh(versions, dirty=dirty)
+        changed = current.changed(versions)
+        if changed is not None:
+            changed |= dirty
+            if not changed:
+                return current
+        if dirty or not cls.BACKGROUND:
+            return cls._refresh(versions, current, changed, dirty)
+        cls._refresh_in_background(versions, current, changed)
+        return current
+
+    @classmethod
+    def _refresh(cls, versions, previous=None, chapter_ids=None, dirty=frozenset()):
+        index = cls(versions, previous, chapter_ids)
+        with cls.lock:
+            # another thread may have already replaced the previous index
+            if cls.current is previous:
+                cls.current = index
+            cls.dirty -= dirty
+            return cls.current
+
+    @classmethod
+    def _refresh_in_background(cls, versions, previous, chapter_ids):
+        with cls.lock:
+            if cls.rebuild_thread and cls.rebuild_thread.is_alive():
+                return
+            cls.rebuild_thread = threading.Thread(
+                target=cls._rebuild, args=(versions, previous, chapter_ids), name='chapter-index',
+            )
+            cls.rebuild_thread.daemon = True
+            cls.rebuild_thread.start()
+
+    @classmethod
+    def _rebuild(cls, versions, previous, chapter_ids):
+        try:
+            cls._refresh(versions, previous, chapter_ids)
+        except Exception, e:
+            logger.exception('failed rebuilding the chapter index: %s', e)
+        finally:
+            connection.close()
+
+    @classmethod
+    def invalidate(cls, chapter_ids=None):
+        """ marks the given chapters as changed, or if no chapters are given, the chapters themselves """
+        if chapter_ids is None:
+            DataVersion.increment(cls.VERSION)
+            with cls.lock:
+                cls.current = None
+        else:
+            chapter_ids = set(chapter_ids) - {None}
+            if not chapter_ids:
+                return
+            DataVersion.increment(*[cls.chapter_version(chapter_id) for chapter_id in chapter_ids])
+            with cls.lock:
+                cls.dirty |= chapter_ids
+
+    @classmethod
+    def expire(cls):
+        """ makes the next get of this thread check the versions """
+        cls._local.checked = 0
+
+    def chapter(self, chnum):
+        chnum = Decimal(chnum)
+        for ch in self.chapter_parts(chnum):
+            if ch.number == chnum:
+                return ch
+
+    def chapter_parts(self, chnum):
+        return self.parts.get(int(Decimal(chnum)), [])
+
+@receiver(request_started)
+def expire_chapter_index(**kwargs):
+    ChapterIndex.expire()
+
 class Chapter(models.Model):
     number = models.DecimalField(
         verbose_name='מספר',
@@ -57,37 +260,19 @@ class Chapter(models.Model):
 
     #########################################################
     # class level stuff
-    lock = threading.RLock()
-    chapter_data = {} # chnum -> (is_open, {followup/not -> num_questions})
-
-    @classmethod
-    def _update_data(cls, chnum=None):
-        logger.debug('updating data: %s', chnum if chnum else 'all')
-        with cls.lock:
-            get_value = lambda ch: (ch._is_open(), {is_fu: ch._num_questions(is_fu) for is_fu in (True, False)})
-            if chnum:
-                cls.chapter_data[chnum] = get_value(cls.objects.get(number=chnum))
-            else:
-                cls.chapter_data = {
-                    ch.number: get_value(ch)
-                    for ch in cls.objects.all()
-                }
-
     @classmethod
     def _get_data(cls, chnum):
-        with cls.lock:
-            if chnum not in cls.chapter_data:
-                cls._update_data(chnum)
-            return cls.chapter_data[chnum]
+        """ returns (is_open, {followup/not -> num_questions}) from the chapter index """
+        data = ChapterIndex.get().data.get(chnum)
+        if data is None:
+            # a chapter the index does not have yet
+            ch = cls.objects.get(number=chnum)
+            data = ch._is_open(), {is_fu: ch._num_questions(is_fu) for is_fu in (True, False)}
+        return data
 
     @classmethod
-    def _remove_data(cls, chnum=None):
-        logger.debug('removing data: %s', chnum if chnum else 'all')
-        with cls.lock:
-            if chnum:
-                cls.chapter_data.pop(chnum, None)
-            else:
-                cls.chapter_data.clear()
+    def _remove_data(cls, chapter_ids=None):
+        ChapterIndex.invalidate(chapter_ids)
     #
     #########################################################
 
@@ -96,7 +281,7 @@ class Chapter(models.Model):
 
     def save(self, *args, **kwargs):
         super(Chapter, self).save(*args, **kwargs)
-        self._remove_data(self.number)
+        self._remove_data()
 
     @property
     def chnum(self):
@@ -132,7 +317,7 @@ class Chapter(models.Model):
         return Chapter.objects.filter(number__gte=int(self.number), number__lt=int(self.number)+1)
 
     def has_parts(self):
-        return not self.is_first_part() or self.parts().count() > 1
+        return not self.is_first_part() or len(ChapterIndex.get().chapter_parts(self.number)) > 1
 
     def is_first_part(self):
         return self.number == int(self.number)
@@ -168,14 +353,56 @@ class Chapter(models.Model):
     def reorder_questions(self, moved_num=None):
         """ renumbers questions if there are any gaps in numbers, starting 1 """
         questions = sorted(self.questions(), key=lambda q: q.number)
+        numbers = {}
         next_num = 1
         for q in questions:
             if moved_num is None or moved_num != q.number:
                 if q.number != next_num:
                     logger.debug('ch. %s: renumbering %s to %d', self.number, q, next_num)
-                    q.number = next_num
-                    q.save()
+                    numbers[q.number] = next_num
                 next_num += 1
+        self.renumber_questions(numbers, questions)
+
+    def renumber_questions(self, numbers, questions=None):
+        """
+        sets the numbers of questions, given as {number: new number}. the new numbering is validated once,
+        and the questions of each type are updated by a single query, in one transaction.
+        returns the renumbered questions
+        """
+        if questions is None:
+            questions = self.questions()
+        final = {q.number: q.number for q in questions}
+        for num, new_num in numbers.iteritems():
+            if num not in final:
+                raise ValidationError('לא קיימת שאלה מספר %d בפרק %s' % (num, self.display))
+            final[num] = new_num
+        changed = [q for q in questions if final[q.number] != q.number]
+        if not changed:
+            return []
+        if Question.CLEAN_CHECK_ANSWERS and self.user_answers().exists():
+            logger.error('%s has user answers, not renumbering questions', self)
+            raise ValidationError('לא ניתן לערוך שאלה בפרק שיש לו תשובות משתמשים')
+        taken = set()
+        for num in final.itervalues():
+            if num <= Question.DEFAULT_NUM:
+                raise ValidationError('מספר שאלה לא חוקי: %d' % num)
+            if num in taken:
+                raise ValidationError('כבר קיימת שאלה מספר %d בפרק %s' % (num, self.display))
+            taken.add(num)
+        by_type = OrderedDict()
+        for q in changed:
+            by_type.setdefault(type(q), []).append(q)
+        with transaction.atomic():
+            for cls, qs in by_type.iteritems():
+                cls.objects.filter(id__in=[q.id for q in qs]).update(number=Case(
+                    *[When(id=q.id, then=Value(final[q.number])) for q in qs],
+                    output_field=models.PositiveIntegerField()
+                ))
+        logger.debug('ch. %s: renumbered %d questions', self.number, len(changed))
+        for q in changed:
+            q.number = final[q.number]
+        self._remove_data([self.id])
+        return changed
 
     def __unicode__(self):
         return '%s. %s' % (self.display, self.title)
@@ -185,6 +412,12 @@ class Chapter(models.Model):
         verbose_name_plural = 'פרקים'
         ordering = ['number']
 
+@receiver(post_delete)
+def delete_chapter(instance, sender, **kwargs):
+    if issubclass(sender, Chapter):
+        Chapter._remove_data()
+        DataVersion.objects.filter(name=ChapterIndex.chapter_version(instance.id)).delete()
+
 class Question(models.Model):
 
     CLEAN_CHECK_ANSWERS = True
@@ -253,6 +486,7 @@ class Question(models.Model):
     def save(self, *args, **kwargs):
         logger.debug('saving %s', self)
         reorder_chapter = False
+        changed_chapters = {self.chapter_id}
         if self.number == self.DEFAULT_NUM:
             # new question, set a number
             self._auto_number()
@@ -263,12 +497,13 @@ class Question(models.Model):
                 # question moved to another chapter, renumber the question
                 self._auto_number()
                 reorder_chapter = True
+                changed_chapters.add(existing_chapter.id)
         self.clean()
         super(Question, self).save(*args, **kwargs)
         if reorder_chapter:
             # reorder the chapter from which the question was moved (must be after save)
             existing_chapter.reorder_questions(moved_num=old_num)
-        Chapter._remove_data()
+        Chapter._remove_data(changed_chapters)
 
     def _chapter_changed(self):
         existing_q = self._get_existing()
@@ -338,11 +573,13 @@ def delete_stuff(instance, sender, **kwargs):
     # do stuff upon question deletion
     if issubclass(sender, Question):
         self = instance
-        logger.debug('post delete %s', self)
+        # the chapter may already be deleted, so it is not fetched for logging
+        logger.debug('post delete %s %s (chapter id %s)', sender.__name__, self.number, self.chapter_id)
         # re-order other questions
         chapter = self._get_chapter()
         if chapter: # if chapter was not deleted
             chapter.reorder_questions()
+        Chapter._remove_data([self.chapter_id])
 
 class TextualQuestion(Question):
     text = models.TextField(verbose_name='טקסט')
@@ -585,6 +822,79 @@ class ChapterSubmission(models.Model):
     attempt = models.PositiveIntegerField(verbose_name='נסיונות')
     ongoing = models.BooleanField()
     time = models.DateTimeField(verbose_name='זמן הגשה', blank=True, null=True)
+    grade = models.PositiveIntegerField(verbose_name='ציון', blank=True, null=True)
+    ready = models.BooleanField(verbose_name='מוכן לסטטיסטיקה', default=False)
+    counted_stats = models.TextField(null=True, blank=True) # json of the data counted in the aggregate stats
+    # set while the submission is being deleted, so that its grade and stats are no longer updated. set in the
+    # deleting transaction, so that it is undone if the deletion fails
+    deleting = models.BooleanField(default=False, editable=False)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # counted stats are only updated by the aggregate stats, never overwrite them
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if f.name not in ('id', 'counted_stats', 'deleting')]
+        super(ChapterSubmission, self).save(*args, **kwargs)
+
+    def update_grade(self):
+        """
+        recalculates the stored grade and readiness of the submission, this should be called once anything the
+        grade depends on changes (submission, user answers, open answer grades), e.g. once per request.
+        the grade of an unsubmitted submission is not stored, but calculated when shown (see percent_correct)
+        """
+        self.grade, self.ready = self.live_grade()
+        # update directly, so as not to trigger save
+        ChapterSubmission.objects.filter(pk=self.pk).update(grade=self.grade, ready=self.ready)
+        logger.debug('%s/%s: updated grade=%s, ready=%s', self.user_id, self.chapter_id, self.grade, self.ready)
+        ChapterStats.update_submission(self)
+
+    def live_grade(self):
+        """ returns the grade and readiness to store, as calculated live """
+        return self.calculate_grade() if self.is_submitted() else None, self.is_ready_for_stats()
+
+    def stats_data(self, stats=None, answers=None):
+        """
+        returns the data this submission contributes to the chapter aggregate stats:
+        grade, attempt, and for each question number a list of
+        [answers, final correct, attempts, attempts correct, first attempts correct]
+        where correctness of open questions is their grade.
+        the stats (user answer id -> list of correct) and the user answers (with their questions and
+        open answers) are fetched unless given, e.g. when prefetched for many submissions
+        """
+        if stats is None:
+            stats = {}
+            for ans_id, correct in Stat.objects.filter(user_answer__submission=self).order_by('id').values_list('user_answer_id', 'correct'):
+                stats.setdefault(ans_id, []).append(correct)
+        is_open = self.chapter.is_open()
+        if answers is None:
+            answers = self.all_useranswers_with_related()
+            if is_open:
+                answers = answers.select_related('openanswer')
+        questions = {}
+        for ans in answers:
+            ans_stats = stats.get(ans.id)
+            if not ans_stats:
+                continue
+            if is_open:
+                open_ans = getattr(ans, 'openanswer', None)
+                grade = float(open_ans.grade) if open_ans and open_ans.checked else 0.
+                values = [1, grade, len(ans_stats), grade, grade]
+            else:
+                values = [1, int(ans.correct), len(ans_stats), sum(1 for c in ans_stats if c), int(ans_stats[0])]
+            qdata = questions.setdefault(str(ans.question_number), [0] * len(values))
+            for i, v in enumerate(values):
+                qdata[i] += v
+        return {
+            'grade': self.grade,
+            'attempt': self.attempt,
+            'questions': questions,
+        }
+
+    def calculate_grade(self):
+        """ live grade calculation, returns None for a chapter with no questions """
+        if self.chapter.num_questions() == 0:
+            return None
+        _, _, pct = self.correctness_data()
+        return pct
 
     def is_complete(self):
         """
@@ -631,27 +941,21 @@ class ChapterSubmission(models.Model):
     def remaining(self):
         return self.max_attempts - self.attempt
 
-    @property
-    def user_id_num(self):
-        return self.user.userprofile.id_num if hasattr(self.user, 'userprofile') else ''
-
-    @property
-    def user_group(self):
-        return self.user.userprofile.group if hasattr(self.user, 'userprofile') else ''
-
-    @property
-    def percent_correct_f(self):
-        return self.percent_correct()
-
     def percent_correct(self):
-        _, _, pct = self.correctness_data()
-        return pct
+        if self.grade is None:
+            return self.calculate_grade()
+        return self.grade
     percent_correct.short_description = 'ציון'
 
-    @property
-    def localtime_str(self):
-        if self.time:
-            return timezone.localtime(self.time).strftime('%d/%m/%Y %H:%M')
+    @classmethod
+    def grades(cls, ids, using=None):
+        """ returns a dict of submission id -> grade for the given ids, calculating only grades that are not stored """
+        grades = dict(cls.objects.using(using).filter(id__in=ids).values_list('id', 'grade'))
+        missing = [sub_id for sub_id, grade in grades.iteritems() if grade is None]
+        if missing:
+            for submission in cls.objects.using(using).filter(id__in=missing).select_related('chapter'):
+                grades[submission.id] = submission.calculate_grade()
+        return grades
 
     def correctness_data(self):
         """
@@ -683,10 +987,6 @@ class ChapterSubmission(models.Model):
             .select_related('_oq') \
             .select_related('_mq')
 
-    @property
-    def chapter_number_f(self):
-        return self.chapter.number
-
     def chapter_number(self):
         return self.chapter.number
     chapter_number.short_description = 'פרק'
@@ -709,6 +1009,8 @@ class ChapterSubmission(models.Model):
         unique_together = ('chapter', 'user')
         ordering = ['chapter']
 
+MAX_ANSWER_STATS = 4 # stats recorded per answer at most
+
 class UserAnswer(models.Model):
     user = models.ForeignKey(User, verbose_name='משתמש', on_delete=models.CASCADE)
     chapter = models.ForeignKey(Chapter, verbose_name='פרק', on_delete=models.PROTECT)
@@ -725,6 +1027,7 @@ class UserAnswer(models.Model):
     answer = models.TextField()
     is_followup = models.BooleanField(default=False)
     time = models.DateTimeField(verbose_name='זמן', blank=True, null=True)
+    attempts = models.PositiveIntegerField(verbose_name='נסיונות', default=0) # number of stats recorded for the answer
 
     def set_question(self, q):
         if type(q) == ChoiceQuestion:
@@ -776,6 +1079,13 @@ class UserAnswer(models.Model):
     def _all_q(self):
         return [self._cq, self._oq, self._fq, self._tq, self._mq, self._dq]
 
+    @classmethod
+    def question_numbers(cls, ids, using=None):
+        """ returns a dict of user answer id -> question number for the given ids """
+        rows = cls.objects.using(using).filter(id__in=ids) \
+            .values_list('id', '_cq__number', '_oq__number', '_fq__number', '_tq__number', '_mq__number', '_dq__number')
+        return {row[0]: next((n for n in row[1:] if n is not None), None) for row in rows}
+
     def is_submitted(self):
         """ returns true iff chapter was submitted with this answer """
         return self.submission and self.submission.time and (self.time < self.submission.time)
@@ -801,6 +1111,80 @@ def name_file(instance, filename):
     name = '%s_%s_%s.%s' % (instance.user_answer.user.username, chapnum, instance.question.number, extension)
     return os.path.join(path, name)
 
+def file_digest(f):
+    """ returns the sha256 of the file content """
+    digest = hashlib.sha256()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+def stored_file_name(digest, filename):
+    extension = filename.rsplit('.', 1).pop().lower() if '.' in filename else ''
+    return 'uploads/files/%s/%s%s' % (digest[:2], digest, '.%s' % extension if extension else '')
+
+class StoredFile(models.Model):
+    """
+    an uploaded file, stored once by the sha256 of its content and counting the open answers referring to it
+    (see OpenAnswer.save), so that identical uploads are not written again, and files are deleted once unused
+    """
+    digest = models.CharField(max_length=64, unique=True, verbose_name='sha256')
+    name = models.CharField(max_length=200, db_index=True, verbose_name='שם')
+    size = models.PositiveIntegerField(verbose_name='גודל')
+    refs = models.PositiveIntegerField(default=0, verbose_name='הפניות')
+
+    @classmethod
+    def store(cls, upload):
+        """ stores the uploaded file unless its content is already stored, adds a reference to it and returns its name """
+        digest = getattr(upload, 'sha256', None) or file_digest(upload)
+        stored = cls.objects.filter(digest=digest).first()
+        if stored is None or not cls.objects.filter(id=stored.id).update(refs=F('refs') + 1):
+            name = stored_file_name(digest, upload.name)
+            if not default_storage.exists(name):
+                saved = default_storage.save(name, upload)
+                if saved != name:
+                    # the same content was saved concurrently, the storage kept it and suffixed ours
+                    logger.debug('%s was stored concurrently, deleting %s', name, saved)
+                    default_storage.delete(saved)
+            logger.debug('storing %s as %s', upload.name, name)
+            stored, created = cls.objects.get_or_create(digest=digest, defaults={'name': name, 'size': upload.size})
+            cls.objects.filter(id=stored.id).update(refs=F('refs') + 1)
+            if created:
+                transaction.on_commit(lambda: previews.preview_worker.add(name))
+        else:
+            logger.debug('%s is already stored as %s', upload.name, stored.name)
+        return stored.name
+
+    @classmethod
+    def release(cls, name):
+        """ removes a reference to the stored file, deleting the file once there are no references left """
+        stored = cls.objects.filter(name=name).first()
+        if stored is None:
+            # stored before files were stored by content
+            logger.debug('deleting unreferenced file %s', name)
+            default_storage.delete(name)
+            return
+        cls.objects.filter(id=stored.id, refs__gt=0).update(refs=F('refs') - 1)
+        if cls.objects.filter(id=stored.id, refs=0).delete()[0]:
+            logger.debug('deleting stored file %s', name)
+            transaction.on_commit(lambda: cls._delete_file(name))
+
+    @classmethod
+    def _delete_file(cls, name):
+        # the same content may have been stored again since
+        if not cls.objects.filter(name=name).exists():
+            default_storage.delete(name)
+            previews.delete(name)
+
+    def __unicode__(self):
+        return '%s (%d refs)' % (self.name, self.refs)
+
+    class Meta:
+        verbose_name = 'קובץ'
+        verbose_name_plural = 'קבצים'
+
+GRADING_PAGE_SIZE = 50
+
 class OpenAnswer(models.Model):
 
     text = models.TextField(verbose_name='טקסט')
@@ -825,16 +1209,79 @@ class OpenAnswer(models.Model):
         return self.grade is not None
 
     def save(self, *args, **kwargs):
+        grade_changed = False
+        uploaded = self.upload and not self.upload._committed
+        if uploaded:
+            self.upload = StoredFile.store(self.upload)
         if self.pk is not None:
-            # existing answer updated, delete old file if replaced
+            # existing answer updated, release old file if replaced (even by the same content, which was referred again)
             existing = OpenAnswer.objects.get(id=self.id)
-            if existing.upload and existing.upload != self.upload:
-                logger.debug('upload updated (%s->%s), deleting previous file', existing, self)
-                existing.upload.delete(save=False)
+            if existing.upload and (uploaded or existing.upload != self.upload):
+                logger.debug('upload updated (%s->%s), releasing previous file', existing, self)
+                StoredFile.release(existing.upload.name)
+            grade_changed = existing.grade != self.grade
         if not self.upload and not self.text:
             logger.error('not saving open answer with no upload and no text: %s', self)
             raise ValidationError('empty open answer')
         super(OpenAnswer, self).save(*args, **kwargs)
+        if grade_changed:
+            # graded, answers themselves are graded by the view saving them
+            self.user_answer.submission.update_grade()
+
+    @classmethod
+    def grading_queue(cls, chapter, after=None, limit=GRADING_PAGE_SIZE):
+        """
+        returns the next ungraded answers of the submitted submissions of the chapter, by id, after the given id
+        (keyset pagination: the queue does not shift as answers are graded), with their users and questions
+        """
+        answers = cls.objects.filter(question__chapter=chapter, grade__isnull=True, user_answer__submission__attempt__gt=0)
+        if after is not None:
+            answers = answers.filter(id__gt=after)
+        return list(answers.select_related('user_answer__user', 'question').order_by('id')[:limit])
+
+    @classmethod
+    def grade_many(cls, grades):
+        """
+        sets the grades and comments of many answers, given as {answer id: (grade, comment)}, where a comment of
+        None keeps the existing comment. all grades are validated first, then set by a single query, and the
+        grade of each affected submission is updated once. returns the number of answers whose grade changed
+        """
+        grade_field, comment_field = cls._meta.get_field('grade'), cls._meta.get_field('comment')
+        existing = {
+            ans_id: (grade, comment, sub_id) for ans_id, grade, comment, sub_id in
+            cls.objects.filter(id__in=grades.keys()).values_list('id', 'grade', 'comment', 'user_answer__submission_id')
+        }
+        values = {}
+        for ans_id, (grade, comment) in grades.iteritems():
+            if ans_id not in existing:
+                raise ValidationError('לא קיימת תשובה %s' % ans_id)
+            try:
+                grade = grade_field.clean(grade, None)
+                comment = comment_field.clean(comment, None) if comment is not None else existing[ans_id][1]
+            except ValidationError, e:
+                raise ValidationError('ציון לא חוקי לתשובה %s: %s' % (ans_id, ' '.join(e.messages)))
+            values[ans_id] = (grade, comment or None)
+        if not values:
+            return 0
+        regraded = {ans_id for ans_id, (grade, _) in values.iteritems() if grade != existing[ans_id][0]}
+        with transaction.atomic():
+            cls.objects.filter(id__in=values.keys()).update(
+                grade=Case(
+                    *[When(id=ans_id, then=Value(grade)) for ans_id, (grade, _) in values.iteritems()],
+                    output_field=models.DecimalField(max_digits=2, decimal_places=1)
+                ),
+                comment=Case(
+                    *[When(id=ans_id, then=Value(comment)) for ans_id, (_, comment) in values.iteritems()],
+                    output_field=models.TextField()
+                ),
+            )
+            submissions = ChapterSubmission.objects \
+                .filter(id__in={existing[ans_id][2] for ans_id in regraded}) \
+                .select_related('chapter', 'user')
+            for submission in submissions:
+                submission.update_grade()
+        logger.debug('graded %d answers, %d changed', len(values), len(regraded))
+        return len(regraded)
 
     @property
     def short_text(self):
@@ -847,13 +1294,30 @@ class OpenAnswer(models.Model):
         verbose_name = 'תשובה פתוחה'
         verbose_name_plural = 'תשובות פתוחות'
 
+# handle user answer deletion
+@receiver(post_delete)
+def delete_user_answer(instance, sender, **kwargs):
+    if issubclass(sender, UserAnswer):
+        # update submission grade, unless it is being deleted as well
+        submission = ChapterSubmission.objects.filter(pk=instance.submission_id).first()
+        if submission and not submission.deleting:
+            submission.update_grade()
+
+# handle submission deletion
+@receiver(pre_delete)
+def pre_delete_submission(instance, sender, **kwargs):
+    if issubclass(sender, ChapterSubmission):
+        ChapterStats.remove_submission(instance)
+        ChapterSubmission.objects.filter(pk=instance.pk).update(deleting=True)
+
 # handle open answer deletion
 @receiver(post_delete)   
 def delete_open_answer(instance, sender, **kwargs):
     if issubclass(sender, OpenAnswer):
-        # delete file
+        # release file
         logger.debug('post delete %s', instance)
-        instance.upload.delete(save=False)
+        if instance.upload:
+            StoredFile.release(instance.upload.name)
 
 ########################################################################################################
 # Other models
@@ -884,10 +1348,181 @@ class UserProfile(models.Model):
         verbose_name = 'פרופיל'
         verbose_name_plural = 'פרופילים'
 
+class RosterGroup(models.Model):
+    """ a course group whose members are stored locally, synced from ldap (see auth_ldap) """
+    course_id = models.CharField(max_length=30, verbose_name='מספר קורס')
+    group_id = models.CharField(max_length=2, verbose_name='מספר קבוצה')
+    synced = models.DateTimeField(verbose_name='זמן עדכון')
+
+    def __unicode__(self):
+        return '%s%s' % (self.course_id, self.group_id)
+
+    class Meta:
+        unique_together = ('course_id', 'group_id')
+        verbose_name = 'קבוצת קורס'
+        verbose_name_plural = 'קבוצות קורס'
+
+class RosterMember(models.Model):
+    group = models.ForeignKey(RosterGroup, on_delete=models.CASCADE)
+    username = models.CharField(max_length=150, db_index=True) # lowercase
+
+    class Meta:
+        unique_together = ('group', 'username')
+
 class Stat(models.Model):
     user_answer = models.ForeignKey(UserAnswer, on_delete=models.CASCADE)
     correct = models.BooleanField()
 
+@receiver(post_save)
+def save_stat(instance, sender, created, **kwargs):
+    if issubclass(sender, Stat) and created:
+        ChapterStats.update_submission(instance.user_answer.submission)
+
+########################################################################################################
+# Aggregate stats
+# these are maintained incrementally from ready submissions: each submission keeps the data it
+# contributed (see ChapterSubmission.stats_data) so that only the difference is applied on change
+
+class ChapterStats(models.Model):
+    chapter = models.OneToOneField(Chapter, on_delete=models.CASCADE)
+    num_sub = models.IntegerField(default=0)
+    sum_grade = models.IntegerField(default=0)
+    sum_attempts = models.IntegerField(default=0)
+
+    @property
+    def avg_grade(self):
+        return float(self.sum_grade) / self.num_sub
+
+    @property
+    def avg_attempts(self):
+        return float(self.sum_attempts) / self.num_sub
+
+    @classmethod
+    def update_submission(cls, submission):
+        row = ChapterSubmission.objects.filter(pk=submission.pk).values_list('counted_stats', 'deleting').first()
+        if row is None or row[1]:
+            # deleted, or being deleted
+            return
+        counted = row[0]
+        old = json.loads(counted) if counted else None
+        new = submission.stats_data() if submission.ready and submission.grade is not None else None
+        if old == new:
+            return
+        logger.debug('%s/%s: updating aggregate stats', submission.user_id, submission.chapter_id)
+        cls._apply(submission.chapter_id, old, -1)
+        cls._apply(submission.chapter_id, new, 1)
+        submission.counted_stats = json.dumps(new) if new else None
+        ChapterSubmission.objects.filter(pk=submission.pk).update(counted_stats=submission.counted_stats)
+
+    @classmethod
+    def remove_submission(cls, submission):
+        counted = ChapterSubmission.objects.filter(pk=submission.pk).values_list('counted_stats', flat=True).first()
+        if counted:
+            logger.debug('%s/%s: removing from aggregate stats', submission.user_id, submission.chapter_id)
+            cls._apply(submission.chapter_id, json.loads(counted), -1)
+
+    @classmethod
+    def _apply(cls, chapter_id, data, sign, add=None):
+        if not data:
+            return
+        add = add or _add
+        add(cls, {'chapter_id': chapter_id}, num_sub=sign, sum_grade=sign*data['grade'], sum_attempts=sign*data['attempt'])
+        add(ChapterStatsCount, {'chapter_id': chapter_id, 'kind': ChapterStatsCount.GRADE, 'value': data['grade']}, count=sign)
+        add(ChapterStatsCount, {'chapter_id': chapter_id, 'kind': ChapterStatsCount.ATTEMPTS, 'value': data['attempt']}, count=sign)
+        for qnum, values in data['questions'].iteritems():
+            add(QuestionStats, {'chapter_id': chapter_id, 'question_number': int(qnum)}, **{
+                field: sign*v for field, v in zip(QuestionStats.FIELDS, values)
+            })
+
+    @classmethod
+    def rebuild(cls, chunk_size=500):
+        """
+        rebuilds all aggregate stats from scratch. the data of chunk_size submissions is fetched at a
+        time and summed in memory, and the aggregate rows are then inserted in bulk
+        """
+        cls.objects.all().delete()
+        ChapterStatsCount.objects.all().delete()
+        QuestionStats.objects.all().delete()
+        ChapterSubmission.objects.update(counted_stats=None)
+
+        rows = OrderedDict() # (model, key) -> row values
+        def add(model, key, **values):
+            values = {k: v for k, v in values.iteritems() if v}
+            if not values:
+                return
+            row = rows.setdefault((model, tuple(sorted(key.iteritems()))), dict(key))
+            for k, v in values.iteritems():
+                row[k] = row.get(k, 0) + v
+
+        ids = list(ChapterSubmission.objects.filter(ready=True, grade__isnull=False).order_by('id').values_list('id', flat=True))
+        for i in xrange(0, len(ids), chunk_size):
+            chunk = ids[i:i+chunk_size]
+            stats = {}
+            for ans_id, correct in Stat.objects.filter(user_answer__submission_id__in=chunk).order_by('id').values_list('user_answer_id', 'correct'):
+                stats.setdefault(ans_id, []).append(correct)
+            answers = {}
+            for ans in UserAnswer.objects.filter(submission_id__in=chunk).select_related(
+                '_cq', '_fq', '_tq', '_dq', '_oq', '_mq', 'openanswer',
+            ):
+                answers.setdefault(ans.submission_id, []).append(ans)
+            counted = {}
+            for submission in ChapterSubmission.objects.filter(id__in=chunk).select_related('chapter'):
+                data = submission.stats_data(stats, answers.get(submission.id, []))
+                cls._apply(submission.chapter_id, data, 1, add)
+                counted[submission.id] = json.dumps(data)
+            _update_counted_stats(counted)
+
+        for model in (cls, ChapterStatsCount, QuestionStats):
+            model.objects.bulk_create([model(**values) for (m, _), values in rows.iteritems() if m == model])
+
+def _update_counted_stats(counted, chunk_size=200):
+    """ sets the counted stats of many submissions, given as a dict of submission id -> json """
+    items = counted.items()
+    for i in xrange(0, len(items), chunk_size):
+        chunk = items[i:i+chunk_size]
+        ChapterSubmission.objects.filter(id__in=[sub_id for sub_id, _ in chunk]).update(counted_stats=Case(
+            *[When(id=sub_id, then=Value(data)) for sub_id, data in chunk],
+            output_field=models.TextField()
+        ))
+
+def _add(model, key, **values):
+    """ adds the values to the row identified by key, creating it if needed """
+    values = {k: v for k, v in values.iteritems() if v}
+    if not values:
+        return
+    if not model.objects.filter(**key).update(**{k: F(k) + v for k, v in values.iteritems()}):
+        model.objects.create(**dict(key, **values))
+
+class ChapterStatsCount(models.Model):
+    GRADE = 'G'
+    ATTEMPTS = 'A'
+    KIND_CHOICES = (
+        (GRADE, 'ציון'),
+        (ATTEMPTS, 'נסיונות'),
+    )
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    value = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('chapter', 'kind', 'value')
+
+class QuestionStats(models.Model):
+    FIELDS = ['num_answers', 'num_final_correct', 'num_attempts', 'num_attempts_correct', 'num_first_correct']
+
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE)
+    question_number = models.PositiveIntegerField()
+    num_answers = models.IntegerField(default=0)
+    num_final_correct = models.FloatField(default=0)
+    num_attempts = models.IntegerField(default=0)
+    num_attempts_correct = models.FloatField(default=0)
+    num_first_correct = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ('chapter', 'question_number')
+        ordering = ['question_number']
+
 # TODO: use this in places
 class GlobalSettings(models.Model):
     course_id = models.CharField(
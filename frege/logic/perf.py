@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Request performance instrumentation.
+
+For each request, PerfMiddleware (see middleware.py) samples the wall time, the number and time of
+sql queries, the database lock retries (see db.py) and the time spent in timed sections such as
+the formula engine, and records them in histograms per url name.
+The histograms are served as json to staff (PerfView) and summarized to the log periodically.
+"""
+import bisect
+import functools
+import threading
+import time
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'LOG_INTERVAL': 300, # seconds between log summaries, None for no summaries
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'PERF', {}))
+
+TIME_BOUNDS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000] # ms
+BOUNDS = {
+    'wall': TIME_BOUNDS,
+    'sql_count': [1, 2, 5, 10, 20, 50, 100, 200, 500],
+    'sql_time': TIME_BOUNDS,
+    'lock_retries': [0, 1, 2, 5, 10],
+    'formula_time': TIME_BOUNDS,
+}
+
+##############################################################################################
+# timed sections
+
+_local = threading.local()
+
+def _sections():
+    if not hasattr(_local, 'sections'):
+        _local.sections = {}
+        _local.active = set()
+    return _local.sections
+
+def reset_sections():
+    _sections().clear()
+
+def section_times():
+    """ returns the time in ms spent in each timed section by the current thread since the last reset """
+    return dict(_sections())
+
+def timed(section):
+    """
+    decorator that adds the time spent in the function to the section time of the current thread,
+    only the outermost timed call of a section is counted, so that nested calls are not counted twice
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sections = _sections()
+            if section in _local.active:
+                return func(*args, **kwargs)
+            _local.active.add(section)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.active.discard(section)
+                sections[section] = sections.get(section, 0.) + (time.time() - start) * 1000
+        return wrapper
+    return decorator
+
+##############################################################################################
+# histograms
+
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket is for values above all bounds
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        """ returns the upper bound of the bucket of the percentile (the max for the last bucket) """
+        rank = pct / 100. * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.avg,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'buckets': zip(self.bounds + ['inf'], self.counts),
+        }
+
+class Registry(object):
+    """ histograms of request samples per url name """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.urls = {}
+        self.last_log = time.time()
+
+    def record(self, url_name, sample):
+        with self.lock:
+            histograms = self.urls.get(url_name)
+            if histograms is None:
+                histograms = self.urls[url_name] = {metric: Histogram(bounds) for metric, bounds in BOUNDS.iteritems()}
+            for metric, value in sample.iteritems():
+                histograms[metric].add(value)
+        self._log_summary()
+
+    def summary(self):
+        with self.lock:
+            return {
+                url_name: {metric: h.as_dict() for metric, h in histograms.iteritems()}
+                for url_name, histograms in self.urls.iteritems()
+            }
+
+    def clear(self):
+        with self.lock:
+            self.urls.clear()
+
+    def _log_summary(self):
+        interval = conf()['LOG_INTERVAL']
+        if not interval:
+            return
+        with self.lock:
+            if time.time() - self.last_log < interval:
+                return
+            self.last_log = time.time()
+            lines = [
+                '%s: n=%d wall avg=%.0fms p95=%.0fms, sql avg=%.1f/%.0fms, formula avg=%.0fms, lock retries=%d' % (
+                    url_name,
+                    h['wall'].count,
+                    h['wall'].avg,
+                    h['wall'].percentile(95),
+                    h['sql_count'].avg,
+                    h['sql_time'].avg,
+                    h['formula_time'].avg,
+                    h['lock_retries'].total,
+                )
+                for url_name, h in sorted(self.urls.iteritems())
+            ]
+        logger.info('performance summary:\n%s', '\n'.join(lines))
+
+registry = Registry()
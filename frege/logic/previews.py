@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Previews of uploaded images (phone photos of handwritten answers, which are often several MB).
+
+Once a new file is stored (see StoredFile.store) and its transaction commits, it is queued to a background
+thread, which writes a downscaled, recompressed jpeg preview and a small thumbnail next to it in storage:
+uploads/files/ab/<sha256>.png -> uploads/files/ab/<sha256>.preview.jpg and uploads/files/ab/<sha256>.thumb.jpg.
+Files are stored by content, so each preview is made once however many answers refer to the file.
+The admin shows the previews, linking to the original.
+Previews require Pillow; without it nothing is generated and the admin links to the original files.
+Previews missing for any reason (e.g. files uploaded before, or a process that died with a non-empty queue)
+can be generated with the make_previews command.
+"""
+import os
+import Queue
+import threading
+
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'PREVIEW_SIZE': 1600, # pixels, of the longer side
+    'THUMBNAIL_SIZE': 200,
+    'QUALITY': 75, # jpeg quality
+    'BACKGROUND': True, # False to generate previews in the committing thread
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'UPLOAD_PREVIEWS', {}))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+PREVIEW = 'preview'
+THUMBNAIL = 'thumb'
+KINDS = (PREVIEW, THUMBNAIL)
+
+def enabled():
+    return Image is not None
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def preview_name(name, kind=PREVIEW):
+    return '%s.%s.jpg' % (os.path.splitext(name)[0], kind)
+
+def preview_base(name):
+    """
+    returns the name of the file that name is a preview of, without its extension (which the preview name does
+    not keep), or None if name is not a preview name
+    """
+    for kind in KINDS:
+        suffix = '.%s.jpg' % kind
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+def preview_url(name, kind=PREVIEW):
+    """ returns the url of the preview of the stored file name, or None if there is none (yet) """
+    if not enabled() or not is_image(name):
+        return None
+    preview = preview_name(name, kind)
+    if not default_storage.exists(preview):
+        return None
+    return default_storage.url(preview)
+
+def _resized(image, size, quality):
+    image = image.copy()
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    data = BytesIO()
+    image.save(data, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return ContentFile(data.getvalue())
+
+def generate(name):
+    """ writes the previews of the stored file name, returns the number of previews written """
+    if not enabled() or not is_image(name) or not default_storage.exists(name):
+        return 0
+    c = conf()
+    try:
+        with default_storage.open(name) as f:
+            image = Image.open(f)
+            image.load()
+    except (IOError, SyntaxError), e:
+        # not an image after all, or a broken one
+        logger.warning('cannot make previews of %s: %s', name, e)
+        return 0
+    if hasattr(ImageOps, 'exif_transpose'):
+        image = ImageOps.exif_transpose(image) # phone photos are often rotated by their exif data
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    written = 0
+    for kind, size in ((PREVIEW, c['PREVIEW_SIZE']), (THUMBNAIL, c['THUMBNAIL_SIZE'])):
+        preview = preview_name(name, kind)
+        if default_storage.exists(preview):
+            continue
+        default_storage.save(preview, _resized(image, size, c['QUALITY']))
+        written += 1
+    logger.debug('made %d previews of %s (%dx%d)', written, name, image.size[0], image.size[1])
+    return written
+
+def delete(name):
+    """ deletes the previews of the stored file name """
+    if is_image(name):
+        for kind in KINDS:
+            default_storage.delete(preview_name(name, kind))
+
+class PreviewWorker(object):
+
+    def __init__(self, background=True):
+        self.background = background
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def add(self, name):
+        """ queues previews of the stored file name """
+        if not enabled() or not is_image(name):
+            return
+        if not self.background:
+            self._generate(name)
+            return
+        self._start()
+        self.queue.put(name)
+
+    def _start(self):
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            thread = threading.Thread(target=self._run, name='upload-previews')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            name = self.queue.get()
+            try:
+                self._generate(name)
+            finally:
+                self.queue.task_done()
+
+    def _generate(self, name):
+        try:
+            generate(name)
+        except Exception, e:
+            logger.exception('unexpected error making previews of %s: %s', name, e)
+
+def generate_missing(names):
+    """ writes the missing previews of the stored file names, returns the number of previews written """
+    return sum(generate(name) for name in names)
+
+preview_worker = PreviewWorker(conf()['BACKGROUND'])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from .models import Question, UserAnswer
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ChapterProgress(object):
+    """
+    a user's progress in a chapter: all of the user's chapter answers are fetched in a single query
+    and mapped by (question number, is followup)
+    """
+
+    def __init__(self, chapter, user, questions=None):
+        self.chapter = chapter
+        self.user = user
+        if questions is None:
+            questions = Question._filter(chapter=chapter)
+        self.questions = sorted(questions, key=lambda q: q.number)
+        self.answers = {
+            (ans.question_number, ans.is_followup): ans
+            for ans in UserAnswer.objects.filter(user=user, chapter=chapter) \
+                .select_related('_cq', '_oq', '_fq', '_tq', '_mq', '_dq')
+        }
+        logger.debug('%s: chapter %s progress: %d answers', user, chapter.number, len(self.answers))
+
+    def answer(self, question, is_followup=False):
+        return self.answers.get((question.number, is_followup))
+
+    def is_answered(self, question, is_followup=False):
+        return (question.number, is_followup) in self.answers
+
+    def status(self, question):
+        """ returns whether the question is answered, or 'half' if its followup is not answered yet """
+        if not self.is_answered(question):
+            return False
+        if question.has_followup() and not self.is_answered(question, is_followup=True):
+            return 'half'
+        return True
+
+    def statuses(self):
+        return {q.number: self.status(q) for q in self.questions}
+
+    def first_unanswered(self):
+        for question in self.questions:
+            if not self.is_answered(question):
+                return question
+        # check for unanswered followups
+        for question in self.questions:
+            if self.status(question) == 'half':
+                return question
+
+    def first_question(self):
+        return self.questions[0] if self.questions else None
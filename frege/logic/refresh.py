@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Change detection for the polling of followup pages (see FollowupRefreshView).
+
+A followup page shows the student's answer to its formulation question, and polls to find out whether that
+answer was changed since (e.g. in another tab), so that the page should be reloaded. The answer is kept in the
+cache as a version tag: an etag of the answer formula, computed from the database on the first poll. The tags of
+each user are cached together, and dropped whenever any of the user's formulation answers is saved or deleted
+(which then needs no lookups). So polls are answered from the session and the cache only: the user is taken from
+the session without being fetched, and a poll whose If-None-Match is the current tag gets 304 Not Modified.
+The session is checked once by auth.get_user itself, and the session auth hash it accepted is cached along with
+the tags, which are dropped whenever the user is saved. Later polls of a session with that hash need no lookups,
+while any other session (e.g. logged out by a password change) is checked by get_user again, which flushes it.
+Responses advertise the polling interval in an X-Poll-Interval header, which is longer at peak load (whenever
+posts wait for admission, see admission.py), so that polling backs off when the server is busy.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY, get_user
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import admission
+from .models import UserAnswer
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'CACHE': 'default',
+    'TIMEOUT': 600, # seconds, bounds the staleness of a tag cached by a poll racing with a save
+    'POLL_INTERVAL': 20, # seconds
+    'PEAK_POLL_INTERVAL': 60, # seconds
+}
+
+def conf():
+    return dict(DEFAULTS, **getattr(settings, 'FOLLOWUP_REFRESH', {}))
+
+NO_ANSWER = '"-"'
+AUTH = 'auth' # the session auth hash accepted by auth.get_user in the cached data
+
+def cache_key(user_id):
+    return 'followup-refresh:%s' % user_id
+
+def etag(answer):
+    if answer is None:
+        return NO_ANSWER
+    return '"%s"' % hashlib.sha1(answer.encode('utf-8')).hexdigest()[:16]
+
+def _data(user_id):
+    return caches[conf()['CACHE']].get(cache_key(user_id)) or {}
+
+def _set(user_id, data):
+    c = conf()
+    caches[c['CACHE']].set(cache_key(user_id), data, c['TIMEOUT'])
+
+def _cached(user_id, name, compute):
+    """ returns the user's data of the given name from the cache, or else computes and caches it """
+    data = _data(user_id)
+    if name not in data:
+        data[name] = compute()
+        _set(user_id, data)
+    return data[name]
+
+def session_user_id(request):
+    """ returns the id of the active user logged in to the session of the request, or None """
+    session = request.session
+    user_id, session_hash = session.get(SESSION_KEY), session.get(HASH_SESSION_KEY)
+    if user_id is None or not session_hash:
+        return None
+    data = _data(user_id)
+    if data.get(AUTH) != session_hash:
+        # as of Django 1.9, get_user checks the session backend and auth hash (flushing the session of a stale
+        # hash, e.g. from before a password change) but not is_active
+        user = get_user(request)
+        if not user.is_authenticated() or not user.is_active:
+            return None
+        data[AUTH] = session_hash
+        _set(user_id, data)
+    return user_id
+
+def answer_tag(user_id, chnum, qnum):
+    """ returns the version tag of the answer to the formulation question, from the cache or else the database """
+    def tag():
+        return etag(UserAnswer.objects.filter(
+            user_id=user_id,
+            _fq__number=qnum,
+            chapter__number=chnum,
+            is_followup=False
+        ).values_list('answer', flat=True).first())
+    return _cached(user_id, '%s/%s' % (chnum, qnum), tag)
+
+def poll_interval():
+    c = conf()
+    controller = admission.controller
+    if controller and controller.semaphore.waiting:
+        return c['PEAK_POLL_INTERVAL']
+    return c['POLL_INTERVAL']
+
+def invalidate(user_id):
+    key = cache_key(user_id)
+    cache = caches[conf()['CACHE']]
+    cache.delete(key)
+    # and again once committed, in case a poll cached the answer from before
+    transaction.on_commit(lambda: cache.delete(key))
+
+@receiver(post_save, sender=UserAnswer)
+@receiver(post_delete, sender=UserAnswer)
+def answer_changed(instance, **kwargs):
+    if instance.is_followup or not instance._fq_id:
+        return
+    invalidate(instance.user_id)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(instance, **kwargs):
+    # e.g. a password change, which logs out the user's other sessions
+    invalidate(instance.id)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered (write-behind) creation of answer stats.
+
+Stats are queued once the answer transaction commits and written in batches with bulk_create by a
+background thread, so that they are not written inside the student's answer transaction.
+When a journal directory is set, queued stats are also appended to a per-process journal file,
+which is replayed on startup if the process that wrote it died before flushing (stats may then be
+written twice, but are never lost). The journal is synced to disk once per flush, not once per stat.
+Stats that fail to be written because the database is locked are requeued, and stay in the journal until
+written. Stats that fail for any other reason (e.g. a bad row) are requeued up to MAX_RETRIES times, and then
+dropped, to a dead-letter file in the journal directory, so that they do not block the stats that follow.
+"""
+import atexit
+import errno
+import glob
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+from .db import write_transaction
+from .models import ChapterStats, ChapterSubmission, Stat, UserAnswer
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH_SIZE': 50,
+    'FLUSH_INTERVAL': 2, # seconds, None for no background flushing
+    'JOURNAL_DIR': None, # None to disable journaling
+    'MAX_RETRIES': 3, # flushes failing other than by a locked database
+}
+
+FAILED_JOURNAL = 'failed-stats.journal'
+
+class StatBuffer(object):
+
+    def __init__(self, batch_size=50, flush_interval=2, journal_dir=None, max_retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_dir = journal_dir
+        self.max_retries = max_retries
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.items = []
+        self.journal = None
+        self.journal_synced = True
+        self.started = False
+        self.wakeup = threading.Event()
+
+    def add(self, user_answer, correct):
+        """ queues a stat for the user answer, once the current transaction commits """
+        item = (user_answer.id, bool(correct))
+        transaction.on_commit(lambda: self._enqueue(item))
+
+    def _enqueue(self, item):
+        self._start()
+        with self.lock:
+            self.items.append(item)
+            if self.journal:
+                # flushed, so that it survives the process, and synced to disk by the next flush
+                self.journal.write('%s\n' % json.dumps(item))
+                self.journal.flush()
+                self.journal_synced = False
+            full = len(self.items) >= self.batch_size
+        if full:
+            if self.flush_interval:
+                self.wakeup.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        """ writes all queued stats, returns the number of stats written """
+        with self.flush_lock:
+            with self.lock:
+                items, self.items = self.items, []
+                self._sync_journal()
+            if not items:
+                return 0
+            try:
+                self._write(items)
+            except OperationalError, e:
+                # the database is locked (after the retries of write_transaction), retried by the next flush
+                logger.warning('failed writing %d stats, requeueing: %s', len(items), e)
+                self._requeue(items)
+                return 0
+            except Exception, e:
+                self.failures += 1
+                if self.failures < self.max_retries:
+                    logger.exception('failed writing %d stats (%d/%d), requeueing: %s', len(items), self.failures, self.max_retries, e)
+                    self._requeue(items)
+                    return 0
+                logger.exception('failed writing %d stats %d times, dropping them: %s', len(items), self.failures, e)
+                self._drop(items)
+                written = 0
+            else:
+                written = len(items)
+            self.failures = 0
+            with self.lock:
+                self._truncate_journal()
+            return written
+
+    def _requeue(self, items):
+        with self.lock:
+            self.items = items + self.items
+
+    def _drop(self, items):
+        if not self.journal_dir:
+            logger.error('dropped stats: %s', items)
+            return
+        path = os.path.join(self.journal_dir, FAILED_JOURNAL)
+        with open(path, 'a') as f:
+            for item in items:
+                f.write('%s\n' % json.dumps(item))
+        logger.error('dropped %d stats to %s', len(items), path)
+
+    @write_transaction
+    def _write(self, items):
+        for i in range(0, len(items), self.batch_size):
+            self._write_batch(items[i:i+self.batch_size])
+        logger.debug('wrote %d stats', len(items))
+
+    def _write_batch(self, items):
+        # answers may have been deleted since (e.g. a followup answer when its question is re-answered)
+        existing = set(UserAnswer.objects.filter(id__in=set(ans_id for ans_id, _ in items)).values_list('id', flat=True))
+        Stat.objects.bulk_create([
+            Stat(user_answer_id=ans_id, correct=correct) for ans_id, correct in items if ans_id in existing
+        ])
+        # bulk_create sends no signals, so update the aggregate stats here
+        submissions = ChapterSubmission.objects \
+            .filter(useranswer__id__in=existing) \
+            .distinct() \
+            .select_related('chapter')
+        for submission in submissions:
+            ChapterStats.update_submission(submission)
+
+    def _start(self):
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            if self.journal_dir:
+                self._replay_journals()
+                self.journal = open(self._journal_path(os.getpid()), 'a')
+                self._truncate_journal() # journal the replayed items
+            atexit.register(self.flush)
+            if self.flush_interval:
+                thread = threading.Thread(target=self._run, name='stat-buffer')
+                thread.daemon = True
+                thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception, e:
+                logger.exception('unexpected error flushing stats: %s', e)
+            finally:
+                connection.close()
+
+    def _journal_path(self, pid):
+        return os.path.join(self.journal_dir, 'stats-%s.journal' % pid)
+
+    def _sync_journal(self):
+        if self.journal and not self.journal_synced:
+            os.fsync(self.journal.fileno())
+            self.journal_synced = True
+
+    def _truncate_journal(self):
+        if self.journal:
+            # rewrite the journal with the items that are still queued
+            self.journal.seek(0)
+            self.journal.truncate()
+            for item in self.items:
+                self.journal.write('%s\n' % json.dumps(item))
+            self.journal.flush()
+
+    def _replay_journals(self):
+        """ queues the stats of journals left by dead processes """
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        for path in glob.glob(self._journal_path('*')):
+            pid = int(os.path.basename(path).split('-')[1].split('.')[0])
+            if pid != os.getpid() and _is_alive(pid):
+                continue
+            claimed = '%s.replay' % path
+            try:
+                os.rename(path, claimed) # so that only one process replays it
+            except OSError:
+                continue
+            with open(claimed) as f:
+                items = [tuple(json.loads(line)) for line in f if line.strip()]
+            logger.warning('replaying %d stats from %s', len(items), path)
+            self.items.extend(items)
+            os.remove(claimed)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def _create_buffer():
+    conf = dict(DEFAULTS, **getattr(settings, 'STAT_BUFFER', {}))
+    return StatBuffer(conf['BATCH_SIZE'], conf['FLUSH_INTERVAL'], conf['JOURNAL_DIR'], conf['MAX_RETRIES'])
+
+stat_buffer = _create_buffer()
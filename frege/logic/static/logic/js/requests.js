@@ -2,8 +2,31 @@
  * functions for handling question-related server requests
  */
 
+// a post rejected because the server is busy (see admission.py) is posted again after the seconds
+// the server asks to wait, with jitter and doubling on each retry, up to MAX_BUSY_RETRIES times.
+// returns whether the post will be retried
+var MAX_BUSY_RETRIES = 3;
+
+function busyRetry(response, attempt, retry) {
+    var data = response.responseJSON;
+    if ((response.status != 429 && response.status != 503) || !data || !data['retry']) {
+        return false;
+    }
+    if (attempt >= MAX_BUSY_RETRIES) {
+        errmsg(data['msg']);
+        return false;
+    }
+    var delay = data['retry'] * 1000 * Math.pow(2, attempt) * (1 + Math.random());
+    setTimeout(function() { retry(attempt + 1); }, delay);
+    return true;
+}
+
+function isBusy(response) {
+    return response.status == 429 || response.status == 503;
+}
+
 // general post function
-function post(url, csrf, postData, onSuccess) {
+function post(url, csrf, postData, onSuccess, attempt) {
     if (!postData) {
         postData = {};
     }
@@ -16,21 +39,43 @@ function post(url, csrf, postData, onSuccess) {
         }
     })
     .fail(function(response) {
-        errhandler(response);
+        var retry = function(next) { post(url, csrf, postData, onSuccess, next); };
+        if (!busyRetry(response, attempt || 0, retry) && !isBusy(response)) {
+            errhandler(response);
+        }
     });
 }
 
-function sbt(url, csrf) {
+function sbt(url, csrf, attempt) {
     $.post(url, {'csrfmiddlewaretoken':csrf}, function(data, status) {
         if (data['next']) window.location.assign(data['next']);
         else errmsg('עברת את מספר הנסיונות המירבי לפרק זה');
     })
     .fail(function(response) {
-        errhandler(response);
+        var retry = function(next) { sbt(url, csrf, next); };
+        if (!busyRetry(response, attempt || 0, retry) && !isBusy(response)) {
+            errhandler(response);
+        }
     });
 }
 
-function ans(url, csrf) {
+// idempotency key of the posted answer: posting the same answer again (a double click, or a retry
+// after an error) reuses the key, so that the server answers it from its cache instead of saving it again.
+// file uploads cannot be compared, so their key is only reused while the previous post is pending
+var ansKey = null;
+var ansKeyData = null;
+var ansPending = false;
+
+function answerKey(data) {
+    var keyData = (data instanceof FormData) ? null : $.param(data);
+    if (!ansKey || (keyData === null ? !ansPending : keyData !== ansKeyData)) {
+        ansKey = Date.now().toString(36) + Math.random().toString(36).substr(2);
+    }
+    ansKeyData = keyData;
+    return ansKey;
+}
+
+function ans(url, csrf, attempt) {
     var emptyMsg = isEmpty();
     if (emptyMsg) {
         errmsg(emptyMsg);
@@ -44,8 +89,10 @@ function ans(url, csrf) {
         url: url,
         type: 'POST',
         data: data,
+        headers: {'X-Idempotency-Key': answerKey(data)},
         success: ansDone(btn),
     };
+    ansPending = true;
     if (data instanceof FormData) {
         ajaxkw.processData = false;
         ajaxkw.contentType = false;
@@ -65,8 +112,16 @@ function ans(url, csrf) {
     } else {
         data['csrfmiddlewaretoken'] = csrf;
     }
-    $.ajax(ajaxkw).fail(function(response){
-        errhandler(response);
+    $.ajax(ajaxkw).always(function() {
+        ansPending = false;
+    }).fail(function(response){
+        var retry = function(next) { ans(url, csrf, next); };
+        if (busyRetry(response, attempt || 0, retry)) {
+            return;
+        }
+        if (!isBusy(response)) {
+            errhandler(response);
+        }
         btn.html("אישור");
         reg();
     });
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic course data for load and scale tests.
+
+seed() creates chapters with every question type and users with profiles. the synthetic chapters
+are numbered from FIRST_CHAPTER, each with a second part for its open question (open questions
+cannot be in a chapter with other questions), and the synthetic usernames start with USER_PREFIX,
+so that they can be removed with clear(). synthetic data is only written to a database of its own
+(settings.SYNTHETIC_DATA, see frege/synthetic_settings.py), since clear() would also remove real
+chapters and users numbered or named as synthetic ones. answer() makes the post data of an answer to a question, as the
+question pages send it.
+
+generate_semester() fills the synthetic chapters with a reproducible semester of submissions,
+answers, stats and open answers for thousands of users, written with bulk inserts.
+"""
+import itertools
+import random
+
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from .formula import (
+    CON,
+    DIS,
+    IMP,
+    Argument,
+    Formula,
+    FormulaSet,
+    MultiTruthTable,
+    PredicateFormula,
+    get_argument,
+)
+from .models import (
+    Chapter,
+    ChapterStats,
+    ChapterSubmission,
+    Choice,
+    ChoiceQuestion,
+    DeductionQuestion,
+    FormulationAnswer,
+    FormulationQuestion,
+    GlobalSettings,
+    MAX_ANSWER_STATS,
+    ModelQuestion,
+    OpenAnswer,
+    OpenQuestion,
+    Stat,
+    TruthTableQuestion,
+    UserAnswer,
+    UserProfile,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+FIRST_CHAPTER = 90
+USER_PREFIX = 'synthetic'
+PASSWORD = 'synthetic'
+
+# formulation answers, the correct one is also the formula of the deduction followup
+FORMULATION_CORRECT = u'p%sq∴p' % CON
+FORMULATION_WRONG = u'p%sq∴p' % DIS
+
+def check_database():
+    """ raises ImproperlyConfigured unless the database is for synthetic data """
+    if not getattr(settings, 'SYNTHETIC_DATA', False):
+        raise ImproperlyConfigured(
+            'synthetic data is only written to a database of its own, e.g. with --settings=frege.synthetic_settings'
+        )
+
+def chapters(num_chapters=None):
+    """ the chapters and parts of the first num_chapters synthetic chapters (default: all) """
+    chapters = Chapter.objects.filter(number__gte=FIRST_CHAPTER)
+    if num_chapters is not None:
+        chapters = chapters.filter(number__lt=FIRST_CHAPTER + num_chapters)
+    return chapters.order_by('number')
+
+def users():
+    return User.objects.filter(username__startswith=USER_PREFIX).order_by('id')
+
+def username(i):
+    return '%s%d' % (USER_PREFIX, i)
+
+@transaction.atomic
+def seed(num_users, num_chapters):
+    """ creates the synthetic chapters and users that do not exist yet """
+    check_database()
+    if not GlobalSettings.objects.exists():
+        GlobalSettings.objects.create(ldap_enabled=False)
+    for i in range(num_chapters):
+        number = FIRST_CHAPTER + i
+        if not Chapter.objects.filter(number=number).exists():
+            _create_chapter(number)
+    group = GlobalSettings.get().course_id[-2:]
+    _create_users({i: group for i in range(num_users)})
+    logger.info('seeded %d synthetic users and %d chapters', num_users, num_chapters)
+
+def _create_users(groups, batch_size=None):
+    """ creates the synthetic users that do not exist yet, groups is a dict of user index -> group """
+    existing = set(users().values_list('username', flat=True))
+    new = [i for i in sorted(groups) if username(i) not in existing]
+    password = make_password(PASSWORD) # hashing is slow, so all users get the same hash
+    User.objects.bulk_create([User(username=username(i), password=password) for i in new], batch_size)
+    user_ids = dict(users().values_list('username', 'id'))
+    UserProfile.objects.bulk_create([
+        UserProfile(user_id=user_ids[username(i)], group=groups[i], id_num='%09d' % i)
+        for i in new
+    ], batch_size)
+
+def _create_chapter(number):
+    chapter = Chapter.objects.create(number=number, title='synthetic %d' % number)
+    choice = ChoiceQuestion.objects.create(chapter=chapter, number=1, text='which is correct?')
+    for i in range(3):
+        Choice.objects.create(question=choice, text='choice %d' % i, is_correct=(i == 0))
+    formulation = FormulationQuestion.objects.create(
+        chapter=chapter, number=2, text='formalize', followup=FormulationQuestion.DEDUCTION,
+    )
+    FormulationAnswer.objects.create(question=formulation, formula=FORMULATION_CORRECT)
+    TruthTableQuestion.objects.create(chapter=chapter, number=3, formula=u'(p%sq)%sr' % (DIS, IMP))
+    ModelQuestion.objects.create(chapter=chapter, number=4, formula=u'Pa%sQb' % CON)
+    DeductionQuestion.objects.create(chapter=chapter, number=5, formula=u'p%sq∴q' % CON)
+    open_chapter = Chapter.objects.create(number=number + 0.1, title='synthetic %d open' % number)
+    OpenQuestion.objects.create(chapter=open_chapter, number=1, text='explain')
+
+def seed_staff(name):
+    """ creates a synthetic staff user, e.g. for reading the performance stats """
+    check_database()
+    user = users().filter(username=name).first()
+    if not user:
+        user = User.objects.create_user(name, password=PASSWORD, is_staff=True)
+        UserProfile.objects.create(user=user, group=GlobalSettings.get().course_id[-2:], id_num='0' * 9)
+    return user
+
+@transaction.atomic
+def clear():
+    """ removes all synthetic data """
+    check_database()
+    users().delete()
+    for chapter in chapters():
+        chapter.delete()
+
+def answer(question, correct=True):
+    """ returns the post data of a correct or a wrong answer to the question """
+    if type(question) == ChoiceQuestion:
+        choices = list(question.choice_set.all())
+        choice = next((c for c in choices if c.is_correct == correct), random.choice(choices))
+        return {'choice': choice.id}
+    if type(question) == FormulationQuestion:
+        return {'formulation': FORMULATION_CORRECT if correct else FORMULATION_WRONG}
+    if type(question) == TruthTableQuestion:
+        return _truth_table_answer(question, correct)
+    if type(question) == ModelQuestion:
+        return _model_answer(question, correct)
+    if type(question) == DeductionQuestion:
+        return _deduction_answer(question.formula, correct)
+    if type(question) == OpenQuestion:
+        return {'anstxt': 'synthetic answer to question %d' % question.number}
+    raise ValueError('unknown question type: %s' % type(question))
+
+def stored_answer(question, correct=True):
+    """ returns a correct or a wrong answer to the question, as the question view stores it """
+    data = answer(question, correct)
+    if type(question) == ChoiceQuestion:
+        return str(data['choice'])
+    if type(question) == FormulationQuestion:
+        return data['formulation']
+    if type(question) == TruthTableQuestion:
+        values = [data['values[%d][]' % i] for i in range(len(data) - 2)]
+        return '%s#%s' % (values, data['option'])
+    if type(question) == ModelQuestion:
+        return str({k: tuple(s for s in v.split(',') if s) for k, v in data.iteritems()})
+    if type(question) == DeductionQuestion:
+        return data['obj']
+    return '/%s' % data['anstxt']
+
+def followup_answer(formulation, correct=True):
+    """ returns the post data of an answer to the deduction followup of the formulation answer """
+    return _deduction_answer(formulation, correct)
+
+def _deduction_answer(formula, correct):
+    argument = get_argument(formula)
+    conclusion = unicode(argument.conclusion) if correct else u'~%s' % argument.conclusion
+    return {'formula': formula, 'conclusion': conclusion, 'obj': ''}
+
+def _truth_table_answer(question, correct):
+    if question.is_formula:
+        formulas = [Formula(question.formula)]
+        option = formulas[0].correct_option.num
+    elif question.is_set:
+        formulas = FormulaSet(question.formula)
+        option = formulas.correct_option.num
+    else:
+        formulas = Argument(question.formula)
+        option = formulas.correct_option.num
+    values = [['T' if v else 'F' for v in result] for result in MultiTruthTable(formulas).result]
+    if not correct:
+        values[0][0] = 'F' if values[0][0] == 'T' else 'T'
+    data = {'values[%d][]' % i: v for i, v in enumerate(values)}
+    data.update({'formula': question.formula, 'option': option})
+    return data
+
+def _model_answer(question, correct):
+    """ searches for a model over a domain of one object, assuming a formula with unary predicates """
+    formula = PredicateFormula(question.formula)
+    predicates = sorted(formula.predicates)
+    constants = sorted(formula.constants)
+    data = None
+    for extensions in itertools.product(['', '1'], repeat=len(predicates)):
+        data = dict(zip(predicates, extensions), domain='1', **{c: '1' for c in constants})
+        assignment = {k: tuple(s for s in v.split(',') if s) for k, v in data.iteritems()}
+        if (formula.assign(assignment) == False) == correct:
+            break
+    return data
+
+##############################################################################################
+# semester generation
+
+ANSWER_FIELDS = ('_cq', '_oq', '_fq', '_tq', '_mq', '_dq') # in the order of UserAnswer._all_q
+
+class _ChapterPlan(object):
+    """ a synthetic chapter with the difficulty of each question and the answers to store """
+
+    def __init__(self, chapter, deadline, rng):
+        self.chapter = chapter
+        self.deadline = deadline
+        self.is_open = chapter.is_open()
+        self.max_attempts = ChapterSubmission(chapter=chapter).max_attempts
+        self.num_questions = chapter.num_questions(followups=True)
+        self.questions = []
+        for q in sorted(chapter.questions(), key=lambda q: q.number):
+            field = UserAnswer.get_kw(q).keys()[0]
+            self.questions.append({
+                'question': q,
+                'field': field,
+                'key': tuple(q.id if f == field else None for f in ANSWER_FIELDS),
+                'difficulty': rng.uniform(-0.2, 0.2),
+                'answers': {correct: stored_answer(q, correct) for correct in (True, False)},
+                'followup': q.has_followup(),
+            })
+
+def _stats(rng, p):
+    """ returns the correctness of each try of a user answering with probability p of being correct """
+    stats = []
+    while len(stats) < MAX_ANSWER_STATS:
+        stats.append(rng.random() < p)
+        if stats[-1] or rng.random() < 0.4: # correct, or gave up
+            break
+    return stats
+
+def _simulate(rng, plan, ability):
+    """
+    simulates a user answering a chapter, returns the submission fields and the answers, each a
+    (question, is followup, correctness of each try, open answer grade or None, time)
+    """
+    ongoing = rng.random() < 0.05
+    attempt = 0 if ongoing else min(plan.max_attempts, 1 + int(rng.expovariate(3 * ability)))
+    questions = plan.questions
+    if ongoing:
+        questions = questions[:rng.randint(0, len(questions))]
+    answers = []
+    for q in questions:
+        time = plan.deadline - timedelta(seconds=rng.uniform(3600, 7 * 24 * 3600))
+        if plan.is_open:
+            grade = None
+            if rng.random() < 0.85: # checked
+                grade = Decimal('%.1f' % min(1, max(0, rng.gauss(ability, 0.2))))
+            answers.append((q, False, [False], grade, time))
+            continue
+        p = min(0.98, max(0.05, ability - q['difficulty']))
+        answers.append((q, False, _stats(rng, p), None, time))
+        if q['followup']:
+            answers.append((q, True, _stats(rng, p), None, time + timedelta(seconds=rng.uniform(10, 600))))
+
+    # grade and readiness, as ChapterSubmission.update_grade calculates them
+    complete = len(questions) == len(plan.questions)
+    if plan.is_open:
+        checked = complete and all(grade is not None for _, _, _, grade, _ in answers)
+        num_correct = sum(float(grade) for _, _, _, grade, _ in answers) if checked else 0
+        ready = attempt > 0 and checked
+    else:
+        num_correct = sum(1 for _, _, stats, _, _ in answers if stats[-1])
+        ready = attempt > 0
+    submission = {
+        'attempt': attempt,
+        'ongoing': ongoing,
+        'time': max(a[4] for a in answers) + timedelta(seconds=rng.uniform(60, 24 * 3600)) if attempt and answers else None,
+        'grade': int(round(num_correct * 100. / plan.num_questions)) if attempt else None,
+        'ready': ready,
+    }
+    return submission, answers
+
+def generate_semester(num_users, num_chapters, random_seed=0, batch_size=None, chunk_size=500):
+    """
+    replaces the synthetic data with a semester of num_users users, in random groups, answering
+    num_chapters chapters (and their open parts). each user has an ability and each question a
+    difficulty, which determine the correctness of the answers, the number of tries and attempts.
+    the same random seed generates the same semester. rows are inserted in batches of batch_size
+    (default: as many as the database allows). returns the number of objects created per model
+    """
+    check_database()
+    rng = random.Random(random_seed)
+    clear()
+    seed(0, num_chapters)
+    global_settings = GlobalSettings.get()
+    groups = ['%02d' % i for i in range(2, int(global_settings.max_group_id) + 1)] or [global_settings.course_id[-2:]]
+    _create_users({i: rng.choice(groups) for i in range(num_users)}, batch_size)
+    user_ids = dict(users().values_list('username', 'id'))
+    chapter_list = list(chapters(num_chapters))
+    start = timezone.now() - timedelta(weeks=len(chapter_list) + 1)
+    plans = [
+        _ChapterPlan(chapter, start + timedelta(weeks=i + 1), rng)
+        for i, chapter in enumerate(chapter_list)
+    ]
+    counts = {'users': num_users, 'submissions': 0, 'answers': 0, 'stats': 0, 'open answers': 0}
+    for chunk_start in range(0, num_users, chunk_size):
+        students = [
+            (user_ids[username(i)], rng.betavariate(5, 2))
+            for i in range(chunk_start, min(num_users, chunk_start + chunk_size))
+        ]
+        with transaction.atomic():
+            _generate_chunk(rng, plans, students, batch_size, counts)
+        logger.info('generated %d/%d users', chunk_start + len(students), num_users)
+    with transaction.atomic():
+        ChapterStats.rebuild()
+    return counts
+
+def _generate_chunk(rng, plans, students, batch_size, counts):
+    simulated = {} # (user id, chapter id) -> (submission fields, answers)
+    for user_id, ability in students:
+        for i, plan in enumerate(plans):
+            if rng.random() < 0.03 * i: # dropped out
+                continue
+            simulated[user_id, plan.chapter.id] = plan, _simulate(rng, plan, ability)
+
+    ChapterSubmission.objects.bulk_create([
+        ChapterSubmission(user_id=user_id, chapter_id=chapter_id, **fields)
+        for (user_id, chapter_id), (_, (fields, _)) in sorted(simulated.iteritems())
+    ], batch_size)
+    submission_ids = {
+        (user_id, chapter_id): sub_id
+        for sub_id, user_id, chapter_id in ChapterSubmission.objects.filter(
+            user_id__in=[user_id for user_id, _ in students]
+        ).values_list('id', 'user_id', 'chapter_id')
+    }
+
+    user_answers = []
+    for (user_id, chapter_id), (plan, (_, answers)) in sorted(simulated.iteritems()):
+        for q, is_followup, stats, grade, time in answers:
+            user_answers.append(UserAnswer(
+                user_id=user_id,
+                chapter_id=chapter_id,
+                submission_id=submission_ids[user_id, chapter_id],
+                is_followup=is_followup,
+                correct=stats[-1],
+                answer='' if is_followup else q['answers'][stats[-1]],
+                time=time,
+                attempts=len(stats),
+                **{q['field']: q['question']}
+            ))
+    UserAnswer.objects.bulk_create(user_answers, batch_size)
+    answer_ids = {
+        (row[1], row[2], row[3:]): row[0]
+        for row in UserAnswer.objects.filter(submission_id__in=submission_ids.values())
+            .values_list('id', 'submission_id', 'is_followup', *[f + '_id' for f in ANSWER_FIELDS])
+    }
+
+    stats_objs = []
+    open_answers = []
+    for (user_id, chapter_id), (plan, (_, answers)) in sorted(simulated.iteritems()):
+        sub_id = submission_ids[user_id, chapter_id]
+        for q, is_followup, stats, grade, time in answers:
+            ans_id = answer_ids[sub_id, is_followup, q['key']]
+            stats_objs.extend(Stat(user_answer_id=ans_id, correct=correct) for correct in stats)
+            if plan.is_open:
+                open_answers.append(OpenAnswer(
+                    question=q['question'],
+                    user_answer_id=ans_id,
+                    text=q['answers'][False][1:],
+                    grade=grade,
+                ))
+    Stat.objects.bulk_create(stats_objs, batch_size)
+    OpenAnswer.objects.bulk_create(open_answers, batch_size)
+
+    counts['submissions'] += len(simulated)
+    counts['answers'] += len(user_answers)
+    counts['stats'] += len(stats_objs)
+    counts['open answers'] += len(open_answers)
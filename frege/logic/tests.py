@@ -1,13 +1,46 @@
 # -*- coding: utf-8 -*-
+import Queue
+import csv
+import hashlib
 import json
-
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from decimal import Decimal
+from StringIO import StringIO
 from itertools import groupby
+from unittest import skipUnless
+
+import ldap
 
+from django.conf.urls import include, url
+from django.contrib import admin
+from django.contrib.auth import SESSION_KEY
 from django.contrib.auth.models import User
-from django.core.exceptions import ValidationError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.db.utils import OperationalError
+from django.http import HttpResponse
+from django.test import Client, LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from frege import auth_ldap
+from frege.ldap_client import LDAPClient, TTLCache
+from frege.logs import FallbackSocketHandler, LogServer, QueueHandler, QueueListener, sampled
 
 from .formula import (
     Formula,
@@ -31,6 +64,8 @@ from .formula import (
 
 from .models import (
     Chapter,
+    ChapterIndex,
+    DataVersion,
     Question,
     ChoiceQuestion,
     Choice,
@@ -42,9 +77,25 @@ from .models import (
     DeductionQuestion,
     UserAnswer,
     OpenAnswer,
+    StoredFile,
     ChapterSubmission,
     GlobalSettings,
+    UserProfile,
+    RosterGroup,
+    Stat,
+    ChapterStats,
+    ChapterStatsCount,
+    QuestionStats,
+    stored_file_name,
 )
+from . import admission, benchmark, db, idempotency, media, perf, previews, refresh, synthetic
+from .loadtest import LoadTest, percentile
+from .actions import csv_rows
+from .admin import UserAnswerAdmin
+from .db import counters, snapshot_age, snapshot_alias, take_snapshot, write_transaction
+from .progress import ChapterProgress
+from .stat_buffer import StatBuffer, stat_buffer
+from .views import next_question
 
 Question.CLEAN_CHECK_ANSWERS = False
 
@@ -97,6 +148,120 @@ class IndexViewTests(TestCase):
         response = self.client.get(reverse('logic:index'))
         self._assertHas(response, chapters)
 
+class ChapterIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        login(self)
+
+    def _create_chapters(self, start, num):
+        for i in range(start, start + num):
+            chapter = Chapter.objects.create(title='chapternum%d' % i, number=i)
+            part = Chapter.objects.create(title='partnum%d' % i, number=i + 0.1)
+            TruthTableQuestion.objects.create(chapter=chapter, number=1, formula='p')
+            OpenQuestion.objects.create(chapter=part, number=1, text='hi?')
+
+    def _num_queries(self, url):
+        self.client.get(url) # build the index
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(queries)
+
+    def test_index_queries(self):
+        self._create_chapters(1, 2)
+        few = self._num_queries(reverse('logic:index'))
+        self._create_chapters(3, 10)
+        many = self._num_queries(reverse('logic:index'))
+        self.assertEquals(few, many)
+
+    def test_data(self):
+        self._create_chapters(1, 1)
+        chapter = Chapter.objects.get(number=1)
+        FormulationQuestion.objects.create(chapter=chapter, number=2, text='hi?', followup=FormulationQuestion.DEDUCTION)
+        FormulationQuestion.objects.create(chapter=chapter, number=3, text='hi?')
+        index = ChapterIndex.get()
+        self.assertEquals([ch.number for ch in index.chapter_parts('1.0')], [1, Decimal('1.1')])
+        self.assertEquals(index.chapter('1.1').title, 'partnum1')
+        self.assertIsNone(index.chapter('2.0'))
+        self.assertEquals(chapter.num_questions(), 3)
+        self.assertEquals(chapter.num_questions(followups=True), 4)
+        self.assertFalse(chapter.is_open())
+        self.assertTrue(index.chapter('1.1').is_open())
+        self.assertTrue(chapter.has_parts())
+        TruthTableQuestion.objects.get(chapter=chapter).delete()
+        self.assertEquals(chapter.num_questions(), 2)
+
+    def test_parts_view(self):
+        self._create_chapters(1, 1)
+        response = self.client.get(reverse('logic:chapter-parts', args=('1.0',)))
+        self.assertEquals([ch.title for ch in response.context['chapter_list']], ['chapternum1', 'partnum1'])
+        response = self.client.get(reverse('logic:chapter-parts', args=('2.0',)))
+        self.assertEquals(response.status_code, 404)
+
+    def test_other_process_change(self):
+        self._create_chapters(1, 1)
+        index = ChapterIndex.get()
+        # as if changed by another process
+        Chapter.objects.filter(number=1).update(title='changed')
+        DataVersion.increment(ChapterIndex.VERSION)
+        self.assertIs(ChapterIndex.get(), index)
+        ChapterIndex.expire()
+        self.assertEquals(ChapterIndex.get().chapter('1.0').title, 'changed')
+        response = self.client.get(reverse('logic:index'))
+        self.assertContains(response, 'changed')
+
+    def test_question_change(self):
+        self._create_chapters(1, 2)
+        chapter1, chapter2 = Chapter.objects.get(number=1), Chapter.objects.get(number=2)
+        index = ChapterIndex.get()
+        question = ModelQuestion.objects.create(chapter=chapter1, formula='Pa', number=2)
+        versions = DataVersion.versions(ChapterIndex.VERSION)
+        self.assertEquals(versions[ChapterIndex.chapter_version(chapter1.id)], 2)
+        self.assertEquals(versions[ChapterIndex.chapter_version(chapter2.id)], 1)
+        # only the changed chapter is rebuilt
+        with CaptureQueriesContext(connection) as queries:
+            rebuilt = ChapterIndex.get()
+        self.assertEquals(len(queries), 7) # the versions, and a query per question type
+        self.assertIs(rebuilt.chapters, index.chapters)
+        self.assertEquals(chapter1.num_questions(), 2)
+        self.assertEquals(chapter2.num_questions(), 1)
+        # a moved question changes both chapters
+        question.chapter = chapter2
+        question.save()
+        self.assertEquals(chapter1.num_questions(), 1)
+        self.assertEquals(chapter2.num_questions(), 2)
+
+    def test_background_rebuild(self):
+        self._create_chapters(1, 1)
+        chapter = Chapter.objects.get(number=1)
+        index = ChapterIndex.get()
+        # as if added by another process
+        TruthTableQuestion.objects.bulk_create([TruthTableQuestion(chapter=chapter, number=2, formula='q')])
+        DataVersion.increment(ChapterIndex.chapter_version(chapter.id))
+        ChapterIndex.expire()
+        # test data is not visible to other threads, so the rebuild is run here
+        rebuilds = []
+        rebuild = ChapterIndex.__dict__['_rebuild']
+        ChapterIndex._rebuild = classmethod(lambda cls, *args: rebuilds.append(args))
+        background, ChapterIndex.BACKGROUND = ChapterIndex.BACKGROUND, True
+        try:
+            self.assertIs(ChapterIndex.get(), index)
+            ChapterIndex.rebuild_thread.join()
+        finally:
+            ChapterIndex.BACKGROUND = background
+            ChapterIndex._rebuild = rebuild
+        self.assertEquals(len(rebuilds), 1)
+        _, previous, chapter_ids = rebuilds[0]
+        self.assertIs(previous, index)
+        self.assertEquals(chapter_ids, {chapter.id})
+        ChapterIndex._refresh(*rebuilds[0])
+        self.assertIsNot(ChapterIndex.get(), index)
+        self.assertEquals(chapter.num_questions(), 2)
+
 class QuestionViewTests(TestCase):
  
     @classmethod
@@ -197,6 +362,16 @@ class QuestionViewTests(TestCase):
             self.assertEquals(q.user_answers().first().correct, is_correct)
         self.assertEquals(len(ChapterSubmission.objects.filter(chapter=self.chapter,user=self.user)), 1)
 
+    def test_answer_attempts(self):
+        q, choices = self._create_choice_question(num_choices=3)
+        self._post_choice(q, choices[0])
+        self.assertEquals(q.user_answer(self.user).attempts, 1)
+        self._post_choice(q, choices[0]) # not changed
+        self.assertEquals(q.user_answer(self.user).attempts, 1)
+        for choice in choices * 2:
+            self._post_choice(q, choice)
+        self.assertEquals(q.user_answer(self.user).attempts, 4)
+
     def test_chapter_submission(self):
         # create questions
         q1, choices1 = self._create_choice_question(number=1, num_choices=3)
@@ -391,6 +566,58 @@ class ChapterTests(TestCase):
         DeductionQuestion.objects.create(chapter=chapter, formula=u'p%sq∴p'%CON, number=2)
         self.assertFalse(chapter.is_open())
 
+class RenumberTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.chapter = Chapter.objects.create(title='ch', number=1.0)
+        for i in range(1, 41):
+            if i % 2:
+                ChoiceQuestion.objects.create(chapter=self.chapter, number=i, text='choice %d' % i)
+            else:
+                FormulationQuestion.objects.create(chapter=self.chapter, number=i, text='formulation %d' % i)
+
+    def _numbers(self):
+        return sorted((type(q).__name__, q.id, q.number) for q in self.chapter.questions())
+
+    def test_renumber(self):
+        before = {(type(q), q.id): q.number for q in self.chapter.questions()}
+        with CaptureQueriesContext(connection) as queries:
+            changed = self.chapter.renumber_questions({i: 41 - i for i in range(1, 41)})
+        self.assertEquals(len(changed), 40)
+        # questions of each type, the 2 updates and the chapter version
+        self.assertLessEqual(len(queries), 12)
+        for q in self.chapter.questions():
+            self.assertEquals(q.number, 41 - before[type(q), q.id])
+
+    def test_renumber_duplicate(self):
+        before = self._numbers()
+        with self.assertRaises(ValidationError):
+            self.chapter.renumber_questions({1: 2})
+        with self.assertRaises(ValidationError):
+            self.chapter.renumber_questions({41: 1})
+        self.assertEquals(self._numbers(), before)
+
+    def test_reorder_on_delete(self):
+        Question._get(chapter=self.chapter, number=2).delete()
+        Question._get(chapter=self.chapter, number=10).delete()
+        self.assertEquals(sorted(q.number for q in self.chapter.questions()), range(1, 39))
+
+    def test_admin_view(self):
+        login(self)
+        first, second = Question._get(chapter=self.chapter, number=1), Question._get(chapter=self.chapter, number=2)
+        url = reverse('admin:chapter-questions', args=(self.chapter.chnum,))
+        response = self.client.post(url, {'qdata': 'q1:2,q2:1,q3:3'})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('error', response.context)
+        self.assertTrue(Question._get(chapter=self.chapter, number=2).is_same(first))
+        self.assertTrue(Question._get(chapter=self.chapter, number=1).is_same(second))
+        response = self.client.post(url, {'qdata': 'q1:3'})
+        self.assertIn('error', response.context)
+
 class ChapterSubmissionTests(TestCase):
 
     @classmethod
@@ -419,6 +646,37 @@ class ChapterSubmissionTests(TestCase):
         ua2.save()
         self.assertEquals(cs.percent_correct(), 100)
 
+    def test_save_with_pk(self):
+        user = User.objects.create(username='u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        ChapterSubmission(pk=100, chapter=chapter, user=user, attempt=0, ongoing=False).save()
+        self.assertTrue(ChapterSubmission.objects.filter(pk=100).exists())
+
+    def test_failed_delete(self):
+        user = User.objects.create(username='u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        q1 = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=1)
+        q2 = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=2)
+        cs = self.create_submission(chapter, user)
+        create_user_answer(q=q1, chapter=chapter, user=user, submission=cs, correct=True)
+        ua2 = create_user_answer(q=q2, chapter=chapter, user=user, submission=cs, correct=True)
+        cs.attempt = 1
+        cs.save()
+        cs.update_grade()
+        def fail(**kwargs):
+            raise ValueError('failed')
+        post_delete.connect(fail, sender=UserAnswer)
+        try:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    cs.delete()
+        finally:
+            post_delete.disconnect(fail, sender=UserAnswer)
+        # the submission is still graded once the deletion is undone
+        self.assertFalse(ChapterSubmission.objects.get(pk=cs.pk).deleting)
+        ua2.delete()
+        self.assertEquals(ChapterSubmission.objects.get(pk=cs.pk).grade, 50)
+
     def test_is_complete(self):
         user = User.objects.create(username='u', password='pw')
         chapter = Chapter.objects.create(title='chap', number=1.0)
@@ -526,6 +784,1635 @@ class ChapterSubmissionTests(TestCase):
         _check(oa3)
         self.assertTrue(cs.is_ready())
 
+    def test_stored_grade(self):
+        user = User.objects.create(username='u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        q1 = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=1)
+        q2 = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=2)
+        cs = self.create_submission(chapter, user)
+        stored = lambda: ChapterSubmission.objects.get(id=cs.id)
+        ua1 = create_user_answer(q=q1, chapter=chapter,user=user,submission=cs, correct=True)
+        # the grade of an unsubmitted submission is not stored
+        cs.update_grade()
+        self.assertIsNone(stored().grade)
+        self.assertFalse(stored().ready)
+        self.assertEquals(stored().percent_correct(), 50)
+        ua2 = create_user_answer(q=q2, chapter=chapter,user=user,submission=cs, correct=True)
+        # submit
+        cs.attempt = 1
+        cs.save()
+        cs.update_grade()
+        self.assertEquals(stored().grade, 100)
+        self.assertTrue(stored().ready)
+        ua2.delete()
+        self.assertEquals(stored().grade, 50)
+        self.assertEquals(stored().percent_correct(), cs.calculate_grade())
+
+    def test_answer_regrades_once(self):
+        user = User.objects.create_user('u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        q = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=1)
+        choices = [Choice.objects.create(question=q, text=str(i), is_correct=i == 0) for i in range(2)]
+        self.client.force_login(user)
+        url = reverse('logic:question', args=(chapter.chnum, 1))
+        calls = []
+        update_grade = ChapterSubmission.update_grade
+        def counted(submission):
+            calls.append(submission.attempt)
+            update_grade(submission)
+        ChapterSubmission.update_grade = counted
+        try:
+            self.client.post(url, {'choice': choices[0].id})
+            self.assertEquals(calls, []) # not submitted
+            cs = ChapterSubmission.objects.get()
+            self.assertIsNone(cs.grade)
+            cs.attempt = 1
+            cs.save()
+            self.client.post(url, {'choice': choices[1].id})
+            self.assertEquals(calls, [1])
+        finally:
+            ChapterSubmission.update_grade = update_grade
+        self.assertEquals(ChapterSubmission.objects.get().grade, 0)
+
+    def test_stored_grade_open(self):
+        user = User.objects.create(username='u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        q = OpenQuestion.objects.create(chapter=chapter, text='hi?', number=1)
+        cs = self.create_submission(chapter, user)
+        ua = create_user_answer(q=q, chapter=chapter,user=user,submission=cs, correct=False)
+        oa = OpenAnswer.objects.create(text='x', question=q, user_answer=ua)
+        cs.attempt = 1
+        cs.save()
+        cs.update_grade()
+        stored = lambda: ChapterSubmission.objects.get(id=cs.id)
+        self.assertEquals(stored().grade, 0)
+        self.assertFalse(stored().ready)
+        oa.grade = 0.5
+        oa.save()
+        self.assertEquals(stored().grade, 50)
+        self.assertTrue(stored().ready)
+
+class ChapterProgressTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def test_progress(self):
+        user = User.objects.create(username='u', password='pw')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        cs = ChapterSubmission.objects.create(chapter=chapter,user=user,attempt=0,ongoing=True)
+        q1 = FormulationQuestion.objects.create(chapter=chapter, text='hi?', number=1, followup=FormulationQuestion.DEDUCTION)
+        q2 = ChoiceQuestion.objects.create(chapter=chapter, text='hi?', number=2)
+        questions = chapter.questions()
+
+        progress = ChapterProgress(chapter, user)
+        self.assertEquals(progress.statuses(), {1: False, 2: False})
+        self.assertEquals(next_question(chapter, user), q1)
+
+        create_user_answer(q=q1, chapter=chapter,user=user,submission=cs, correct=True)
+        create_user_answer(q=q2, chapter=chapter,user=user,submission=cs, correct=True)
+        with self.assertNumQueries(1):
+            progress = ChapterProgress(chapter, user, questions)
+        self.assertEquals(progress.statuses(), {1: 'half', 2: True})
+        self.assertEquals(next_question(chapter, user), q1)
+
+        create_user_answer(q=q1, chapter=chapter,user=user,submission=cs, correct=True, is_followup=True)
+        progress = ChapterProgress(chapter, user)
+        self.assertEquals(progress.statuses(), {1: True, 2: True})
+        self.assertTrue(progress.answer(q1, is_followup=True).is_followup)
+        # all answered, submission is ongoing
+        self.assertEquals(next_question(chapter, user), q1)
+        cs.ongoing = False
+        cs.save()
+        self.assertEquals(next_question(chapter, user), None)
+
+class ChapterStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.q1 = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        self.q2 = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=2)
+
+    def _answer(self, user, answers):
+        cs, _ = ChapterSubmission.objects.get_or_create(chapter=self.chapter, user=user, defaults={'attempt':0, 'ongoing':True})
+        for q, correct in zip([self.q1, self.q2], answers):
+            ua = q.user_answer(user)
+            if ua:
+                ua.correct = correct
+                ua.save()
+            else:
+                ua = create_user_answer(q=q, chapter=self.chapter, user=user, submission=cs, correct=correct)
+            Stat.objects.create(user_answer=ua, correct=correct)
+        if cs.is_submitted():
+            cs.update_grade()
+        return cs
+
+    def _submit(self, cs):
+        cs.attempt += 1
+        cs.ongoing = False
+        cs.save()
+        cs.update_grade()
+
+    def _stats(self):
+        chapter_stats = ChapterStats.objects.get(chapter=self.chapter)
+        counts = {
+            (c.kind, c.value): c.count for c in ChapterStatsCount.objects.filter(chapter=self.chapter) if c.count
+        }
+        questions = {
+            q.question_number: [getattr(q, f) for f in QuestionStats.FIELDS] for q in QuestionStats.objects.filter(chapter=self.chapter)
+        }
+        return (chapter_stats.num_sub, chapter_stats.sum_grade, chapter_stats.sum_attempts), counts, questions
+
+    def test_aggregates(self):
+        u1 = User.objects.create(username='u1', password='pw')
+        u2 = User.objects.create(username='u2', password='pw')
+
+        cs1 = self._answer(u1, [True, False])
+        self.assertFalse(ChapterStats.objects.filter(chapter=self.chapter, num_sub__gt=0).exists())
+        self._submit(cs1)
+        self.assertEquals(self._stats(), (
+            (1, 50, 1),
+            {('G', 50): 1, ('A', 1): 1},
+            {1: [1, 1, 1, 1, 1], 2: [1, 0, 1, 0, 0]},
+        ))
+
+        cs2 = self._answer(u2, [True, True])
+        self._submit(cs2)
+        # 2nd attempt, counted while ongoing
+        self._answer(u1, [True, True])
+        self.assertEquals(self._stats(), (
+            (2, 200, 2),
+            {('G', 100): 2, ('A', 1): 2},
+            {1: [2, 2, 3, 3, 2], 2: [2, 2, 3, 2, 1]},
+        ))
+        self._submit(cs1)
+        self.assertEquals(self._stats()[:2], ((2, 200, 3), {('G', 100): 2, ('A', 1): 1, ('A', 2): 1}))
+
+        # rebuilding gives the same results
+        stats = self._stats()
+        ChapterStats.rebuild()
+        self.assertEquals(self._stats(), stats)
+
+        # deleting a user removes its submission
+        u2.delete()
+        self.assertEquals(self._stats(), (
+            (1, 100, 2),
+            {('G', 100): 1, ('A', 2): 1},
+            {1: [1, 1, 2, 2, 1], 2: [1, 1, 2, 1, 0]},
+        ))
+
+    def test_rebuild_missing(self):
+        u1 = User.objects.create(username='u1', password='pw')
+        self._submit(self._answer(u1, [True, False]))
+        stats = self._stats()
+        call_command('rebuild_stats', missing=True)
+        self.assertEquals(self._stats(), stats)
+        # as after migrating, with grades stored by update_grades but no stats
+        ChapterStats.objects.all().delete()
+        ChapterSubmission.objects.update(counted_stats=None)
+        call_command('rebuild_stats', missing=True)
+        self.assertEquals(self._stats(), stats)
+
+    def test_chapter_stats_view(self):
+        login(self)
+        cs = self._answer(self.user, [True, False])
+        self._submit(cs)
+        response = self.client.get(reverse('logic:chapter-stats', args=(self.chapter.chnum,)))
+        self.assertEquals(response.context['num_sub'], 1)
+        self.assertEquals(response.context['avg_grade'], 50)
+        self.assertIn((50, 1), response.context['grades'])
+        self.assertEquals(response.context['attempts'], [(1, 1)])
+        self.assertEquals(response.context['q_stats'], [(1, 100., 100., 100., 1, 1.), (2, 0., 0., 0., 1, 1.)])
+        response = self.client.get(reverse('logic:stats'))
+        self.assertEquals(response.context['num_sub'], 1)
+        self.assertEquals(response.context['chapter_data'], [(self.chapter, 50., 1, 1.)])
+
+class StatBufferTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.user = User.objects.create(username='u', password='pw')
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.q = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        cs = ChapterSubmission.objects.create(chapter=self.chapter,user=self.user,attempt=0,ongoing=True)
+        self.ua = create_user_answer(q=self.q, chapter=self.chapter,user=self.user,submission=cs, correct=True)
+        self.journal_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    def test_batches(self):
+        buf = StatBuffer(batch_size=2, flush_interval=None)
+        buf._enqueue((self.ua.id, False))
+        self.assertEquals(Stat.objects.count(), 0)
+        buf._enqueue((self.ua.id, True))
+        self.assertEquals([s.correct for s in Stat.objects.order_by('id')], [False, True])
+        buf._enqueue((self.ua.id, True))
+        self.assertEquals(buf.flush(), 1)
+        self.assertEquals(Stat.objects.count(), 3)
+
+    def test_journal_replay(self):
+        buf = StatBuffer(batch_size=10, flush_interval=None, journal_dir=self.journal_dir)
+        buf._enqueue((self.ua.id, True))
+        buf._enqueue((self.ua.id, False))
+        # simulate a crash before flushing
+        buf.journal.close()
+        buf.journal, buf.items = None, []
+        buf = StatBuffer(batch_size=10, flush_interval=None, journal_dir=self.journal_dir)
+        buf._start()
+        self.assertEquals(buf.flush(), 2)
+        self.assertEquals([s.correct for s in Stat.objects.order_by('id')], [True, False])
+        with open(buf.journal.name) as f:
+            self.assertEquals(f.read(), '')
+
+    def test_requeue(self):
+        buf = StatBuffer(batch_size=10, flush_interval=None, journal_dir=self.journal_dir, max_retries=2)
+        buf._enqueue((self.ua.id, True))
+        def fail(items):
+            raise OperationalError('database is locked')
+        buf._write = fail
+        # however many times the database is locked
+        for i in range(3):
+            self.assertEquals(buf.flush(), 0)
+        del buf._write
+        # still queued, and in the journal
+        buf._enqueue((self.ua.id, False))
+        with open(buf.journal.name) as f:
+            self.assertEquals(len(f.readlines()), 2)
+        self.assertEquals(buf.flush(), 2)
+        self.assertEquals([s.correct for s in Stat.objects.order_by('id')], [True, False])
+
+    def test_drop(self):
+        buf = StatBuffer(batch_size=10, flush_interval=None, journal_dir=self.journal_dir, max_retries=2)
+        buf._enqueue((self.ua.id, True))
+        def fail(items):
+            raise ValueError('unexpected')
+        buf._write = fail
+        self.assertEquals(buf.flush(), 0)
+        self.assertEquals(buf.items, [(self.ua.id, True)])
+        # dropped after the retries, to the dead-letter file
+        self.assertEquals(buf.flush(), 0)
+        self.assertEquals(buf.items, [])
+        with open(buf.journal.name) as f:
+            self.assertEquals(f.read(), '')
+        with open(os.path.join(self.journal_dir, 'failed-stats.journal')) as f:
+            self.assertEquals([json.loads(line) for line in f], [[self.ua.id, True]])
+        # and the stats that follow are written
+        del buf._write
+        buf._enqueue((self.ua.id, False))
+        self.assertEquals(buf.flush(), 1)
+        self.assertEquals([s.correct for s in Stat.objects.all()], [False])
+
+    def test_deleted_answer(self):
+        buf = StatBuffer(batch_size=10, flush_interval=None)
+        buf._enqueue((self.ua.id, True))
+        self.ua.delete()
+        buf.flush()
+        self.assertEquals(Stat.objects.count(), 0)
+
+# UserAnswerAdmin is not registered on the admin site, so its changelist is tested on a site of its own
+user_answer_site = admin.AdminSite(name='useranswers')
+user_answer_site.register(UserAnswer, UserAnswerAdmin)
+urlpatterns = [
+    url(r'^useranswers/', user_answer_site.urls),
+    url(r'^frege/', include('logic.urls')),
+]
+
+class AdminQueryTests(TestCase):
+    """ changelist pages make a fixed number of queries, regardless of the number of rows """
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        login(self)
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.open_chapter = Chapter.objects.create(title='open', number=2.0)
+        self.q = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        self.oq = OpenQuestion.objects.create(chapter=self.open_chapter, text='hi?', number=1)
+        self.num_users = 0
+
+    def _add_users(self, n):
+        for i in range(n):
+            self.num_users += 1
+            user = User.objects.create(username='u%d' % self.num_users, password='pw')
+            UserProfile.objects.create(user=user, group=str(self.num_users % 3 + 1), id_num='123456789')
+            cs = ChapterSubmission.objects.create(chapter=self.chapter, user=user, attempt=1, ongoing=False)
+            create_user_answer(q=self.q, chapter=self.chapter, user=user, submission=cs, correct=True)
+            cs.update_grade()
+            cs = ChapterSubmission.objects.create(chapter=self.open_chapter, user=user, attempt=1, ongoing=False)
+            ua = create_user_answer(q=self.oq, chapter=self.open_chapter, user=user, submission=cs, correct=False)
+            OpenAnswer.objects.create(question=self.oq, user_answer=ua, text='ans')
+            cs.update_grade()
+
+    def _num_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(queries)
+
+    def _assert_budget(self, model, budget, site=admin.site):
+        url = reverse('%s:%s_changelist' % (site.name, model))
+        self._add_users(2)
+        self._num_queries(url) # warm up the chapter data cache
+        few = self._num_queries(url)
+        self._add_users(10)
+        many = self._num_queries(url)
+        self.assertEquals(few, many)
+        self.assertLessEqual(many, budget)
+
+    def test_submissions(self):
+        self._assert_budget('logic_chaptersubmission', 12)
+
+    def test_open_answers(self):
+        self._assert_budget('logic_openanswer', 12)
+
+    def test_users(self):
+        self._assert_budget('auth_user', 12)
+
+    @override_settings(ROOT_URLCONF=__name__)
+    def test_user_answers(self):
+        self._assert_budget('logic_useranswer', 12, user_answer_site)
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        login(self)
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.q1 = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        self.q2 = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=2)
+        self.submissions = []
+        for i in range(5):
+            user = User.objects.create(username='u%d' % i, password='pw')
+            UserProfile.objects.create(user=user, group='1%d' % i, id_num='12345678%d' % i)
+            cs = ChapterSubmission.objects.create(chapter=self.chapter, user=user, attempt=1, ongoing=False)
+            create_user_answer(q=self.q1, chapter=self.chapter, user=user, submission=cs, correct=True)
+            create_user_answer(q=self.q2, chapter=self.chapter, user=user, submission=cs, correct=i % 2 == 0)
+            cs.update_grade()
+            self.submissions.append(cs)
+        # a grade that is not stored is calculated
+        ChapterSubmission.objects.filter(id=self.submissions[0].id).update(grade=None)
+
+    def _export(self, ids):
+        response = self.client.post(reverse('admin:logic_chaptersubmission_changelist'), {
+            'action': 'export_as_csv',
+            '_selected_action': ids,
+        })
+        self.assertEquals(response['Content-Type'], 'text/csv')
+        return list(csv.reader(''.join(response.streaming_content).splitlines()))
+
+    def test_submissions(self):
+        rows = self._export([cs.id for cs in self.submissions])
+        self.assertEquals(rows[0], ['user', 'id', 'group', 'chapter', 'percent', 'time'])
+        self.assertEquals(
+            sorted(row[:5] for row in rows[1:]),
+            [['u%d' % i, '12345678%d' % i, '1%d' % i, '1.0', '100' if i % 2 == 0 else '50'] for i in range(5)],
+        )
+
+    def test_answers(self):
+        rows = list(csv_rows(UserAnswer.objects.all(), OrderedDict([
+            ('user', 'user__username'),
+            ('question', UserAnswer.question_numbers),
+            ('correct', 'correct'),
+        ])))
+        self.assertEquals(len(rows), 11)
+        self.assertEquals(sorted(rows[1:])[:2], [['u0', '1', 'True'], ['u0', '2', 'True']])
+
+    def test_queries(self):
+        # the number of queries does not depend on the number of rows
+        self.submissions[0].update_grade()
+        with self.assertNumQueries(2):
+            rows = list(csv_rows(ChapterSubmission.objects.all(), OrderedDict([
+                ('user', 'user__username'),
+                ('group', 'user__userprofile__group'),
+                ('percent', ChapterSubmission.grades),
+            ])))
+        self.assertEquals(len(rows), 6)
+
+    def test_gradebook(self):
+        chapter2 = Chapter.objects.create(title='chap2', number=2.0)
+        ChoiceQuestion.objects.create(chapter=chapter2, text='hi?', number=1)
+        out = tempfile.NamedTemporaryFile(suffix='.csv')
+        call_command('export_gradebook', out.name, stderr=StringIO())
+        with open(out.name) as f:
+            rows = list(csv.reader(f))
+        self.assertEquals(rows[0], ['user', 'id', 'group', '1', '2'])
+        self.assertEquals(rows[1:3], [['u0', '123456780', '10', '100', ''], ['u1', '123456781', '11', '50', '']])
+        self.assertEquals(len(rows), 6)
+
+class FakeLDAP(object):
+    """ local stand-in for an ldap connection, with users by ou and course groups of members """
+
+    def __init__(self, groups, users=None):
+        self.groups = groups
+        self.users = users or {} # cn -> (ou, password)
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.options = {}
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def search_st(self, base, scope, query, attrlist=None, timeout=-1):
+        with self.lock:
+            self.searches += 1
+        if query.startswith('(&'):
+            # the course groups of a member: (&(|(cn=group)...)(member=dn))
+            member = query.split('(member=cn=')[1].split(',')[0].lower()
+            return [
+                ('cn=%s,%s' % (cn, base), {'cn': [cn]})
+                for cn in query.split('(member=')[0].split('(cn=')[1:]
+                for cn in [cn.rstrip(')')]
+                if member in [m.lower() for m in self.groups.get(cn, [])]
+            ]
+        cn = query.split('=')[1]
+        if base == 'ou=Courses,o=TAU':
+            return [(cn, {'member': ['cn=%s,ou=Students,o=TAU' % m for m in self.groups.get(cn, [])]})]
+        ou = base.split(',')[0].split('=')[1]
+        return [('cn=%s,%s' % (cn, base), {})] if self.users.get(cn, (None,))[0] == ou else []
+
+    def simple_bind_s(self, dn, password):
+        cn = dn.split(',')[0].split('=')[1]
+        if self.users.get(cn, (None, None))[1] != password:
+            raise ldap.INVALID_CREDENTIALS()
+
+    def unbind_s(self):
+        pass
+
+class RosterTests(TestCase):
+
+    COURSE = '06181012'
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.auth_ldap = auth_ldap
+        self.ldap = FakeLDAP({
+            self.COURSE + '01': ['Stud1', 'stud2', 'staff'],
+            self.COURSE + '03': ['STUD1'],
+            self.COURSE + '04': ['stud2'],
+        }, {'stud1': ('Students', 'pw'), 'new': ('Students', 'pw')})
+        self.client = auth_ldap.client
+        auth_ldap.client = LDAPClient(lambda: self.ldap)
+        caches['default'].clear()
+
+    def tearDown(self):
+        self.auth_ldap.client = self.client
+
+    def _group_ids(self, uname):
+        return self.auth_ldap.get_all_user_group_ids(uname, self.COURSE)
+
+    def _age_roster(self, seconds):
+        RosterGroup.objects.update(synced=timezone.now() - timedelta(seconds=seconds))
+
+    def test_lookup(self):
+        self.assertEquals(self._group_ids('stud1'), ['03', '01'])
+        self.assertEquals(self.ldap.searches, 9) # synced once
+        self.assertEquals(self._group_ids('Stud1'), ['03', '01'])
+        self.assertEquals(self._group_ids('stud2'), ['04', '01'])
+        self.assertEquals(self.auth_ldap.get_user_group_id('staff', self.COURSE), '01')
+        self.assertEquals(self.ldap.searches, 9)
+
+    def test_stale(self):
+        self.auth_ldap.sync_roster(self.COURSE)
+        self._age_roster(self.auth_ldap.roster_conf()['MAX_AGE'] + 1)
+        self.ldap.groups[self.COURSE + '05'] = ['stud1']
+        self.assertEquals(self._group_ids('stud1'), ['03', '05', '01'])
+        self.assertEquals(self.ldap.searches, 18)
+
+    def test_course_change(self):
+        # the current course is looked up on each call, not once on import
+        self.assertEquals(self.auth_ldap.get_all_user_group_ids('stud1'), ['03', '01'])
+        GlobalSettings.objects.update(course_id='0618999901')
+        self.ldap.groups['0618999901'] = ['stud1']
+        self.assertEquals(self.auth_ldap.get_all_user_group_ids('stud1'), ['01'])
+        self.assertTrue(RosterGroup.objects.filter(course_id='06189999').exists())
+
+    def test_sync_interval(self):
+        self.assertEquals(self._group_ids('stud1'), ['03', '01'])
+        self.assertEquals(self.ldap.searches, 9)
+        # a roster that is stale again within the sync interval is not synced, users are looked up instead
+        self._age_roster(self.auth_ldap.roster_conf()['MAX_AGE'] + 1)
+        self.ldap.groups[self.COURSE + '05'] = ['new']
+        self.assertEquals(self._group_ids('stud1'), ['03', '01'])
+        self.assertEquals(self.ldap.searches, 12) # user dn (one search per ou) and groups
+        self.assertEquals(self._group_ids('new'), ['05'])
+        self.assertEquals(self.ldap.searches, 15)
+
+    def test_miss(self):
+        self.auth_ldap.sync_roster(self.COURSE)
+        self.assertEquals(self._group_ids('new'), [])
+        self.assertEquals(self.ldap.searches, 12) # user dn (one search per ou) and groups
+        # a user missing from the roster is looked up in ldap, without syncing the roster
+        self.ldap.groups[self.COURSE + '01'].append('new')
+        self.assertEquals(self._group_ids('new'), ['01'])
+        self.assertEquals(self.ldap.searches, 13)
+        self.assertEquals(self._group_ids('nobody'), []) # not in ldap
+        self.assertEquals(self.ldap.searches, 15)
+
+class LDAPClientTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        from frege import auth_ldap
+        self.auth_ldap = auth_ldap
+        self.ldap = FakeLDAP({}, users={'stud': ('Students', 'pw'), 'prof': ('Staff', 'pw2')})
+        self.connections = 0
+        self.client = auth_ldap.client
+        auth_ldap.client = LDAPClient(self._connect, pool_size=2, timeout=3)
+
+    def tearDown(self):
+        self.auth_ldap.client = self.client
+
+    def _connect(self):
+        self.connections += 1
+        return self.ldap
+
+    def test_pool(self):
+        client = self.auth_ldap.client
+        results = client.map(lambda i: client.search('ou=Students,o=TAU', 'cn=stud'), range(20))
+        self.assertEquals(len(results), 20)
+        self.assertLessEqual(self.connections, 2)
+        self.assertEquals(self.ldap.options, {ldap.OPT_NETWORK_TIMEOUT: 3, ldap.OPT_TIMEOUT: 3})
+        self.assertEquals(client.metrics.get()['search']['count'], 20)
+
+    def test_discard_on_error(self):
+        client = self.auth_ldap.client
+        with client.connection():
+            pass
+        self.assertEquals(self.connections, 1)
+        with self.assertRaises(ldap.LDAPError):
+            with client.connection():
+                raise ldap.SERVER_DOWN()
+        with client.connection():
+            pass
+        with client.connection():
+            with client.connection():
+                pass
+        self.assertEquals(self.connections, 3)
+
+    def test_auth(self):
+        self.assertTrue(self.auth_ldap.auth('stud', u'pw'))
+        self.assertTrue(self.auth_ldap.auth('prof', u'pw2'))
+        self.assertFalse(self.auth_ldap.auth('prof', u'pw'))
+        self.assertFalse(self.auth_ldap.auth('nobody', u'pw'))
+        searches = self.ldap.searches
+        # bind dns are cached
+        self.assertTrue(self.auth_ldap.user_exists('stud'))
+        self.assertEquals(self.ldap.searches, searches)
+        metrics = self.auth_ldap.client.metrics.get()
+        self.assertEquals(metrics['bind']['count'], 3)
+        self.assertEquals(metrics['bind']['errors'], 1)
+
+    def test_ttl_cache(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+
+class PerfTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        perf.registry.clear()
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.q = TruthTableQuestion.objects.create(chapter=self.chapter, formula='p%sq' % DIS, number=1)
+
+    def test_request_stats(self):
+        login(self)
+        self.client.get(reverse('logic:question', args=(self.chapter.chnum, self.q.number)))
+        stats = json.loads(self.client.get(reverse('logic:perf')).content)
+        question = stats['urls']['logic:question']
+        self.assertEquals(question['wall']['count'], 1)
+        self.assertGreater(question['sql_count']['avg'], 0)
+        self.assertGreater(question['formula_time']['max'], 0)
+        self.assertEquals(question['lock_retries']['max'], 0)
+        self.assertIn('retries', stats['db'])
+
+    def test_staff_only(self):
+        User.objects.create_user('s', 's@hi.com', 'pw')
+        self.client.login(username='s', password='pw')
+        self.assertEquals(self.client.get(reverse('logic:perf')).status_code, 404)
+
+    def test_timed(self):
+        @perf.timed('t')
+        def f(n):
+            time.sleep(0.01)
+            if n:
+                f(n - 1)
+        perf.reset_sections()
+        f(2)
+        # nested calls are counted once
+        self.assertGreater(perf.section_times()['t'], 25)
+        self.assertLess(perf.section_times()['t'], 50)
+
+    def test_histogram(self):
+        h = perf.Histogram([10, 100])
+        for v in [1, 2, 50, 500]:
+            h.add(v)
+        self.assertEquals(h.counts, [2, 1, 1])
+        self.assertEquals(h.percentile(50), 10)
+        self.assertEquals(h.percentile(95), 500)
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.received = threading.Event()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.received.set()
+
+class LoggingTests(TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.logger = logging.getLogger('logic.tests.logging')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.handlers = []
+        self.logger.propagate = True
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_queue(self):
+        queue = Queue.Queue()
+        listener = QueueListener(queue, self.handler)
+        listener.start()
+        self.logger.addHandler(QueueHandler(queue))
+        self.logger.info('a %s %d', 'b', 1)
+        try:
+            1/0
+        except ZeroDivisionError:
+            self.logger.exception('failed')
+        listener.stop()
+        self.assertEquals([r.getMessage() for r in self.handler.records], ['a b 1', 'failed'])
+        self.assertIsNone(self.handler.records[1].exc_info)
+        self.assertIn('ZeroDivisionError', self.handler.records[1].exc_text)
+
+    def test_queue_formats_on_listener(self):
+        rendered = []
+        class Context(object):
+            def __str__(self):
+                rendered.append(threading.current_thread())
+                return 'context'
+        queue = Queue.Queue()
+        self.logger.addHandler(QueueHandler(queue))
+        self.logger.info('%s', sampled(Context(), rate=1))
+        self.assertEquals(rendered, []) # not rendered by the logging thread
+        listener = QueueListener(queue, self.handler)
+        listener.start()
+        listener.stop()
+        self.assertEquals(self.handler.records[0].getMessage(), 'context')
+        self.assertEquals(len(rendered), 1)
+        self.assertIsNot(rendered[0], threading.current_thread())
+
+    def test_log_server(self):
+        server = LogServer(('localhost', 0), self.handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            socket_handler = FallbackSocketHandler(*server.server_address)
+            self.logger.addHandler(socket_handler)
+            self.logger.warning('to server: %s', u'שלום')
+            self.handler.received.wait(5)
+            socket_handler.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEquals(self.handler.records[0].getMessage(), u'to server: שלום')
+        self.assertEquals(self.handler.records[0].levelno, logging.WARNING)
+
+    def test_fallback(self):
+        fallback = ListHandler()
+        socket_handler = FallbackSocketHandler('localhost', 1, fallback) # nothing listens on port 1
+        self.logger.addHandler(socket_handler)
+        self.logger.info('no server')
+        socket_handler.close()
+        self.assertEquals(fallback.records[0].getMessage(), 'no server')
+
+    def test_sampled(self):
+        rendered = []
+        class Context(object):
+            def __str__(self):
+                rendered.append(1)
+                return 'context'
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.debug('%s', sampled(Context(), rate=1))
+        self.assertEquals(rendered, []) # not rendered when not logged
+        self.logger.info('%s', sampled(Context(), rate=1))
+        self.assertEquals(self.handler.records[0].getMessage(), 'context')
+        self.logger.info('%s', sampled(Context(), rate=10**9))
+        self.assertEquals(self.handler.records[1].getMessage(), '<not sampled>')
+        self.assertEquals(len(rendered), 1)
+
+class LoadTestTests(LiveServerTestCase):
+
+    def setUp(self):
+        GlobalSettings.objects.create(ldap_enabled=False)
+        # stats of the test database must not be replayed into the real one
+        self.journal_dir, stat_buffer.journal_dir = stat_buffer.journal_dir, None
+
+    def tearDown(self):
+        stat_buffer.flush()
+        stat_buffer.journal_dir = self.journal_dir
+
+    def test_load_test(self):
+        result = LoadTest(self.live_server_url, users=2, chapters=1, polls=1, correct_rate=1).run()
+        for endpoint, e in result['endpoints'].iteritems():
+            self.assertEquals(e['errors'], 0, endpoint)
+        self.assertEquals(result['endpoints']['POST logic:question']['count'], 12)
+        self.assertEquals(result['endpoints']['GET logic:followup-refresh']['count'], 2)
+        self.assertEquals(result['lock_retries']['total'], 0)
+        # all answers are checked as correct, except for the open question
+        answers = UserAnswer.objects.filter(user__in=synthetic.users())
+        self.assertEquals(answers.count(), 14)
+        self.assertEquals(answers.filter(correct=True).count(), 12)
+        self.assertEquals(ChapterSubmission.objects.filter(attempt=1).count(), 4)
+        synthetic.clear()
+        self.assertFalse(synthetic.chapters().exists())
+
+    def test_wrong_answers(self):
+        synthetic.seed(1, 1)
+        for q in synthetic.chapters()[0].questions():
+            self.assertNotEqual(type(q), OpenQuestion)
+            if type(q) in (ChoiceQuestion, TruthTableQuestion, ModelQuestion, DeductionQuestion):
+                self.assertNotEqual(synthetic.answer(q, True), synthetic.answer(q, False))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile([3], 95), 3)
+
+class SemesterTests(TestCase):
+
+    def setUp(self):
+        GlobalSettings.objects.create(ldap_enabled=False)
+
+    def _generate(self, random_seed):
+        counts = synthetic.generate_semester(30, 2, random_seed=random_seed, chunk_size=8)
+        fingerprint = list(ChapterSubmission.objects.order_by('user__username', 'chapter__number').values_list(
+            'user__username', 'user__userprofile__group', 'chapter__number', 'attempt', 'grade', 'ready',
+        ))
+        return counts, fingerprint
+
+    def test_generate(self):
+        counts, _ = self._generate(1)
+        self.assertEquals(synthetic.users().count(), 30)
+        self.assertEquals(ChapterSubmission.objects.count(), counts['submissions'])
+        self.assertEquals(UserAnswer.objects.count(), counts['answers'])
+        self.assertEquals(Stat.objects.count(), counts['stats'])
+        self.assertEquals(OpenAnswer.objects.count(), counts['open answers'])
+        self.assertGreater(counts['open answers'], 0)
+        # stored grades are as calculated live
+        for submission in ChapterSubmission.objects.all():
+            self.assertEquals((submission.grade, submission.ready), submission.live_grade())
+            for ans in submission.useranswer_set.all():
+                if submission.is_submitted():
+                    self.assertTrue(ans.is_submitted())
+        # aggregate stats are built
+        ready = ChapterSubmission.objects.filter(ready=True)
+        self.assertEquals(sum(ChapterStats.objects.values_list('num_sub', flat=True)), ready.count())
+
+    def test_reproducible(self):
+        _, first = self._generate(1)
+        _, again = self._generate(1)
+        _, other = self._generate(2)
+        self.assertEquals(first, again)
+        self.assertNotEqual(first, other)
+
+    @override_settings(SYNTHETIC_DATA=False)
+    def test_real_database(self):
+        chapter = Chapter.objects.create(title='not synthetic', number=synthetic.FIRST_CHAPTER)
+        self.assertRaises(ImproperlyConfigured, synthetic.clear)
+        self.assertRaises(ImproperlyConfigured, synthetic.seed, 1, 1)
+        self.assertRaises(ImproperlyConfigured, synthetic.generate_semester, 1, 1)
+        self.assertTrue(Chapter.objects.filter(id=chapter.id).exists())
+        self.assertFalse(synthetic.users().exists())
+
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        GlobalSettings.objects.create(ldap_enabled=False)
+
+    def test_run(self):
+        benchmark.prepare(5, 1, 0)
+        results = benchmark.run(repeat=1)
+        self.assertEquals(results.keys(), benchmark.load_baseline()['views'].keys())
+        for name, r in results.iteritems():
+            self.assertLess(r['status'], 400, name)
+            self.assertGreaterEqual(r['queries'], 0)
+        self.assertGreater(results['question/choice post']['queries'], results['index']['queries'])
+
+    def test_compare(self):
+        baseline = {'index': {'queries': 3, 'median_ms': 10}, 'help': {'queries': 2, 'median_ms': 5}}
+        results = OrderedDict([
+            ('index', {'status': 200, 'queries': 3, 'median_ms': 20}),
+            ('help', {'status': 200, 'queries': 2, 'median_ms': 5}),
+            ('new', {'status': 200, 'queries': 50, 'median_ms': 500}),
+        ])
+        self.assertEquals(benchmark.compare(results, baseline), [])
+        results['index']['queries'] = 4
+        results['help']['median_ms'] = 18
+        results['new']['status'] = 500
+        self.assertEquals([name for name, _ in benchmark.compare(results, baseline)], ['index', 'help', 'new'])
+        self.assertEquals(benchmark.compare(results, baseline, tolerance=3, slack=10)[1:], [('new', 'status 500')])
+
+class WriteTransactionTests(TransactionTestCase):
+
+    def _failing(self, times, error='database is locked'):
+        calls = []
+        @write_transaction(base_delay=0.001, max_delay=0.001)
+        def write():
+            calls.append(1)
+            if len(calls) <= times:
+                raise OperationalError(error)
+            return len(calls)
+        return write, calls
+
+    def test_retry(self):
+        before = counters.get()
+        write, calls = self._failing(2)
+        self.assertEquals(write(), 3)
+        after = counters.get()
+        self.assertEquals(after['retries'] - before['retries'], 2)
+        self.assertEquals(after['lock_waits'] - before['lock_waits'], 2)
+        self.assertEquals(after['transactions'] - before['transactions'], 1)
+
+    def test_give_up(self):
+        before = counters.get()
+        write, calls = self._failing(100)
+        self.assertRaises(OperationalError, write)
+        self.assertEquals(len(calls), 6)
+        self.assertEquals(counters.get()['failures'] - before['failures'], 1)
+
+    def test_other_error(self):
+        write, calls = self._failing(1, error='no such table: x')
+        self.assertRaises(OperationalError, write)
+        self.assertEquals(len(calls), 1)
+
+    def test_nested(self):
+        # not retried inside an outer transaction
+        write, calls = self._failing(1)
+        with transaction.atomic():
+            self.assertRaises(OperationalError, write)
+        self.assertEquals(len(calls), 1)
+
+    def _lock_once(self, model):
+        """ makes the next save of model fail as locked, once its changes are made """
+        save = model.save
+        def locked(*args, **kwargs):
+            model.save = save
+            raise OperationalError('database is locked')
+        model.save = locked
+        self.addCleanup(setattr, model, 'save', save)
+
+    def _answer_chapter(self):
+        create_settings()
+        login(self)
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        question = ChoiceQuestion.objects.create(chapter=chapter, number=1, text='hithere')
+        choices = [Choice.objects.create(question=question, text='c%s' % i, is_correct=(i==1)) for i in range(2)]
+        url = reverse('logic:question', args=(chapter.chnum, question.number))
+        self.assertIn('next', self.client.post(url, {'choice': choices[0].id}).json())
+        return chapter, url, choices
+
+    def test_retried_submission(self):
+        chapter, _, _ = self._answer_chapter()
+        self._lock_once(ChapterSubmission)
+        response = self.client.post(reverse('logic:chapter-summary', args=(chapter.chnum,)))
+        self.assertIn('next', response.json())
+        submission = ChapterSubmission.objects.get(chapter=chapter, user=self.user)
+        self.assertEquals(submission.attempt, 1)
+        self.assertFalse(submission.ongoing)
+
+    def test_retried_answer(self):
+        chapter, url, choices = self._answer_chapter()
+        self._lock_once(UserAnswer)
+        self.assertIn('next', self.client.post(url, {'choice': choices[1].id}).json())
+        user_answer = UserAnswer.objects.get(chapter=chapter, user=self.user)
+        self.assertEquals(user_answer.attempts, 2)
+        self.assertTrue(user_answer.correct)
+
+    def test_pragmas(self):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA synchronous')
+        self.assertEquals(cursor.fetchone()[0], 1) # NORMAL
+
+class UploadTests(TransactionTestCase):
+
+    def setUp(self):
+        GlobalSettings.objects.create(max_file_size=1)
+        self.media_dir = tempfile.mkdtemp()
+        self.media = self.settings(MEDIA_ROOT=self.media_dir)
+        self.media.enable()
+        # stats of the test database must not be replayed into the real one
+        self.journal_dir, stat_buffer.journal_dir = stat_buffer.journal_dir, None
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        OpenQuestion.objects.create(chapter=self.chapter, text='hi?', number=1, has_file=True)
+        self.url = reverse('logic:question', args=(self.chapter.chnum, 1))
+
+    def tearDown(self):
+        stat_buffer.flush()
+        stat_buffer.journal_dir = self.journal_dir
+        self.media.disable()
+        shutil.rmtree(self.media_dir)
+
+    def _files(self):
+        return [os.path.join(d, f) for d, _, files in os.walk(self.media_dir) for f in files]
+
+    def _answer(self, username, content):
+        self.client.force_login(User.objects.get_or_create(username=username)[0])
+        return self.client.post(self.url, {'anstxt': 'text', 'file-upd': 'true', 'file': SimpleUploadedFile('ans.pdf', content)})
+
+    def test_upload(self):
+        response = self._answer('u1', 'content')
+        self.assertNotIn('msg', response.json())
+        name = stored_file_name(hashlib.sha256('content').hexdigest(), 'ans.pdf')
+        self.assertEquals(OpenAnswer.objects.get().upload.name, name)
+        self.assertEquals(StoredFile.objects.get().refs, 1)
+        self.assertEquals(self._files(), [os.path.join(self.media_dir, name)])
+        # the same content again is not written again
+        os.utime(self._files()[0], (0, 0))
+        self._answer('u1', 'content')
+        self.assertEquals(StoredFile.objects.get().refs, 1)
+        self.assertEquals(os.path.getmtime(self._files()[0]), 0)
+        # replaced
+        self._answer('u1', 'other content')
+        self.assertEquals(StoredFile.objects.get().digest, hashlib.sha256('other content').hexdigest())
+        self.assertEquals(len(self._files()), 1)
+
+    def test_shared(self):
+        self._answer('u1', 'content')
+        self._answer('u2', 'content')
+        self.assertEquals(StoredFile.objects.get().refs, 2)
+        self.assertEquals(len(self._files()), 1)
+        first, second = OpenAnswer.objects.order_by('id')
+        first.delete()
+        self.assertEquals(StoredFile.objects.get().refs, 1)
+        self.assertEquals(len(self._files()), 1)
+        second.upload = None
+        second.save()
+        self.assertFalse(StoredFile.objects.exists())
+        self.assertEquals(self._files(), [])
+
+    def test_concurrent(self):
+        # the same content saved by a concurrent request after the existence check
+        name = stored_file_name(hashlib.sha256('content').hexdigest(), 'ans.pdf')
+        os.makedirs(os.path.dirname(os.path.join(self.media_dir, name)))
+        with open(os.path.join(self.media_dir, name), 'wb') as f:
+            f.write('content')
+        def missed(name):
+            del default_storage.exists
+            return False
+        default_storage.exists = missed
+        self.assertEquals(StoredFile.store(SimpleUploadedFile('ans.pdf', 'content')), name)
+        self.assertEquals(StoredFile.objects.get().name, name)
+        self.assertEquals(self._files(), [os.path.join(self.media_dir, name)])
+
+    def test_preview_on_commit(self):
+        added = []
+        add = previews.preview_worker.add
+        previews.preview_worker.add = added.append
+        try:
+            try:
+                with transaction.atomic():
+                    StoredFile.store(SimpleUploadedFile('ans.png', 'rolled back'))
+                    self.assertEquals(added, [])
+                    raise OperationalError
+            except OperationalError:
+                pass
+            self.assertEquals(added, [])
+            with transaction.atomic():
+                name = StoredFile.store(SimpleUploadedFile('ans.png', 'committed'))
+                self.assertEquals(added, [])
+            self.assertEquals(added, [name])
+            # not again for a stored file
+            StoredFile.store(SimpleUploadedFile('ans.png', 'committed'))
+            self.assertEquals(added, [name])
+        finally:
+            previews.preview_worker.add = add
+
+    def test_too_large(self):
+        response = self._answer('u1', 'x' * (1024 * 1024 + 1))
+        self.assertIn('msg', response.json())
+        self.assertFalse(UserAnswer.objects.exists())
+        self.assertEquals(self._files(), [])
+        response = self._answer('u1', 'x' * 1024 * 1024)
+        self.assertNotIn('msg', response.json())
+
+class MediaTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.media = self.settings(MEDIA_ROOT=self.media_dir)
+        self.media.enable()
+        self.name = 'uploads/files/ab/abc.pdf'
+        os.makedirs(os.path.join(self.media_dir, 'uploads/files/ab'))
+        with open(os.path.join(self.media_dir, self.name), 'wb') as f:
+            f.write('0123456789')
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        question = OpenQuestion.objects.create(chapter=chapter, text='hi?', number=1, has_file=True)
+        self.student = User.objects.create_user('student', password='pw')
+        cs = ChapterSubmission.objects.create(chapter=chapter, user=self.student, attempt=0, ongoing=True)
+        ua = create_user_answer(q=question, chapter=chapter, user=self.student, submission=cs, correct=False)
+        OpenAnswer.objects.create(text='x', question=question, user_answer=ua, upload=self.name)
+        self.url = reverse('media', args=(self.name,))
+
+    def tearDown(self):
+        self.media.disable()
+        shutil.rmtree(self.media_dir)
+
+    def _get(self, user, **headers):
+        if user:
+            self.client.force_login(user)
+        return self.client.get(self.url, **headers)
+
+    def test_permissions(self):
+        self.assertEquals(self.url, OpenAnswer.objects.get().upload.url)
+        response = self._get(self.student)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(''.join(response.streaming_content), '0123456789')
+        self.assertEquals(response['Content-Type'], 'application/pdf')
+        self.assertEquals(response['Content-Disposition'], 'inline; filename="student_1-0_1.pdf"; filename*=UTF-8\'\'student_1-0_1.pdf')
+        self.assertEquals(self._get(User.objects.create_superuser('staff', 's@hi.com', 'pw')).status_code, 200)
+        self.assertEquals(self._get(User.objects.create_user('other', password='pw')).status_code, 404)
+        self.client.logout()
+        self.assertEquals(self._get(None).status_code, 302)
+        self.client.force_login(self.student)
+        self.assertEquals(self.client.get(reverse('media', args=('../settings.py',))).status_code, 404)
+
+    def test_range(self):
+        response = self._get(self.student, HTTP_RANGE='bytes=2-4')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(''.join(response.streaming_content), '234')
+        self.assertEquals(response['Content-Range'], 'bytes 2-4/10')
+        response = self._get(self.student, HTTP_RANGE='bytes=-3')
+        self.assertEquals(''.join(response.streaming_content), '789')
+        response = self._get(self.student, HTTP_RANGE='bytes=8-')
+        self.assertEquals(''.join(response.streaming_content), '89')
+        self.assertEquals(self._get(self.student, HTTP_RANGE='bytes=10-').status_code, 416)
+        # a stale if-range gets the whole file
+        response = self._get(self.student, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+        self.assertEquals(response.status_code, 200)
+
+    def test_conditional(self):
+        response = self._get(self.student)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEquals(self._get(self.student, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEquals(self._get(self.student, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEquals(self._get(self.student, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_content_disposition(self):
+        self.assertEquals(media.content_disposition(u'תשובה 1.pdf'),
+            'inline; filename="_____ 1.pdf"; filename*=UTF-8\'\'%D7%AA%D7%A9%D7%95%D7%91%D7%94%201.pdf')
+        self.assertEquals(media.content_disposition(u'a"b\\c.pdf'),
+            'inline; filename="a_b_c.pdf"; filename*=UTF-8\'\'a%22b%5Cc.pdf')
+
+    def test_sendfile(self):
+        path = os.path.join(self.media_dir, self.name)
+        with self.settings(MEDIA_SERVE={'SENDFILE': media.X_SENDFILE}):
+            response = self._get(self.student)
+            self.assertEquals(response['X-Sendfile'], path)
+            self.assertEquals(response.content, '')
+        with self.settings(MEDIA_SERVE={'SENDFILE': media.X_ACCEL_REDIRECT, 'ACCEL_PREFIX': '/protected/'}):
+            response = self._get(self.student)
+            self.assertEquals(response['X-Accel-Redirect'], '/protected/' + self.name)
+
+class PreviewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.media = self.settings(MEDIA_ROOT=self.media_dir)
+        self.media.enable()
+        chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.question = OpenQuestion.objects.create(chapter=chapter, text='hi?', number=1, has_file=True)
+        self.student = User.objects.create_user('student', password='pw')
+        cs = ChapterSubmission.objects.create(chapter=chapter, user=self.student, attempt=1, ongoing=False)
+        self.ua = create_user_answer(q=self.question, chapter=chapter, user=self.student, submission=cs, correct=False)
+        self.staff = User.objects.create_superuser('staff', 's@hi.com', 'pw')
+
+    def tearDown(self):
+        self.media.disable()
+        shutil.rmtree(self.media_dir)
+
+    def _store(self, name, content):
+        return OpenAnswer.objects.create(text='x', question=self.question, user_answer=self.ua, upload=SimpleUploadedFile(name, content))
+
+    def test_names(self):
+        name = 'uploads/files/ab/abc.png'
+        self.assertTrue(previews.is_image(name))
+        self.assertFalse(previews.is_image('uploads/files/ab/abc.pdf'))
+        self.assertEquals(previews.preview_name(name), 'uploads/files/ab/abc.preview.jpg')
+        self.assertEquals(previews.preview_name(name, previews.THUMBNAIL), 'uploads/files/ab/abc.thumb.jpg')
+        for kind in previews.KINDS:
+            self.assertEquals(previews.preview_base(previews.preview_name(name, kind)), 'uploads/files/ab/abc')
+        self.assertIsNone(previews.preview_base(name))
+
+    def test_media_view(self):
+        answer = self._store('ans.png', 'not really an image')
+        preview = previews.preview_name(answer.upload.name)
+        with open(os.path.join(self.media_dir, preview), 'wb') as f:
+            f.write('preview')
+        self.client.force_login(self.student)
+        response = self.client.get(reverse('media', args=(preview,)))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(''.join(response.streaming_content), 'preview')
+        self.client.force_login(User.objects.create_user('other', password='pw'))
+        self.assertEquals(self.client.get(reverse('media', args=(preview,))).status_code, 404)
+
+    def test_admin_without_preview(self):
+        answer = self._store('ans.pdf', 'pdf')
+        self.assertEquals(previews.generate(answer.upload.name), 0)
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('admin:logic_openanswer_change', args=(answer.id,)))
+        self.assertContains(response, "<a href='%s'>%s</a>" % (answer.upload.url, answer.upload.name))
+        self.assertNotContains(response, '<img src')
+
+    @skipUnless(previews.enabled(), 'previews require Pillow')
+    def test_generate(self):
+        data = StringIO()
+        previews.Image.new('RGB', (3000, 2000), 'white').save(data, 'PNG')
+        answer = self._store('ans.png', data.getvalue())
+        name = answer.upload.name
+        self.assertEquals(previews.generate(name), 2)
+        self.assertEquals(previews.generate(name), 0)
+        for kind, size in ((previews.PREVIEW, (1600, 1066)), (previews.THUMBNAIL, (200, 133))):
+            with open(os.path.join(self.media_dir, previews.preview_name(name, kind)), 'rb') as f:
+                self.assertEquals(previews.Image.open(f).size, size)
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('admin:logic_openanswer_change', args=(answer.id,)))
+        self.assertContains(response, "<img src='%s'" % previews.preview_url(name))
+        response = self.client.get(reverse('admin:logic_openanswer_changelist'))
+        self.assertContains(response, "<img src='%s'" % previews.preview_url(name, previews.THUMBNAIL))
+        # previews are deleted with the file
+        StoredFile.objects.filter(name=name).delete()
+        StoredFile._delete_file(name)
+        self.assertEquals([f for _, _, files in os.walk(self.media_dir) for f in files], [])
+
+class GradingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        questions = [OpenQuestion.objects.create(chapter=self.chapter, text='hi%d?' % i, number=i) for i in (1, 2)]
+        self.answers = []
+        for i in range(3):
+            user = User.objects.create_user('u%d' % i, password='pw')
+            cs = ChapterSubmission.objects.create(chapter=self.chapter, user=user, attempt=0, ongoing=True)
+            for q in questions:
+                ua = create_user_answer(q=q, chapter=self.chapter, user=user, submission=cs, correct=False)
+                self.answers.append(OpenAnswer.objects.create(text='ans', question=q, user_answer=ua))
+            cs.attempt, cs.ongoing = 1, False
+            cs.save()
+            cs.update_grade()
+        # not submitted
+        user = User.objects.create_user('u3', password='pw')
+        cs = ChapterSubmission.objects.create(chapter=self.chapter, user=user, attempt=0, ongoing=True)
+        ua = create_user_answer(q=questions[0], chapter=self.chapter, user=user, submission=cs, correct=False)
+        OpenAnswer.objects.create(text='ans', question=questions[0], user_answer=ua)
+        self.url = reverse('admin:openanswer-grading', args=(self.chapter.number,))
+
+    def test_queue(self):
+        ids = [a.id for a in self.answers]
+        first = OpenAnswer.grading_queue(self.chapter, limit=4)
+        self.assertEquals([a.id for a in first], ids[:4])
+        # grading does not shift the next page
+        OpenAnswer.grade_many({ids[0]: (1, None), ids[4]: (1, None)})
+        self.assertEquals([a.id for a in OpenAnswer.grading_queue(self.chapter, after=first[-1].id, limit=4)], ids[5:])
+        self.assertEquals([a.id for a in OpenAnswer.grading_queue(self.chapter)], ids[1:4] + ids[5:])
+
+    def test_grade_many(self):
+        grades = {a.id: (Decimal('0.5'), 'comment %d' % a.id) for a in self.answers}
+        with CaptureQueriesContext(connection) as context:
+            self.assertEquals(OpenAnswer.grade_many(grades), 6)
+        # each of the 3 submissions is updated once (about 30 queries each), rather than once per answer
+        self.assertLess(len(context), 3 * 30)
+        for a in OpenAnswer.objects.filter(id__in=grades):
+            self.assertEquals(a.grade, Decimal('0.5'))
+            self.assertEquals(a.comment, 'comment %d' % a.id)
+        for cs in ChapterSubmission.objects.filter(attempt=1):
+            self.assertEquals(cs.grade, 50)
+            self.assertTrue(cs.ready)
+        # regrading by the same grades changes nothing, and keeps comments
+        self.assertEquals(OpenAnswer.grade_many({a.id: (Decimal('0.5'), None) for a in self.answers}), 0)
+        self.assertEquals(OpenAnswer.objects.get(id=self.answers[0].id).comment, 'comment %d' % self.answers[0].id)
+
+    def test_invalid(self):
+        for grades in ({self.answers[0].id: (1, None), self.answers[1].id: (Decimal('1.5'), None)},
+                       {self.answers[0].id: (Decimal('0.25'), None)},
+                       {self.answers[0].id: ('x', None)},
+                       {0: (1, None)}):
+            with self.assertRaises(ValidationError):
+                OpenAnswer.grade_many(grades)
+        self.assertFalse(OpenAnswer.objects.filter(grade__isnull=False).exists())
+        self.assertFalse(ChapterSubmission.objects.filter(ready=True).exists())
+
+    def test_view(self):
+        self.client.force_login(User.objects.create_user('student', password='pw'))
+        self.assertEquals(self.client.get(self.url).status_code, 302)
+        self.client.force_login(User.objects.create_superuser('staff', 's@hi.com', 'pw'))
+        response = self.client.get(self.url)
+        self.assertEquals(len(response.context['answers']), 6)
+        self.assertContains(response, 'grade-%d' % self.answers[0].id)
+        response = self.client.post(self.url, {
+            'grade-%d' % self.answers[0].id: '1',
+            'comment-%d' % self.answers[0].id: 'good',
+            'grade-%d' % self.answers[1].id: '',
+        })
+        self.assertEquals(response.status_code, 302)
+        graded = OpenAnswer.objects.get(id=self.answers[0].id)
+        self.assertEquals((graded.grade, graded.comment), (1, 'good'))
+        self.assertEquals(len(self.client.get(self.url).context['answers']), 5)
+        response = self.client.post(self.url, {'grade-%d' % self.answers[1].id: '2'})
+        self.assertIn('error', response.context)
+
+    def test_api(self):
+        self.client.force_login(User.objects.create_superuser('staff', 's@hi.com', 'pw'))
+        data = self.client.get(self.url, {'format': 'json'}).json()
+        self.assertEquals([a['id'] for a in data['answers']], [a.id for a in self.answers])
+        self.assertIsNone(data['next'])
+        post = lambda body: self.client.post(self.url, body, content_type='application/json')
+        response = post(json.dumps({'grades': [{'id': a.id, 'grade': 0.3} for a in self.answers[:2]]}))
+        self.assertEquals(response.json(), {'graded': 2})
+        self.assertEquals(OpenAnswer.objects.get(id=self.answers[0].id).grade, Decimal('0.3'))
+        self.assertEquals(post(json.dumps({'grades': [{'id': self.answers[2].id, 'grade': 3}]})).status_code, 400)
+        self.assertEquals(post('not json').status_code, 400)
+        self.assertEquals(post(json.dumps({'grades': [1]})).status_code, 400)
+
+class IdempotencyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.question = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        self.choices = [Choice.objects.create(question=self.question, text=str(i), is_correct=i == 0) for i in range(2)]
+        self.user = User.objects.create_user('u', password='pw')
+        self.client.force_login(self.user)
+        self.url = reverse('logic:question', args=(self.chapter.chnum, 1))
+        self.lock_dir = tempfile.mkdtemp()
+        self.idempotency = self.settings(IDEMPOTENCY={'LOCK_DIR': self.lock_dir})
+        self.idempotency.enable()
+
+    def tearDown(self):
+        caches['default'].clear()
+        self.idempotency.disable()
+        shutil.rmtree(self.lock_dir)
+
+    def _post(self, choice, key):
+        return self.client.post(self.url, {'choice': choice.id}, HTTP_X_IDEMPOTENCY_KEY=key)
+
+    def _writes(self, key):
+        with CaptureQueriesContext(connection) as context:
+            if key:
+                self._post(self.choices[0], key)
+            else:
+                self.client.post(self.url, {'choice': self.choices[0].id})
+        return len([q for q in context.captured_queries if not q['sql'].startswith('SELECT')])
+
+    def test_repeated(self):
+        first = self._post(self.choices[0], 'k1')
+        self.assertIn('next', first.json())
+        self.assertNotIn('X-Idempotent-Replay', first)
+        with CaptureQueriesContext(connection) as context:
+            repeated = self._post(self.choices[1], 'k1')
+        self.assertEquals(repeated['X-Idempotent-Replay'], 'true')
+        self.assertEquals(repeated.content, first.content)
+        self.assertFalse([q for q in context.captured_queries if not q['sql'].startswith('SELECT')])
+        self.assertEquals(UserAnswer.objects.get().correct, True)
+        # a new key is handled
+        self.assertNotIn('X-Idempotent-Replay', self._post(self.choices[1], 'k2'))
+        self.assertEquals(UserAnswer.objects.get().correct, False)
+        # keys are per user
+        self.client.force_login(User.objects.create_user('u2', password='pw'))
+        self.assertNotIn('X-Idempotent-Replay', self._post(self.choices[0], 'k1'))
+        self.assertEquals(UserAnswer.objects.count(), 2)
+
+    def test_claim_writes(self):
+        # claiming a key writes nothing to the database
+        self._writes(None) # the first answer is created, and then updated
+        self.assertEquals(self._writes('k1'), self._writes(None))
+
+    def _claim(self, key):
+        request = RequestFactory().post(self.url)
+        request.user = self.user
+        ckey = idempotency.cache_key(request, key)
+        return ckey, idempotency._claim(ckey)
+
+    def test_pending(self):
+        ckey, claim = self._claim('k1')
+        with self.settings(IDEMPOTENCY={'LOCK_DIR': self.lock_dir, 'WAIT': 0}):
+            response = self._post(self.choices[0], 'k1')
+        self.assertIn('msg', response.json())
+        self.assertFalse(UserAnswer.objects.exists())
+        # a post arriving at the same moment as the first one cannot claim the key
+        self.assertIsNone(idempotency._claim(ckey))
+        self.assertEquals(idempotency.clear_locks(), 0)
+        idempotency._release(claim)
+        self.assertIn('next', self._post(self.choices[0], 'k1').json())
+
+    def test_abandoned(self):
+        # claimed by a process that died while handling the post, which released its lock
+        ckey, (path, fd) = self._claim('k1')
+        os.close(fd)
+        response = self._post(self.choices[0], 'k1')
+        self.assertIn('next', response.json())
+        self.assertTrue(UserAnswer.objects.exists())
+        self.assertEquals(os.listdir(self.lock_dir), []) # released
+        # and the lock file of another one is cleared
+        ckey, (path, fd) = self._claim('k2')
+        os.close(fd)
+        self.assertEquals(idempotency.clear_locks(), 1)
+        self.assertEquals(os.listdir(self.lock_dir), [])
+
+    def test_released(self):
+        calls = []
+        def view(self, request):
+            calls.append(request)
+            if len(calls) == 1:
+                raise ValueError('failed')
+            return HttpResponse(status=500 if len(calls) == 2 else 200)
+        view = idempotency.idempotent(view)
+        request = RequestFactory().post(self.url, HTTP_X_IDEMPOTENCY_KEY='k1')
+        request.user = self.user
+        with self.assertRaises(ValueError):
+            view(None, request)
+        self.assertEquals(view(None, request).status_code, 500)
+        self.assertEquals(view(None, request).status_code, 200)
+        self.assertEquals(view(None, request).status_code, 200)
+        self.assertEquals(len(calls), 3)
+
+class AdmissionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.controller, admission.controller = admission.controller, admission.AdmissionController(
+            max_concurrent=1, max_queue=0, max_wait=0, rate=1., burst=2, retry_after=3,
+        )
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.question = ChoiceQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        self.choice = Choice.objects.create(question=self.question, text='1', is_correct=True)
+        self.url = reverse('logic:question', args=(self.chapter.chnum, 1))
+
+    def tearDown(self):
+        admission.controller = self.controller
+
+    def _post(self, username):
+        self.client.force_login(User.objects.get_or_create(username=username)[0])
+        return self.client.post(self.url, {'choice': self.choice.id})
+
+    def test_semaphore(self):
+        semaphore = admission.FairSemaphore(1, 2)
+        self.assertTrue(semaphore.acquire(0))
+        self.assertFalse(semaphore.acquire(0.01))
+        order = []
+        def waiter(i):
+            if semaphore.acquire(5):
+                order.append(i)
+                time.sleep(0.01)
+                semaphore.release()
+        threads = []
+        for i in range(2):
+            threads.append(threading.Thread(target=waiter, args=(i,)))
+            threads[-1].start()
+            while len(semaphore.waiting) <= i:
+                time.sleep(0.001)
+        # the queue is full
+        self.assertFalse(semaphore.acquire(5))
+        semaphore.release()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(order, [0, 1])
+        self.assertEquals((semaphore.active, len(semaphore.waiting)), (0, 0))
+
+    def test_token_buckets(self):
+        buckets = admission.TokenBuckets(rate=2., burst=3)
+        self.assertEquals([buckets.take('u', now=0) for _ in range(3)], [0, 0, 0])
+        self.assertEquals(buckets.take('u', now=0), 0.5)
+        self.assertEquals(buckets.take('other', now=0), 0)
+        self.assertEquals(buckets.take('u', now=0.5), 0)
+        self.assertEquals(buckets.take('u', now=0.5), 0.5)
+        buckets.PRUNE_SIZE = 1
+        buckets.take('new', now=10)
+        self.assertEquals(buckets.buckets.keys(), ['new'])
+
+    def test_rate_limited(self):
+        self.assertIn('next', self._post('u1').json())
+        self.assertIn('next', self._post('u1').json())
+        response = self._post('u1')
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response.json()['retry'], 1)
+        self.assertEquals(response['Retry-After'], '1')
+        self.assertEquals(self._post('u2').status_code, 200)
+        self.assertEquals(admission.controller.stats()['rate_limited'], 1)
+
+    def test_overloaded(self):
+        admission.controller.semaphore.acquire(0)
+        response = self._post('u1')
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response.json()['retry'], 3)
+        self.assertFalse(UserAnswer.objects.exists())
+        admission.controller.semaphore.release()
+        self.assertEquals(self._post('u1').status_code, 200)
+        stats = admission.controller.stats()
+        self.assertEquals((stats['overloaded'], stats['admitted'], stats['active']), (1, 1, 0))
+
+class FollowupRefreshTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_settings()
+
+    def setUp(self):
+        self.chapter = Chapter.objects.create(title='chap', number=1.0)
+        self.question = FormulationQuestion.objects.create(chapter=self.chapter, text='hi?', number=1)
+        FormulationAnswer.objects.create(question=self.question, formula='p')
+        self.user = User.objects.create_user('u', password='pw')
+        self.client.force_login(self.user)
+        self.url = reverse('logic:followup-refresh', args=(self.chapter.chnum, 1))
+
+    def tearDown(self):
+        caches['default'].clear()
+
+    def _answer(self, formula):
+        self.client.post(reverse('logic:question', args=(self.chapter.chnum, 1)), {'formulation': formula})
+
+    def _poll(self, formula='p', tag=None):
+        headers = {'HTTP_IF_NONE_MATCH': tag} if tag else {}
+        return self.client.get(self.url, {'refresh': formula}, **headers)
+
+    def test_refresh(self):
+        response = self._poll()
+        self.assertEquals(response.json(), {})
+        self.assertEquals(response['ETag'], refresh.NO_ANSWER)
+        self._answer('p')
+        response = self._poll()
+        self.assertEquals(response.json(), {})
+        tag = response['ETag']
+        self.assertEquals(tag, refresh.etag('p'))
+        self.assertEquals(self._poll('q').json(), {'reload': 'y'})
+        # unchanged: only the session is read
+        with CaptureQueriesContext(connection) as context:
+            response = self._poll(tag=tag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(len(context), 1, [q['sql'] for q in context.captured_queries])
+        self.assertIn('django_session', context.captured_queries[0]['sql'])
+        # changed in another tab
+        self._answer(u'p%sq' % CON)
+        response = self._poll(tag=tag)
+        self.assertEquals(response.json(), {'reload': 'y'})
+        self.assertEquals(response['ETag'], refresh.etag(u'p%sq' % CON))
+        UserAnswer.objects.all().delete()
+        self.assertEquals(self._poll(tag=tag)['ETag'], refresh.NO_ANSWER)
+        self.client.logout()
+        self.assertEquals(self._poll().json(), {})
+
+    def test_logged_out(self):
+        self._answer('p')
+        self.assertEquals(self._poll('q').json(), {'reload': 'y'})
+        # a password change logs out the user's sessions
+        self.user.set_password('new')
+        self.user.save()
+        response = self._poll('q')
+        self.assertEquals(response.json(), {})
+        self.assertNotIn('ETag', response)
+        self.client.force_login(self.user)
+        self.assertEquals(self._poll('q').json(), {'reload': 'y'})
+        # and so does deactivation
+        self.user.is_active = False
+        self.user.save()
+        self.assertEquals(self._poll('q').json(), {})
+
+    def test_password_change(self):
+        self._answer('p')
+        other = Client()
+        other.force_login(self.user)
+        self.assertEquals(self._poll('q').json(), {'reload': 'y'})
+        self.assertEquals(other.get(self.url, {'refresh': 'q'}).json(), {'reload': 'y'})
+        # changed in the other session, which is logged in again with the new password
+        self.user.set_password('new')
+        self.user.save()
+        other.force_login(self.user)
+        self.assertEquals(other.get(self.url, {'refresh': 'q'}).json(), {'reload': 'y'})
+        # the hash cached for the other session does not let the stale one poll, which get_user logs out
+        self.assertEquals(self._poll('q').json(), {})
+        self.assertNotIn(SESSION_KEY, self.client.session)
+        self.assertEquals(other.get(self.url, {'refresh': 'q'}).json(), {'reload': 'y'})
+
+    def test_poll_interval(self):
+        self.assertEquals(self._poll()['X-Poll-Interval'], str(refresh.DEFAULTS['POLL_INTERVAL']))
+        controller, admission.controller = admission.controller, admission.AdmissionController(1, 1, 0, 1., 1, 1)
+        try:
+            admission.controller.semaphore.waiting.append(threading.Event())
+            with self.settings(FOLLOWUP_REFRESH={'PEAK_POLL_INTERVAL': 90}):
+                self.assertEquals(self._poll()['X-Poll-Interval'], '90')
+        finally:
+            admission.controller = controller
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'db.sqlite3')
+        self.dest = os.path.join(self.dir, 'snapshot.sqlite3')
+        conn = sqlite3.connect(self.source)
+        conn.execute('create table t (x integer)')
+        conn.execute('insert into t values (1)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _count(self):
+        conn = sqlite3.connect(self.dest)
+        try:
+            return conn.execute('select count(*) from t').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_take_snapshot(self):
+        take_snapshot(self.source, self.dest)
+        self.assertEquals(self._count(), 1)
+        conn = sqlite3.connect(self.source)
+        conn.execute('insert into t values (2)')
+        conn.commit()
+        conn.close()
+        take_snapshot(self.source, self.dest)
+        self.assertEquals(self._count(), 2)
+        self.assertEquals(sorted(os.listdir(self.dir)), ['db.sqlite3', 'snapshot.sqlite3'])
+
+    def test_locked_copy(self):
+        # as with sqlite older than VACUUM INTO, of a wal database with changes not yet checkpointed
+        conn = sqlite3.connect(self.source)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA wal_autocheckpoint=0')
+        conn.execute('insert into t values (2)')
+        conn.commit()
+        version, db.VACUUM_INTO_VERSION = db.VACUUM_INTO_VERSION, (99,)
+        try:
+            take_snapshot(self.source, self.dest)
+        finally:
+            db.VACUUM_INTO_VERSION = version
+            conn.close()
+        self.assertEquals(self._count(), 2)
+        self.assertEquals(sorted(os.listdir(self.dir)), ['db.sqlite3', 'snapshot.sqlite3'])
+
+    def test_snapshot_age(self):
+        self.assertIsNone(snapshot_age(self.dest))
+        take_snapshot(self.source, self.dest)
+        self.assertLess(snapshot_age(self.dest), 5)
+        old = os.path.getmtime(self.dest) - 3600
+        os.utime(self.dest, (old, old))
+        self.assertGreater(snapshot_age(self.dest), 3599)
+
+    def test_fallback(self):
+        # no snapshot in tests, so reads go to the default database
+        self.assertEquals(snapshot_alias(), 'default')
+
 class FormulaTests(TestCase):
 
     def test_strip(self):
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Upload handling for open answer files.
+
+HashingUploadHandler (set in settings.FILE_UPLOAD_HANDLERS) streams each uploaded file in chunks to a
+temporary file on disk, hashing it on the way, so that memory use does not depend on the file size.
+A file larger than the maximum size in the global settings stops the upload as soon as it is exceeded:
+the rest of the request is read and discarded, the temporary file is removed and the request is marked
+with upload_rejected, to be checked by the view.
+Uploaded files are then stored by their content hash (see StoredFile).
+"""
+import hashlib
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from .models import GlobalSettings
+
+import logging
+logger = logging.getLogger(__name__)
+
+class HashingUploadHandler(FileUploadHandler):
+
+    def __init__(self, request=None):
+        super(HashingUploadHandler, self).__init__(request)
+        self.max_size = None
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        if self.max_size is None:
+            self.max_size = GlobalSettings.get().max_file_size * 1024 * 1024
+        self.file = TemporaryUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            logger.warning('%s: upload of %s exceeds %d bytes, stopping', getattr(self.request, 'user', None), self.file_name, self.max_size)
+            if self.request is not None:
+                self.request.upload_rejected = self.file_name
+            raise StopUpload()
+        self.hash.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.hash.hexdigest()
+        logger.debug('uploaded %s: %d bytes, sha256 %s', self.file_name, file_size, self.file.sha256)
+        return self.file
@@ -9,6 +9,7 @@ urlpatterns = [
     # general
     url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^stats/$', views.StatsView.as_view(), name='stats'),
+    url(r'^perf/$', never_cache(views.PerfView.as_view()), name='perf'),
     url(r'^user/$', views.UserView.as_view(), name='user'),
     url(r'^chapter-maintenance/$', views.ChapterMaintenanceView.as_view(), name='chapter-maintenance'),
 
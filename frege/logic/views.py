@@ -1,18 +1,22 @@
 # -*- coding: utf-8 -*-
 import ast
+import os
 import re
-import time
 
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
-from django.db import transaction
-from django.db.utils import OperationalError
-from django.http import Http404, HttpResponseRedirect, JsonResponse
-from django.shortcuts import get_object_or_404, render
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404, HttpResponseNotModified, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
 from django.utils import formats, timezone
+from django.utils.cache import patch_cache_control
 from django.views import generic
 from django.views.decorators.cache import never_cache
 
+from frege.logs import sampled
+
 from .formula import (
     Formula,
     PredicateFormula,
@@ -28,6 +32,7 @@ from .formula import (
 )
 from .models import (
     Chapter,
+    ChapterIndex,
     Question,
     ChoiceQuestion,
     Choice,
@@ -40,35 +45,47 @@ from .models import (
     UserAnswer,
     ChapterSubmission,
     OpenAnswer,
-    Stat,
     GlobalSettings,
+    ChapterStats,
+    ChapterStatsCount,
+    QuestionStats,
+    MAX_ANSWER_STATS,
+    name_file,
 )
+from . import admission, media, perf, previews, refresh
+from .admission import admitted
+from .db import counters, snapshot_alias, snapshot_conf, snapshot_time, write_transaction
+from .idempotency import idempotent
+from .progress import ChapterProgress
+from .stat_buffer import stat_buffer
 
 import logging
 logger = logging.getLogger(__name__)
 
-def get_question_or_404(**kwargs):
-    question = Question._get(**kwargs)
+def get_chapter_or_404(chnum):
+    chapter = ChapterIndex.get().chapter(chnum)
+    if chapter is None:
+        raise Http404('Chapter does not exist: %s' % chnum)
+    return chapter
+
+def get_question_or_404(chnum, qnum):
+    chapter = get_chapter_or_404(chnum)
+    question = Question._get(chapter=chapter, number=qnum)
     if not question:
-        raise Http404('Question does not exist: %s' % kwargs)
+        raise Http404('Question does not exist: %s/%s' % (chnum, qnum))
+    question.chapter = chapter
     return question
 
-def next_question(chapter, user):
-    questions = Question._filter(chapter=chapter)
-    questions.sort(key=lambda q: q.number)
-    for question in questions:
-        if not question.user_answer(user):
-            return question
-
-    # check for unanswered followups
-    for question in questions:
-        if question.has_followup() and len(question.user_answers(user=user)) == 1:
-            return question
+def next_question(chapter, user, progress=None):
+    progress = progress or ChapterProgress(chapter, user)
+    question = progress.first_unanswered()
+    if question:
+        return question
 
     # all questions are answered, check if re-answering
     submission = ChapterSubmission.objects.filter(chapter=chapter, user=user).first()
     if submission and submission.ongoing:
-        return chapter.first_question()
+        return progress.first_question()
 
 def next_question_url(chapter, user):
     question = next_question(chapter, user)
@@ -78,83 +95,109 @@ def next_question_url(chapter, user):
         url = reverse('logic:chapter-summary', args=(chapter.chnum,))
     return url
 
-def chapter_questions_user_data(chapter, user):
-    user_answers = {(ans.question_number, ans.is_followup) \
-                    for ans in UserAnswer.objects.filter(user=user, chapter=chapter)}
-    data = {}
-    for q in chapter.questions():
-        data[q.number] = (q.number, False) in user_answers
-        if q.has_followup() and data[q.number]:
-            if not (q.number, True) in user_answers:
-                data[q.number] = 'half'
-    return data
-
-def avg(iterable):
-    lst = list(iterable)
-    return sum(lst)/float(len(lst))
-
-def groupby(data_list, key):
-    groups = {}
-    for item in data_list:
-        groups.setdefault(key(item), []).append(item)
-    return groups
+def chapter_questions_user_data(chapter, user, progress=None):
+    progress = progress or ChapterProgress(chapter, user)
+    return progress.statuses()
 
 class IndexView(LoginRequiredMixin, generic.ListView):
     template_name = 'logic/index.html'
+    context_object_name = 'chapter_list'
 
     def get_queryset(self):
-        chapters = Chapter.objects.all()
+        chapters = ChapterIndex.get().chapters
         logger.debug('%s: %d chapters', self.request.user, len(chapters))
         return chapters
 
 class ChapterPartsView(LoginRequiredMixin, generic.ListView):
     template_name = 'logic/parts.html'
+    context_object_name = 'chapter_list'
 
     def get_queryset(self, **kwargs):
-        chapter = get_object_or_404(Chapter, number=self.kwargs['chnum'])
-        parts = chapter.parts()
+        index = ChapterIndex.get()
+        chapter = index.chapter(self.kwargs['chnum'])
+        if chapter is None:
+            raise Http404
+        parts = index.chapter_parts(chapter.number)
         logger.debug('%s:chapter%s: %d parts', self.request.user, chapter.number, len(parts))
         return parts
 
+def stats_db_context(db):
+    """ context showing how up to date the stats are, when they are read from the snapshot """
+    if db == DEFAULT_DB_ALIAS:
+        return {}
+    return {
+        'data_time': snapshot_time(),
+        'data_max_age': snapshot_conf()['MAX_AGE'] / 60,
+    }
+
 class StatsView(LoginRequiredMixin, generic.ListView):
     template_name = 'logic/stats.html'
 
     def get_queryset(self):
-        chapters = Chapter.objects.all()
-        logger.debug('%s:stats: %d chapters', self.request.user, len(chapters))
+        self.db = snapshot_alias()
+        chapters = Chapter.objects.using(self.db).all()
+        logger.debug('%s:stats: %d chapters from %s', self.request.user, len(chapters), self.db)
         return chapters
 
     def get_context_data(self, **kwargs):
         context = super(StatsView, self).get_context_data(**kwargs)
+        context.update(stats_db_context(self.db))
         chapters = self.object_list
         # general stats
-        subs = []
-        # fetch stats by chapter since a single query is apparently too much for sqlite
-        for ch in Chapter.objects.all():
-            subs.extend([
-                s for s in ChapterSubmission.objects.filter(chapter=ch).prefetch_related('useranswer_set').select_related('chapter')
-                if s.is_ready_for_stats()
-            ])
-        logger.debug('%s:stats: %d submissions ready', self.request.user, len(subs))
-        by_chapter = groupby(subs, lambda s: s.chapter.number)
-        pct_by_sub = {s.id: s.percent_correct() for s in subs}
-        context['num_sub'] = len(subs)
-        if subs:
-            context['avg_attempts'] = avg(s.attempt for s in subs)
-            context['avg_grade'] = avg(pct_by_sub.itervalues())
+        stats = {s.chapter_id: s for s in ChapterStats.objects.using(self.db).filter(num_sub__gt=0)}
+        num_sub = sum(s.num_sub for s in stats.itervalues())
+        logger.debug('%s:stats: %d submissions ready', self.request.user, num_sub)
+        context['num_sub'] = num_sub
+        if num_sub:
+            context['avg_attempts'] = float(sum(s.sum_attempts for s in stats.itervalues())) / num_sub
+            context['avg_grade'] = float(sum(s.sum_grade for s in stats.itervalues())) / num_sub
             # chapter stats
-            chapter_data = []
-            for chapter in chapters:
-                subs = by_chapter.get(chapter.number)
-                if subs:
-                    avg_grade = avg(pct_by_sub[s.id] for s in subs)
-                    num_sub = len(subs)
-                    avg_attempts = avg(s.attempt for s in subs)
-                    chapter_data.append((chapter, avg_grade, num_sub, avg_attempts))
-            context['chapter_data'] = chapter_data
-        logger.debug('%s:stats: context=%s', self.request.user, context)
+            context['chapter_data'] = [
+                (chapter, stats[chapter.id].avg_grade, stats[chapter.id].num_sub, stats[chapter.id].avg_attempts)
+                for chapter in chapters if chapter.id in stats
+            ]
+        logger.debug('%s:stats: context=%s', self.request.user, sampled(context))
         return context
 
+class PerfView(LoginRequiredMixin, generic.View):
+    """ request performance histograms per url name, for staff """
+
+    def get(self, request):
+        if not request.user.is_staff:
+            raise Http404
+        logger.debug('%s: serving performance stats', request.user)
+        return JsonResponse({
+            'urls': perf.registry.summary(),
+            'db': counters.get(),
+            'admission': admission.controller.stats() if admission.controller else None,
+        })
+
+class MediaView(LoginRequiredMixin, generic.View):
+    """ uploaded files: staff may get any file, and students the files (and previews) of their own open answers """
+
+    def get(self, request, path):
+        try:
+            full_path = default_storage.path(path)
+        except SuspiciousFileOperation:
+            raise Http404
+        base = previews.preview_base(path)
+        if base:
+            answers = OpenAnswer.objects.filter(upload__startswith=base + '.')
+        else:
+            answers = OpenAnswer.objects.filter(upload=path)
+        answers = answers.select_related('user_answer__user', 'question__chapter')
+        if not request.user.is_staff:
+            answers = answers.filter(user_answer__user=request.user)
+        answer = answers.first()
+        if not answer and not request.user.is_staff:
+            logger.warning('%s: not allowed to get %s', request.user, path)
+            raise Http404
+        # files are stored by content, so they are named after the answer
+        filename = os.path.basename(name_file(answer, path)) if answer and not base else None
+        response = media.serve(request, full_path, filename)
+        patch_cache_control(response, private=True)
+        return response
+
 class AboutView(LoginRequiredMixin, generic.DetailView):
     template_name = 'logic/help.html'
     def get_object(self):
@@ -170,14 +213,14 @@ class HelpView(LoginRequiredMixin, generic.DetailView):
 class ChapterView(LoginRequiredMixin, generic.DetailView):
 
     def get_object(self):
-        return get_object_or_404(Chapter, number=self.kwargs['chnum'])
+        return get_chapter_or_404(self.kwargs['chnum'])
 
     def dispatch(self, request, chnum):
         if not request.user.is_authenticated():
             return HttpResponseRedirect(reverse('login'))
         if float(chnum) in MAINTENANCE_CHAPTERS:
             return HttpResponseRedirect(reverse('logic:chapter-maintenance'))
-        chapter = get_object_or_404(Chapter, number=chnum)
+        chapter = get_chapter_or_404(chnum)
         logger.debug('%s: chapter %s', self.request.user, chapter)
         return HttpResponseRedirect(next_question_url(chapter, request.user))
 
@@ -205,12 +248,12 @@ class ChapterStatsView(LoginRequiredMixin, generic.DetailView):
     template_name = 'logic/chapter_stats.html'
 
     def get_object(self):
-        return get_object_or_404(Chapter, number=self.kwargs['chnum'])
+        return get_chapter_or_404(self.kwargs['chnum'])
 
     def dispatch(self, request, chnum):
         if not request.user.is_authenticated():
             return HttpResponseRedirect(reverse('login'))
-        chapter = get_object_or_404(Chapter, number=chnum)
+        chapter = get_chapter_or_404(chnum)
         if chapter.num_questions() == 0:
             return HttpResponseRedirect(reverse('logic:index'))
         return super(ChapterStatsView, self).dispatch(request, chnum)
@@ -218,88 +261,54 @@ class ChapterStatsView(LoginRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super(ChapterStatsView, self).get_context_data(**kwargs)
         chapter = self.object
-        logger.debug('%s:chapter %s stats', self.request.user, chapter.number)
-
-        # get submission data (only ready ones)
-        submissions = [
-            s for s in ChapterSubmission.objects.filter(chapter=chapter).prefetch_related('useranswer_set')
-            if s.is_ready_for_stats()
-        ]
-        sub_ids = set(s.id for s in submissions)
-        stats = [
-            s for s in Stat.objects.filter(user_answer__chapter=chapter, user_answer__submission_id__in=sub_ids)
-            .select_related('user_answer')
-            .select_related('user_answer___cq')
-            .select_related('user_answer___fq')
-            .select_related('user_answer___tq')
-            .select_related('user_answer___dq')
-            .select_related('user_answer___oq')
-            .select_related('user_answer___mq')
-        ]
-        logger.debug(
-            '%s:chapter %s stats: fetched %d ready submissions and %d stats',
-            self.request.user, chapter.number, len(submissions), len(stats)
-        )
-
-        # submission stats
-        context['num_sub'] = len(submissions)
-        if not submissions:
+        db = snapshot_alias()
+        context.update(stats_db_context(db))
+        logger.debug('%s:chapter %s stats from %s', self.request.user, chapter.number, db)
+
+        # submission stats (only ready ones)
+        chapter_stats = ChapterStats.objects.using(db).filter(chapter_id=chapter.id, num_sub__gt=0).first()
+        context['num_sub'] = chapter_stats.num_sub if chapter_stats else 0
+        if not chapter_stats:
             return context
-        context['avg_attempts'] = avg(s.attempt for s in submissions)
+        context['avg_attempts'] = chapter_stats.avg_attempts
+        context['avg_grade'] = chapter_stats.avg_grade
 
-        grades = [s.percent_correct() for s in submissions]
         grades_dist = {i: 0 for i in range(0,100,10)}
-        for grade in grades:
-            grades_dist[grade] = grades_dist.get(grade, 0) + 1
-        grades_dist = [(k, v) for k, v in grades_dist.iteritems()]
-        grades_dist.sort(key=lambda x: x[0])
-        context['grades'] = grades_dist
-        context['avg_grade'] = avg(grades)
-
-        attempts = [s.attempt for s in submissions]
         attempts_dist = {}
-        for a in attempts:
-            attempts_dist[a] = attempts_dist.get(a, 0) + 1
-        attempts_dist = [(k, v) for k, v in attempts_dist.iteritems()]
-        attempts_dist.sort(key=lambda x: x[0])
-        context['attempts'] = attempts_dist
- 
+        for count in ChapterStatsCount.objects.using(db).filter(chapter_id=chapter.id, count__gt=0):
+            if count.kind == ChapterStatsCount.GRADE:
+                grades_dist[count.value] = count.count
+            else:
+                attempts_dist[count.value] = count.count
+        context['grades'] = sorted(grades_dist.iteritems())
+        context['attempts'] = sorted(attempts_dist.iteritems())
+
         # question stats
-        by_question = groupby(stats, lambda s: s.user_answer.question_number)
         questions_stats = []
-        for qnum, stat_list in by_question.iteritems():
-            if stat_list:
-                num_stats = len(stat_list)
-                user_answers = set(s.user_answer for s in stat_list)
-                if chapter.is_open():
-                    pct_correct = 100.*sum(float(a.openanswer.grade) for a in user_answers)/len(user_answers)
-                    final_pct_correct = pct_correct
-                else:
-                    pct_correct = 100.*sum(1 for s in stat_list if s.correct)/num_stats
-                    final_pct_correct = 100.*sum(1 for a in user_answers if a.correct)/len(user_answers)
-                attempts = num_stats
-                avg_attempts = float(num_stats)/len(user_answers)
+        for qs in QuestionStats.objects.using(db).filter(chapter_id=chapter.id, num_answers__gt=0):
+            final_pct_correct = 100.*qs.num_final_correct/qs.num_answers
+            if chapter.is_open():
+                pct_correct = first_pct_correct = final_pct_correct
             else:
-                pct_correct = None
-                final_pct_correct = None
-                attempts = None
-                avg_attempts = None
-            questions_stats.append((qnum, pct_correct, final_pct_correct, attempts, avg_attempts))
+                pct_correct = 100.*qs.num_attempts_correct/qs.num_attempts
+                first_pct_correct = 100.*qs.num_first_correct/qs.num_answers
+            avg_attempts = float(qs.num_attempts)/qs.num_answers
+            questions_stats.append((qs.question_number, pct_correct, final_pct_correct, first_pct_correct, qs.num_attempts, avg_attempts))
         context['q_stats'] = questions_stats
 
-        logger.debug('%s:chapter %s stats: context=%s', self.request.user, chapter.number, context)
+        logger.debug('%s:chapter %s stats: context=%s', self.request.user, chapter.number, sampled(context))
         return context
 
 class ChapterSummaryView(LoginRequiredMixin, generic.DetailView):
     template_name = 'logic/chapter_summary.html'
 
     def get_object(self):
-        return get_object_or_404(Chapter, number=self.kwargs['chnum'])
+        return get_chapter_or_404(self.kwargs['chnum'])
 
     def dispatch(self, request, chnum):
         if not request.user.is_authenticated():
             return HttpResponseRedirect(reverse('login'))
-        chapter = get_object_or_404(Chapter, number=chnum)
+        chapter = get_chapter_or_404(chnum)
         if chapter.num_questions() == 0:
             return HttpResponseRedirect(reverse('logic:index'))
         return super(ChapterSummaryView, self).dispatch(request, chnum)
@@ -324,44 +333,42 @@ class ChapterSummaryView(LoginRequiredMixin, generic.DetailView):
                 context['comments'] = {
                     a.question.number: a.comment for a in OpenAnswer.objects.filter(user_answer__submission=submission)
                 }
-            logger.debug('%s: serving chapter %s summary, context=%r', self.request.user, chapter.number, context)
+            logger.debug('%s: serving chapter %s summary, context=%r', self.request.user, chapter.number, sampled(context))
         else:
             logger.debug('%s: not serving chapter %s summary', self.request.user, chapter.number)
         return context
 
+    @admitted
     def post(self, request, chnum):
         logger.info('%s: submitting chapter %s', request.user, chnum)
-        chapter = Chapter.objects.get(number=chnum)
-        submission = ChapterSubmission.objects.get(
-            user=request.user,
-            chapter=chapter,
-        )
-        logger.debug('%s: fetched submission %s for update', request.user, submission)
+        chapter = get_chapter_or_404(chnum)
         response = {}
 
         # DB WRITE
-        while True:
-            try:
-                if submission.is_complete() and submission.can_try_again() and submission.ongoing:
-                    submission.time = timezone.localtime(timezone.now())
-                    submission.attempt += 1
-                    submission.ongoing = False
-                    submission.save()
-                    logger.info('%s: saved submission: %s', self.request.user, submission)
-                    response['next'] = reverse('logic:chapter-summary', args=(chapter.chnum,))
-                else:
-                    logger.info('%s: submission not allowed: %s', self.request.user, submission)
-                break
-            except OperationalError, e:
-                logger.error('%s: got %s', request.user, e)
-                time.sleep(0.2)
-            except Exception, e:
-                logger.error('%s: got unexpected %s (%s)', request.user, e, type(e))
-                raise
+        self._submit(request, chapter, response)
 
         logger.debug('%s: submission post response: %s', self.request.user, response)
         return JsonResponse(response)
 
+    @write_transaction
+    def _submit(self, request, chapter, response):
+        # fetched in the transaction, so that a retry does not see the changes of a failed attempt
+        submission = ChapterSubmission.objects.select_for_update().get(
+            user=request.user,
+            chapter=chapter,
+        )
+        logger.debug('%s: fetched submission %s for update', request.user, submission)
+        if submission.is_complete() and submission.can_try_again() and submission.ongoing:
+            submission.time = timezone.localtime(timezone.now())
+            submission.attempt += 1
+            submission.ongoing = False
+            submission.save()
+            submission.update_grade()
+            logger.info('%s: saved submission: %s', request.user, submission)
+            response['next'] = reverse('logic:chapter-summary', args=(chapter.chnum,))
+        else:
+            logger.info('%s: submission not allowed: %s', request.user, submission)
+
 MAINTENANCE_CHAPTERS = [
 ]
 
@@ -407,7 +414,7 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
         return super(QuestionView, self).dispatch(request, chnum, qnum)
 
     def get_object(self):
-        question = get_question_or_404(chapter__number=self.kwargs['chnum'], number=self.kwargs['qnum'])
+        question = get_question_or_404(self.kwargs['chnum'], self.kwargs['qnum'])
         logger.debug('%s: question %s', self.request.user, question._str)
         return question
 
@@ -416,7 +423,8 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
         question = self.object
         logger.debug('%s: question %s %s', self.request.user, question._str, type(question))
         context['chapter'] = question.chapter
-        context['chap_questions'] = chapter_questions_user_data(question.chapter, self.request.user)
+        progress = ChapterProgress(question.chapter, self.request.user)
+        context['chap_questions'] = chapter_questions_user_data(question.chapter, self.request.user, progress)
 
         # update submission data
         submission = ChapterSubmission.objects.filter(chapter=question.chapter, user=self.request.user).first()
@@ -429,7 +437,7 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
 
         # update answer data
         answer = None
-        user_answer = question.user_answer(user=self.request.user, is_followup=self._is_followup())
+        user_answer = progress.answer(question, is_followup=self._is_followup())
         if user_answer:
             answer = user_answer.answer
             context['ans_time'] = user_answer.time
@@ -444,20 +452,26 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
             '%s: serving question %s/%s%s, context=%s',
             self.request.user, question.chapter.number, question.number,
             '[followup]' if self._is_followup() else '',
-            context,
+            sampled(context),
         )
         return context
 
+    @idempotent
+    @admitted
     def post(self, request, chnum, qnum):
 
         if 'remove-file' in request.POST:
             self._remove_answer_file(request, chnum, qnum)
             return JsonResponse({})
 
+        if getattr(request, 'upload_rejected', None):
+            # the rest of the post is not read (see uploads.py)
+            return JsonResponse({'msg':'לא ניתן להעלות קובץ גדול מ-%dMB' % GlobalSettings.get().max_file_size})
+
         logger.info('%s: answering question %s/%s%s', request.user, chnum, qnum, '[followup]' if self._is_followup() else '')
         logger.debug('%s: post data %s', request.user, request.POST)
 
-        chapter = Chapter.objects.get(number=chnum)
+        chapter = get_chapter_or_404(chnum)
         question = Question._get(chapter__number=chnum, number=qnum)
         ext_data = None
 
@@ -467,44 +481,13 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
                 return JsonResponse({'msg':'תשובה כבר נבדקה - לא ניתן לבצע שינויים'})
 
         # DB WRITE
-        while True:
-            try:
-                # atomize all the save operations, to commit once
-                with transaction.atomic():
-    
-                    # handle user submission
-                    submission, created = ChapterSubmission.objects.get_or_create(
-                        user=request.user,
-                        chapter=chapter,
-                        defaults={
-                            'attempt':0,
-                            'ongoing':True,
-                        },
-                    )
-                    logger.debug('%s: fetched submission %s, created=%s', request.user, submission, created)
-        
-                    if not submission.can_try_again():
-                        response = {'msg':'עברת את מספר הנסיונות המירבי לפרק זה'}
-                        logger.info('%s: cannot try again, submission=%s, reponse=%s', request.user, submission, response)
-                        return JsonResponse(response)
-        
-                    if not submission.ongoing:
-                        logger.debug('%s: submission is now ongoing', request.user)
-                        submission.ongoing = True
-                        submission.save()
- 
-                    # handle answer
-                    user_ans, ext_data = self._handle_user_answer(request, question, submission)
-                    break
-
-            except OperationalError, e:
-                logger.error('%s: got %s', request.user, e)
-                time.sleep(0.2)
-            except ReloadPageException, e:
-                return JsonResponse({'reload':'y'})
-            except Exception, e:
-                logger.error('%s: got unexpected %s (%s)', request.user, e, type(e))
-                raise
+        try:
+            result = self._save_answer(request, chapter, question)
+        except ReloadPageException, e:
+            return JsonResponse({'reload':'y'})
+        if isinstance(result, JsonResponse):
+            return result
+        submission, user_ans, ext_data = result
 
         # make a response
         response = {
@@ -518,6 +501,41 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
         logger.debug('%s: question post response: %s', request.user, response)
         return JsonResponse(response)
 
+    @write_transaction
+    def _save_answer(self, request, chapter, question):
+        """
+        saves the answer in a single transaction, returns the submission, user answer and extra data, or an error response.
+        the submission and user answer are fetched in the transaction, so that a retry does not see the changes of a failed attempt
+        """
+
+        # handle user submission
+        submission, created = ChapterSubmission.objects.get_or_create(
+            user=request.user,
+            chapter=chapter,
+            defaults={
+                'attempt':0,
+                'ongoing':True,
+            },
+        )
+        logger.debug('%s: fetched submission %s, created=%s', request.user, submission, created)
+
+        if not submission.can_try_again():
+            response = {'msg':'עברת את מספר הנסיונות המירבי לפרק זה'}
+            logger.info('%s: cannot try again, submission=%s, reponse=%s', request.user, submission, response)
+            return JsonResponse(response)
+
+        if not submission.ongoing:
+            logger.debug('%s: submission is now ongoing', request.user)
+            submission.ongoing = True
+            submission.save()
+
+        # handle answer
+        user_ans, ext_data = self._handle_user_answer(request, question, submission)
+        if submission.is_submitted():
+            # once the answer is saved, grades of unsubmitted submissions are not stored
+            submission.update_grade()
+        return submission, user_ans, ext_data
+
     def _handle_user_answer(self, request, question, submission):
         # handle answer according to question type
         correct, ext_data, answer = self.post_handlers[type(question)](request, question)
@@ -532,6 +550,7 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
                 'correct': correct,
                 'answer': answer,
                 'time': timezone.localtime(timezone.now()),
+                'attempts': 1,
             },
             **UserAnswer.get_kw(question)
         )
@@ -540,29 +559,25 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
         if type(question) in self.answer_handlers:
             self.answer_handlers[type(question)](request, question, user_ans)
 
-        # save user answer
+        # save user answer, counting the attempt if the answer changed
+        record_stat = created
         if not created:
-            changed = user_ans.answer != answer
+            if user_ans.answer != answer:
+                if user_ans.attempts < MAX_ANSWER_STATS:
+                    user_ans.attempts += 1
+                    record_stat = True
+                else:
+                    logger.warning('%s: exceeding answer stats for %s, not creating any more', request.user, user_ans)
+            else:
+                logger.debug('%s: answer not changed, not saving stat', request.user);
             user_ans.correct = correct
             user_ans.answer = answer
             user_ans.time = timezone.localtime(timezone.now())
             user_ans.save()
-        else:
-            changed = True
-            user_ans.set_question(question)
-            user_ans.save()
 
-        # create stat for answer
-        if user_ans.stat_set.count() < 4:
-            if changed:
-                Stat.objects.create(
-                    user_answer = user_ans,
-                    correct = correct,
-                )
-            else:
-                logger.debug('%s: answer not changed, not saving stat', request.user);
-        else:
-            logger.warning('%s: exceeding answer stats for %s, not creating any more', request.user, user_ans)
+        # create stat for answer (written after the transaction commits)
+        if record_stat:
+            stat_buffer.add(user_ans, correct)
 
         logger.info(
             '%s: %s answer %s/%s, correct=%s',
@@ -571,41 +586,32 @@ class QuestionView(LoginRequiredMixin, generic.DetailView):
         )
         return user_ans, ext_data
 
+    # DB WRITE
+    @write_transaction
     def _remove_answer_file(self, request, chnum, qnum):
-        
-        # DB WRITE
-        while True:
-            try:
-                with transaction.atomic():
-                    logger.info('%s: removing answer file for question %s/%s', request.user, chnum, qnum)
-                    question = Question._get(chapter__number=chnum, number=qnum)
-                    user_answer = question.user_answer(user=request.user)
-                    if not user_answer:
-                        logger.debug('%s: no user answer found for file removal', request.user)
-                        return
-                    filename, text = self._get_open_answer_data(user_answer.answer)
-                    if not text:
-                        # delete the entire user answer, since the file is all there was
-                        logger.debug('%s: deleting user answer %s', request.user, user_answer)
-                        user_answer.delete()
-                    else:
-                        cur_open_ans = OpenAnswer.objects.filter(question=question, user_answer=user_answer).first()
-                        if cur_open_ans:
-                            if cur_open_ans.upload:
-                                cur_open_ans.upload.delete(save=True)
-                                user_answer.answer = self._make_open_answer_data(upload=cur_open_ans.upload, text=cur_open_ans.text)
-                                user_answer.save()
-                            else:
-                                logger.debug('%s: no upload found for removal', request.user)
-                        else:
-                            logger.warning('%s: no open answer found for file removal', request.user)
-                    break
-            except OperationalError, e:
-                logger.error('%s: got %s', request.user, e)
-                time.sleep(0.2)
-            except Exception, e:
-                logger.error('%s: got unexpected %s (%s)', request.user, e, type(e))
-                raise
+        logger.info('%s: removing answer file for question %s/%s', request.user, chnum, qnum)
+        question = Question._get(chapter__number=chnum, number=qnum)
+        user_answer = question.user_answer(user=request.user)
+        if not user_answer:
+            logger.debug('%s: no user answer found for file removal', request.user)
+            return
+        filename, text = self._get_open_answer_data(user_answer.answer)
+        if not text:
+            # delete the entire user answer, since the file is all there was
+            logger.debug('%s: deleting user answer %s', request.user, user_answer)
+            user_answer.delete()
+        else:
+            cur_open_ans = OpenAnswer.objects.filter(question=question, user_answer=user_answer).first()
+            if cur_open_ans:
+                if cur_open_ans.upload:
+                    cur_open_ans.upload = None
+                    cur_open_ans.save() # releases the file
+                    user_answer.answer = self._make_open_answer_data(upload=cur_open_ans.upload, text=cur_open_ans.text)
+                    user_answer.save()
+                else:
+                    logger.debug('%s: no upload found for removal', request.user)
+            else:
+                logger.warning('%s: no open answer found for file removal', request.user)
 
     def _next_url(self, request, question):
         if question.has_followup():
@@ -874,7 +880,7 @@ class FollowupQuestionView(QuestionView):
         return super_dispatch
 
     def get_object(self):
-        original = get_question_or_404(chapter__number=self.kwargs['chnum'], number=self.kwargs['qnum'])
+        original = get_question_or_404(self.kwargs['chnum'], self.kwargs['qnum'])
         self.original_q = original
         self.original_ans = self._get_answer(original)
         if not hasattr(original, 'followup') or not self.original_ans:
@@ -917,19 +923,23 @@ class FollowupQuestionView(QuestionView):
         return handler(request, self.get_object())
 
 class FollowupRefreshView(LoginRequiredMixin, generic.DetailView):
+    """ polled by followup pages, answered from the session and the cache (see refresh.py) """
     def get_object(self):
         return None
     def dispatch(self, request, chnum, qnum):
-        logger.debug('%s: refresh %s/%s', self.request.user, chnum, qnum)
-        user_answer = UserAnswer.objects.filter(
-            user=self.request.user,
-            _fq__number=qnum,
-            chapter__number=chnum,
-            is_followup=False
-        ).first() if request.user.is_authenticated() else None
-        if user_answer:
-            answer_formula = request.GET.get('refresh')
-            if answer_formula != user_answer.answer:
-                logger.debug('%s: should reload %s/%s', self.request.user, chnum, qnum)
-                return JsonResponse({'reload':'y'})
-        return JsonResponse({})
+        user_id = refresh.session_user_id(request)
+        logger.debug('%s: refresh %s/%s', user_id, chnum, qnum)
+        if user_id is None:
+            return JsonResponse({})
+        tag = refresh.answer_tag(user_id, chnum, qnum)
+        if request.META.get('HTTP_IF_NONE_MATCH') == tag:
+            response = HttpResponseNotModified()
+        else:
+            response = JsonResponse({})
+            if tag != refresh.NO_ANSWER and refresh.etag(request.GET.get('refresh', '')) != tag:
+                logger.debug('%s: should reload %s/%s', user_id, chnum, qnum)
+                response = JsonResponse({'reload':'y'})
+        response['ETag'] = tag
+        response['X-Poll-Interval'] = refresh.poll_interval()
+        patch_cache_control(response, private=True, no_cache=True)
+        return response